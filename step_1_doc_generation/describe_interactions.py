@@ -1,12 +1,12 @@
 import copy
 import json
 import os
-import pickle
 from bs4 import BeautifulSoup
 from requests import Timeout
 import requests
 from utils import get_action_desc
 from tools import load_yaml_file, dump_json_file,debug_query_gptv2, load_json_file, convert_gpt_answer_to_json
+from task_graph import DEFAULT_MAX_WORKERS, PromptAnswers, RecordCheckpoints, run_chains
 import base64
 MAX_RETRY = 3
 
@@ -250,7 +250,55 @@ def get_existing_result(output_file_name):
         return data,tag_states
     return None,None
 
-def describe(annotation_log_path, annotation_states_path, output_file_name, model="gpt-4o", prompt_answer_path='temp/prompt_answers.json', include_image=True):
+def is_valid_description(result):
+    '''
+    @return: whether the answer describes the current screen, the next screen and the interaction of the record
+    '''
+    return isinstance(result, dict) and all(
+        isinstance(result.get(key), dict) and "api_name" in result[key]
+        for key in ["current_screen", "interaction_screen", "interaction_effect"])
+
+def get_records_to_describe(data):
+    '''
+    @return: [(iteration, last_step_is_open_app)] of the records described, in order
+    '''
+    records = []
+    last_step_is_open_app = False
+    for iteration in range(len(data) - 1):
+        record = data[iteration]
+        if record["tag"] == data[iteration+1]["tag"]:
+            continue
+        if record["Action"] == 'open_app':
+            # if the action is open_app, it means one sequence of interactions is starting, we do not include the open_app state, so we skip it
+            last_step_is_open_app = True
+            continue
+        records.append((iteration, last_step_is_open_app))
+        last_step_is_open_app = False
+    return records
+
+def prepare_record(data, iteration, annotation_states_path, output_file_name, include_image=True):
+    '''
+    @return: the inputs of the prompt of a record that do not depend on the previous answers
+    '''
+    record = data[iteration]
+    next_state = data[iteration+1]
+
+    # prettified_state = prettify_state(record["State"])
+    try: 
+        action_notation = get_action_notation(record["ActionDetails"], record["State"], record["Choice"], record["Input"])
+    except:
+        print(f"Error in getting action notation for iteration {iteration} {output_file_name}")
+        action_notation = None
+
+    if include_image:
+        state_image = get_state_image(annotation_states_path, record["tag"])
+        next_state_image = get_state_image(annotation_states_path, next_state["tag"])
+    else: 
+        state_image = None
+        next_state_image = None
+    return {"action_notation": action_notation, "state_image": state_image, "next_state_image": next_state_image}
+
+def describe(annotation_log_path, annotation_states_path, output_file_name, model="gpt-4o", prompt_answer_path='temp/prompt_answers.json', include_image=True, max_workers=DEFAULT_MAX_WORKERS):
     existing_data,existing_states = get_existing_result(output_file_name)
     if existing_data is not None:
         return existing_data,existing_states
@@ -259,71 +307,44 @@ def describe(annotation_log_path, annotation_states_path, output_file_name, mode
     described_data = {}
     prompt_history = {"prompts":[],"answers":[]}
     step_history = {}
-    last_step_is_open_app = False
 
     ui_descriptions = {}
     action_descriptions = {}
     tag_state = {}
-    iteration = 0
+    # the action notation of the previous record is reused when it cannot be obtained
+    last_action_notation = {}
 
-    intermediate_path = f"{output_file_name}_intermediate.pkl"
-    prompt_answers = {}
-    
     prompt_answers_dir = os.path.dirname(prompt_answer_path)
     if prompt_answers_dir:  # Ensure there's a directory component
         os.makedirs(prompt_answers_dir, exist_ok=True)
+    prompt_answers = PromptAnswers(prompt_answer_path)
 
     # This is added in case the API fails
-    if os.path.exists(intermediate_path):
-        with open(intermediate_path, 'rb') as file:
-            doc_intermediate = pickle.load(file)
-            iteration = doc_intermediate["iteration"]
-            described_data = doc_intermediate["doc"]
-            ui_descriptions = doc_intermediate["uis"]
-            action_descriptions = doc_intermediate["actions"]
-            tag_state = doc_intermediate["tags"]
-            prompt_history = doc_intermediate["prompt_history"]
-            step_history = doc_intermediate["step_history"]
-            last_step_is_open_app = doc_intermediate["last_step_is_open_app"]
-
-    while iteration < len(data) - 1:
+    checkpoints = RecordCheckpoints(output_file_name)
+
+    records = get_records_to_describe(data)
+    last_step_is_open_app = dict(records)
+
+    def describe_record(iteration, inputs):
         record = data[iteration]
         next_state = data[iteration+1]
         tag = record["tag"]
         next_tag = next_state["tag"]
-        if tag == next_tag:
-            iteration+=1
-            continue
-        
-        if record["Action"] == 'open_app':
-            # if the action is open_app, it means one sequence of interactions is starting, we do not include the open_app state, so we skip it
-            # step_history = []
-            last_step_is_open_app = True
-            iteration+=1
-            continue
-
         choice = record["Choice"]
         input = record["Input"]
         action_details = record["ActionDetails"]
-
-        # prettified_state = prettify_state(record["State"])
         prettified_state = record["State"]
-        try: 
-            full_action, action_type, action_element, element_type = get_action_notation(action_details,prettified_state,choice,input)
-        except:
-            print(f"Error in getting action notation for iteration {iteration} {output_file_name}")
+
+        if inputs["action_notation"] is not None:
+            last_action_notation["value"] = inputs["action_notation"]
+        full_action, action_type, action_element, element_type = last_action_notation["value"]
 
         current_ui = {
             "xml": str(prettified_state),
             "image": "The First attached image"
         }
-        
-        if include_image:
-            state_image = get_state_image(annotation_states_path,tag)
-            next_state_image = get_state_image(annotation_states_path,next_tag)
-        else: 
-            state_image = None
-            next_state_image = None
+        state_image = inputs["state_image"]
+        next_state_image = inputs["next_state_image"]
 
         # next_state_elements = prettify_state(next_state["State"])
         next_state_elements = next_state["State"]
@@ -364,55 +385,68 @@ def describe(annotation_log_path, annotation_states_path, output_file_name, mode
             action_descriptions, 
             step_history, 
             {"state":current_ui,"interaction":interaction}, 
-            last_step_is_open_app=last_step_is_open_app, 
+            last_step_is_open_app=last_step_is_open_app[iteration], 
         )
-        last_step_is_open_app = False
 
         prompt.insert(0,{
                 "type": "text",
                 "text": prompt_text,
             })
         
-        prompt_answers[iteration] = {
-            "prompt": prompt_text,
-            "tag": tag, 
-            "answer": ""}
-        dump_json_file(prompt_answer_path, prompt_answers)
-
-        retry = 0
-        result = None
-        while not result and retry < MAX_RETRY:
-            try:
-                print(f"##################          Executing Prompt {iteration}:          ##################")
-                # print(prompt_text)
-                print(f"Current State Image: {tag if state_image is not None else 'Not found!'}")
-                print(f"Next State Image: {next_tag if next_state_image is not None else 'Not found!'}")
-
-                if not include_image:
-                    prompt = prompt_text
+        checkpoint = checkpoints.load(iteration)
+        # a checkpoint without a valid answer (saved by an earlier version when all the attempts failed) is asked again
+        if checkpoint is not None and is_valid_description(checkpoint["result"]):
+            result = checkpoint["result"]
+            prompt_answers.update(iteration, checkpoint["prompt_answers"])
+        else:
+            prompt_answers.update(iteration, {
+                "prompt": prompt_text,
+                "tag": tag, 
+                "answer": ""})
+
+            retry = 0
+            result = None
+            while not result and retry < MAX_RETRY:
+                try:
+                    print(f"##################          Executing Prompt {iteration}:          ##################")
+                    # print(prompt_text)
+                    print(f"Current State Image: {tag if state_image is not None else 'Not found!'}")
+                    print(f"Next State Image: {next_tag if next_state_image is not None else 'Not found!'}")
+
+                    if not include_image:
+                        prompt = prompt_text
+                        
+                    # a retry asks the model again, instead of replaying the cached answer rejected before
+                    res = debug_query_gptv2(prompt, model, refresh=retry > 0)
+                    prompt_answers.update(iteration, {"answer": res})
+                    res =  res.replace("```json", "").replace("```", "")
                     
-                res = debug_query_gptv2(prompt, model)   
-                prompt_answers[iteration]["answer"] = res
-                dump_json_file(prompt_answer_path, prompt_answers)
-                res =  res.replace("```json", "").replace("```", "")
-                
-                print(f"##################          Prompt Result: Iteration {iteration}:          ##################")
-                print(res)
+                    print(f"##################          Prompt Result: Iteration {iteration}:          ##################")
+                    print(res)
 
-                result = convert_gpt_answer_to_json(res, model, default_value={"default": "format wrong"})
-            
-            except json.JSONDecodeError as e:
-                print(f"JSON decoding error: {e}")
-                print("Retrying...")
-                result = None
-            except Timeout as e:
-                print(f"API call timed out: {e}")
-                print("Retrying...")
-                result = None
-            except requests.RequestException as e:
-                print(f"API request error: {e}")
-                print("Retrying...")
-                result = None
+                    result = convert_gpt_answer_to_json(res, model, default_value={"default": "format wrong"}, refresh=retry > 0)
+                    if not is_valid_description(result):
+                        print("The answer does not describe the interaction, retrying...")
+                        result = None
+                
+                except json.JSONDecodeError as e:
+                    print(f"JSON decoding error: {e}")
+                    print("Retrying...")
+                    result = None
+                except Timeout as e:
+                    print(f"API call timed out: {e}")
+                    print("Retrying...")
+                    result = None
+                except requests.RequestException as e:
+                    print(f"API request error: {e}")
+                    print("Retrying...")
+                    result = None
+                retry += 1
+
+            if result is None:
+                raise ValueError(f"No valid description of record {iteration} after {MAX_RETRY} attempts")
+            # only a valid answer is saved, so that a rerun asks again for the records that failed
+            checkpoints.save(iteration, {"result": result, "prompt_answers": prompt_answers.get(iteration)})
 
         result["interaction_effect"]["current_screen"] = result["current_screen"]["api_name"]
         result["interaction_effect"]["next_screen"] = result["interaction_screen"]["api_name"]
@@ -437,19 +471,15 @@ def describe(annotation_log_path, annotation_states_path, output_file_name, mode
         add_screen_to_final_data(described_data, result["current_screen"], result["interaction_effect"])
 
         tag_state[tag] = prettified_state  # .body.decode_contents()
-        
-        iteration += 1
-        with open(intermediate_path, 'wb') as file:
-                pickle.dump({
-                    "doc":described_data,
-                    "uis":ui_descriptions, 
-                    "actions":action_descriptions,
-                    "tags":tag_state, 
-                    "prompt_history":prompt_history, 
-                    "iteration":iteration, 
-                    "step_history":step_history, 
-                    "last_step_is_open_app":last_step_is_open_app
-                }, file)
+
+    # every prompt holds the answers to all the previous records, only the preparation of the next record runs
+    # concurrently with a query
+    run_chains(
+        [[iteration for iteration, _ in records]], 
+        lambda iteration: prepare_record(data, iteration, annotation_states_path, output_file_name, include_image), 
+        describe_record, 
+        max_workers=max_workers,
+    )
     
     tag_state[data[-1]['tag']] = data[-1]['State']  # get the last tag-state because it does not appear in the former loop
     described_data = prepare_data_legal_for_json(described_data)
@@ -461,4 +491,4 @@ def describe(annotation_log_path, annotation_states_path, output_file_name, mode
         for i, (q, a) in enumerate(zip(prompt_history["prompts"], prompt_history["answers"])):
             f.write(json.dumps({"group_id": i, "prompt": q, "answer": a}) + "\n")
             
-    return described_data, tag_state
\ No newline at end of file
+    return described_data, tag_state
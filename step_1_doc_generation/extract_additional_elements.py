@@ -1,9 +1,9 @@
 import copy
 import json
 import os
-import pickle
 import re
 from bs4 import BeautifulSoup
+from lxml import etree
 from requests import Timeout
 import requests
 from extract_prompts import long_screen
@@ -12,6 +12,7 @@ from extract_prompts import normal_length_after
 from extract_prompts import normal_length_first
 from utils import get_action_desc
 from tools import load_yaml_file, dump_json_file,debug_query_gptv2, load_json_file, convert_gpt_answer_to_json, write_jsonl_file, safe_get_value
+from task_graph import DEFAULT_MAX_WORKERS, PromptAnswers, RecordCheckpoints, run_chains
 import base64
 MAX_RETRY = 3
 
@@ -147,22 +148,58 @@ def _extract_element_without_children(html, attrs):
         return element_without_children.prettify()
     return None
 
-def _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, prompt_answer_path, answer_key="first answer", include_image=True, prompt_text=None):
+def _is_valid_element_names(result):
+    return isinstance(result, list) and all(
+        isinstance(element, dict) and all(key in element for key in ["name", "id", "type"])
+        for element in result)
+
+def _is_valid_element_descriptions(result):
+    return isinstance(result, dict) and isinstance(result.get("elements"), dict) \
+        and isinstance(result.get("user_interaction"), dict) and "name" in result["user_interaction"]
+
+def _is_valid_elements(result, first_time=True):
+    '''
+    @param first_time: whether the answer lists all the elements of the screen, or the new and former elements of a
+    screen extracted before
+    '''
+    if not isinstance(result, dict) or not isinstance(result.get("user_interaction"), dict) \
+            or "name" not in result["user_interaction"]:
+        return False
+    if first_time:
+        return isinstance(result.get("elements"), list)
+    return isinstance(result.get("New UI Elements"), list) and isinstance(result.get("Former UI Elements"), dict)
+
+def _is_valid_answers(answers, first_time=True):
+    '''
+    @return: whether the answers to the prompts of a record have the fields read from them
+    '''
+    if "ele_names" in answers:
+        return _is_valid_element_names(answers["ele_names"]) and _is_valid_element_descriptions(answers["ele_descs"])
+    return _is_valid_elements(answers["result"], first_time)
+
+def _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, answer_key="first answer", include_image=True, prompt_text=None, is_valid=None, refresh=False):
+    '''
+    @param is_valid: is_valid(result) tells whether the answer has the expected fields, the answer is rejected otherwise
+    @param refresh: ask the model again instead of replaying the cached answer, when retrying after a rejected answer
+    @return: the answer converted to json, or None if it failed or was rejected
+    '''
     try:
         print(f"##################          Executing Prompt {iteration}:          ##################")
         # print(prompt_text)
         print(f"Current State Image: {tag if state_image is not None else 'Not found!'}")
         if not include_image:
             prompt = prompt_text
-        res = debug_query_gptv2(prompt, model)   
-        prompt_answers[iteration][answer_key] = res
-        dump_json_file(prompt_answer_path, prompt_answers)
+        res = debug_query_gptv2(prompt, model, refresh=refresh)
+        prompt_answers.update(iteration, {answer_key: res})
         res =  res.replace("```json", "").replace("```", "")
         
         print(f"##################          Prompt Result: Iteration {iteration}:          ##################")
         print(res)
         # result = json.loads(res)
-        result = convert_gpt_answer_to_json(res, model, default_value={"default": "format wrong"})
+        result = convert_gpt_answer_to_json(res, model, default_value={"default": "format wrong"}, refresh=refresh)
+        if is_valid is not None and not is_valid(result):
+            print("The answer misses the expected fields, retrying...")
+            return None
         return result
     
     except json.JSONDecodeError as e:
@@ -179,8 +216,67 @@ def _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, pr
         return None
     
 
+def simplify_xml(xml_text):
+    # Parse the input XML
+    action_elements = [ "input", "button", "scrollbar", "checkbox"]
+    root = etree.fromstring(xml_text)
+
+    def clean_element(element):
+        # Recursively clean child elements first
+        for child in list(element):
+            clean_element(child)
+
+        # Remove empty elements and redundant layers
+        if (not element.text or len(element) == 0) and (element.tag not in action_elements):
+            element.getparent().remove(element)
+        elif len(element) == 1 and (element.tag not in action_elements):
+            child = element[0]
+            element.clear()
+            element.tag = child.tag
+            element.attrib.update(child.attrib)
+            element.text = child.text
+            element.extend(child)
+
+    clean_element(root)
+
+    # Convert back to string
+    return etree.tostring(root, pretty_print=True).decode()
+
+def get_screen_records(data, tag_screen, temp_dir='temp'):
+    '''
+    @return: {screen_name: [iterations of the records of the screen, in order]}, in the order of the first record of each screen
+    '''
+    screen_records = {}
+    for iteration in range(len(data) - 1):
+        record = data[iteration]
+        tag = record["tag"]
+        if tag == data[iteration+1]["tag"]:
+            continue
+        if record["Action"] == 'open_app':
+            # if the action is open_app, it means one sequence of interactions is starting, we do not include the open_app state, so we skip it
+            continue
+        if tag not in tag_screen.keys():
+            os.makedirs(f'{temp_dir}/logs', exist_ok=True)
+            write_jsonl_file(f'{temp_dir}/logs/missing_tag_screen.jsonl', tag)
+            continue
+        screen_records.setdefault(tag_screen[tag]["screen_name"], []).append(iteration)
+    return screen_records
+
+def prepare_record(data, iteration, annotation_states_path, include_image=True):
+    '''
+    @return: the inputs of the prompts of a record that do not depend on the previous answers
+    '''
+    record = data[iteration]
+    prettified_state = simplify_xml(record["State"])
+    full_action = get_action_notation(record["ActionDetails"], prettified_state, record["Choice"], record["Input"])
 
-def extract_additional_elements(annotation_log_path, annotation_states_path, descriptions_file_path, output_file_name, model="gpt-4o", prompt_answer_path='temp/prompt_answers.json', include_image=True):
+    if include_image:
+        state_image = get_state_image(annotation_states_path, record["tag"])
+    else:
+        state_image = None
+    return {"prettified_state": prettified_state, "full_action": full_action, "state_image": state_image, "max_id": _find_max_id(prettified_state)}
+
+def extract_additional_elements(annotation_log_path, annotation_states_path, descriptions_file_path, output_file_name, model="gpt-4o", prompt_answer_path='temp/prompt_answers.json', include_image=True, max_workers=DEFAULT_MAX_WORKERS, temp_dir='temp'):
     # get screen_name, screen_description for each tag
     descriptions_data = load_json_file(descriptions_file_path)
     tag_screen = get_tag_screen(descriptions_data)
@@ -193,78 +289,28 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
     data = load_yaml_file(annotation_log_path)["records"]
     screen_name_elements = {}  # screen_name: [elements]
     tag_elements = {}  # tag: {'elements': [elements], 'user_interaction': {element, name, description, effect}}
+    record_tag_elements = {}  # iteration: the tag_elements of the record
 
-    intermediate_path = f"{output_file_name}_intermediate.pkl"
-    prompt_answers = {}
-
-    iteration = 0
+    prompt_answers = PromptAnswers(prompt_answer_path)
 
     # This is added in case the API fails
-    if os.path.exists(intermediate_path):
-        with open(intermediate_path, 'rb') as file:
-            doc_intermediate = pickle.load(file)
-            iteration = doc_intermediate["iteration"]
-            screen_name_elements = doc_intermediate["screen_name_elements"]
-            tag_elements = doc_intermediate["tag_elements"]
-
-    while iteration < len(data) - 1:
-        record = data[iteration]
-        next_state = data[iteration+1]
-        tag = record["tag"]
-        next_tag = next_state["tag"]
-        if tag == next_tag:
-            iteration+=1
-            continue
-        
-        if record["Action"] == 'open_app':
-            # if the action is open_app, it means one sequence of interactions is starting, we do not include the open_app state, so we skip it
-            iteration+=1
-            continue
-        choice = record["Choice"]
-        input = record["Input"]
-        action_details = record["ActionDetails"]
-        from lxml import etree
-
-        def simplify_xml(xml_text):
-            # Parse the input XML
-            action_elements = [ "input", "button", "scrollbar", "checkbox"]
-            root = etree.fromstring(xml_text)
-
-            def clean_element(element):
-                # Recursively clean child elements first
-                for child in list(element):
-                    clean_element(child)
-
-                # Remove empty elements and redundant layers
-                if (not element.text or len(element) == 0) and (element.tag not in action_elements):
-                    element.getparent().remove(element)
-                elif len(element) == 1 and (element.tag not in action_elements):
-                    child = element[0]
-                    element.clear()
-                    element.tag = child.tag
-                    element.attrib.update(child.attrib)
-                    element.text = child.text
-                    element.extend(child)
-
-            clean_element(root)
-
-            # Convert back to string
-            return etree.tostring(root, pretty_print=True).decode()
-        
-        prettified_state = simplify_xml(record["State"])
-
-        full_action = get_action_notation(action_details,prettified_state,choice,input)
+    checkpoints = RecordCheckpoints(output_file_name)
+
+    def query_record(iteration, inputs):
+        '''
+        @return: the answers to the prompts of the record
+        '''
+        tag = data[iteration]["tag"]
+        next_tag = data[iteration+1]["tag"]
+        prettified_state = inputs["prettified_state"]
+        full_action = inputs["full_action"]
+        state_image = inputs["state_image"]
 
         current_ui = {
             "xml": str(prettified_state),
             "image": "The First attached image"
         }
 
-        if include_image:
-            state_image = get_state_image(annotation_states_path,tag)
-        else:
-            state_image = None
-
         prompt = []
 
         if state_image is not None:
@@ -277,10 +323,6 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
         else: 
             current_ui["image"] = "No image available."
         
-        if tag not in tag_screen.keys():
-            dump_jsonl_file('temp/logs/missing_tag_screen.jsonl', tag)
-            iteration += 1
-            continue
         current_screen_name = tag_screen[tag]["screen_name"]
         current_screen_description = tag_screen[tag]["screen_description"]
         if next_tag in tag_screen.keys():
@@ -290,7 +332,7 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
             next_screen_description = None
             next_screen_name = None
 
-        max_id = _find_max_id(prettified_state)
+        max_id = inputs["max_id"]
 
         if max_id > 90 and tag_screen[tag]['screen_name'] not in screen_name_elements.keys(): # if the UI contains too many elements, we should divide the extraction prompt into two parts to shorten answer length, firstly ask all elements, second ask elements' descriptions
 
@@ -302,18 +344,17 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
                 next_screen_description,
             )
             # print(prompt_text)
-            prompt_answers[iteration] = {"first prompt": prompt_text, "tag": tag, "first answer": ""}
-            dump_json_file(prompt_answer_path, prompt_answers)
+            prompt_answers.update(iteration, {"first prompt": prompt_text, "tag": tag, "first answer": ""})
 
             prompt.insert(0,{
                     "type": "text",
                     "text": prompt_text,
             })
-            ele_names = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, prompt_answer_path, answer_key="first answer", prompt_text=prompt_text, include_image=include_image)
+            ele_names = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, answer_key="first answer", prompt_text=prompt_text, include_image=include_image, is_valid=_is_valid_element_names)
             
             retry_times = 0
             while ele_names is None and retry_times < MAX_RETRY:
-                ele_names = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, prompt_answer_path, answer_key="first answer", prompt_text=prompt_text, include_image=include_image)
+                ele_names = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, answer_key="first answer", prompt_text=prompt_text, include_image=include_image, is_valid=_is_valid_element_names, refresh=True)
                 retry_times += 1
 
             second_prompt_text = long_screen_descriptions.query_long_screen_descriptions(
@@ -325,8 +366,7 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
                 ele_names, 
                 next_screen_name
             )
-            prompt_answers[iteration]["second prompt"] = second_prompt_text
-            dump_json_file(prompt_answer_path, prompt_answers)
+            prompt_answers.update(iteration, {"second prompt": second_prompt_text})
             prompt = [
                 {
                     "type": "text",
@@ -340,13 +380,75 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
                         "url": f"data:image/jpeg;base64,{state_image}",
                     }
                 })
-            ele_descs = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, prompt_answer_path, answer_key="second answer", include_image=include_image, prompt_text=second_prompt_text)
+            ele_descs = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, answer_key="second answer", include_image=include_image, prompt_text=second_prompt_text, is_valid=_is_valid_element_descriptions)
 
             retry_times = 0
             while ele_descs is None and retry_times < MAX_RETRY:
-                ele_descs = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, prompt_answer_path, answer_key="second answer", include_image=include_image, prompt_text=second_prompt_text)
+                ele_descs = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, answer_key="second answer", include_image=include_image, prompt_text=second_prompt_text, is_valid=_is_valid_element_descriptions, refresh=True)
                 retry_times += 1
-                
+            return {"ele_names": ele_names, "ele_descs": ele_descs}
+
+        first_time = tag_screen[tag]['screen_name'] not in screen_name_elements.keys()
+        if first_time:
+            prompt_text = normal_length_first.query_a_screen_first_time(
+                current_screen_name,
+                current_screen_description,
+                prettified_state, 
+                full_action, 
+                next_screen_description, 
+                next_screen_name
+            )
+        else:
+            prompt_text = normal_length_after.query_a_screen_second_and_more_times(
+                current_screen_name,
+                current_screen_description,
+                prettified_state, 
+                full_action, 
+                next_screen_description,
+                screen_name_elements[tag_screen[tag]['screen_name']], 
+                next_screen_name
+            )
+
+        prompt.insert(0,{
+                "type": "text",
+                "text": prompt_text,
+            })
+        
+        prompt_answers.update(iteration, {
+            "prompt": prompt_text,
+            "tag": tag, 
+            "answer": ""})
+        
+        is_valid = lambda result: _is_valid_elements(result, first_time=first_time)
+        result = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, answer_key="answer", include_image=include_image, prompt_text=prompt_text, is_valid=is_valid)
+        retry_times = 0
+        while result is None and retry_times < MAX_RETRY:
+            result = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, answer_key="answer", include_image=include_image, prompt_text=prompt_text, is_valid=is_valid, refresh=True)
+            retry_times += 1
+        return {"result": result}
+
+    def extract_record(iteration, inputs):
+        # the records of a screen are extracted in order, the records of other screens concurrently
+        tag = data[iteration]["tag"]
+        current_screen_name = tag_screen[tag]["screen_name"]
+        prettified_state = inputs["prettified_state"]
+
+        first_time = current_screen_name not in screen_name_elements.keys()
+        checkpoint = checkpoints.load(iteration)
+        # a checkpoint without valid answers (saved by an earlier version when all the attempts failed) is asked again
+        if checkpoint is not None and _is_valid_answers(checkpoint["answers"], first_time):
+            answers = checkpoint["answers"]
+            prompt_answers.update(iteration, checkpoint["prompt_answers"])
+        else:
+            answers = query_record(iteration, inputs)
+            if not _is_valid_answers(answers, first_time):
+                raise ValueError(f"No valid answer to the prompts of record {iteration} after {MAX_RETRY} retries")
+            # only valid answers are saved, so that a rerun asks again for the records that failed
+            checkpoints.save(iteration, {"answers": answers, "prompt_answers": prompt_answers.get(iteration)})
+
+        if "ele_names" in answers:
+            ele_names = answers["ele_names"]
+            ele_descs = answers["ele_descs"]
             elements_attributes = []
             for ele_i in range(len(ele_names)):
                 ele_api_name = ele_names[ele_i]['name']
@@ -354,7 +456,8 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
                     # "element": _extract_ele_from_id(ele_names[ele_i]['id'], str(prettified_state)),
                     "element": _extract_element_without_children(str(prettified_state), {"id": ele_names[ele_i]['id']}),
                     "type": ele_names[ele_i]["type"],
-                    "options": ele_names[ele_i]["options"],
+                    # left out of the answer for the elements that are not element lists
+                    "options": ele_names[ele_i].get("options"),
                     "name": ele_api_name,
                 }
                 if ele_api_name in ele_descs['elements'].keys():
@@ -366,46 +469,8 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
                 'user_interaction': ele_descs['user_interaction']
             }
             user_interaction = ele_descs['user_interaction']
-
         else:
-
-            if tag_screen[tag]['screen_name'] not in screen_name_elements.keys():
-                prompt_text = normal_length_first.query_a_screen_first_time(
-                    current_screen_name,
-                    current_screen_description,
-                    prettified_state, 
-                    full_action, 
-                    next_screen_description, 
-                    next_screen_name
-                )
-            else:
-                prompt_text = normal_length_after.query_a_screen_second_and_more_times(
-                    current_screen_name,
-                    current_screen_description,
-                    prettified_state, 
-                    full_action, 
-                    next_screen_description,
-                    screen_name_elements[tag_screen[tag]['screen_name']], 
-                    next_screen_name
-                )
-
-            prompt.insert(0,{
-                    "type": "text",
-                    "text": prompt_text,
-                })
-            
-            prompt_answers[iteration] = {
-                "prompt": prompt_text,
-                "tag": tag, 
-                "answer": ""}
-            dump_json_file(prompt_answer_path, prompt_answers)
-            
-            result = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, prompt_answer_path, answer_key="answer", include_image=include_image, prompt_text=prompt_text)
-            retry_times = 0
-            while result is None and retry_times < MAX_RETRY:
-                result = _query_prompt(iteration, tag, state_image, prompt, model, prompt_answers, prompt_answer_path, answer_key="answer", include_image=include_image, prompt_text=prompt_text)
-                retry_times += 1
-
+            result = answers["result"]
             user_interaction = result['user_interaction']
 
         
@@ -414,13 +479,13 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
             for ele_id, element_data in enumerate(result['elements']):
                 result['elements'][ele_id]['state_tag'] = tag
             screen_name_elements[current_screen_name] = result['elements']
-            tag_elements[tag] = {'elements': [element["name"] for element in result['elements']], 'user_interaction': user_interaction}
+            record_tag_elements[iteration] = {'elements': [element["name"] for element in result['elements']], 'user_interaction': user_interaction}
         else:
-            tag_elements[tag] = {'elements': [], 'user_interaction': user_interaction}
+            record_tag_elements[iteration] = {'elements': [], 'user_interaction': user_interaction}
             new_elements = result['New UI Elements']
             old_elements = result['Former UI Elements']
             for new_element in new_elements:
-                tag_elements[tag]['elements'].append(new_element['name'])
+                record_tag_elements[iteration]['elements'].append(new_element['name'])
                 for element in screen_name_elements[current_screen_name]:
                     if element['name'] == new_element['name']:
                         print(f"Element {new_element['name']} already exists in the list.")
@@ -431,8 +496,8 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
                     screen_name_elements[current_screen_name][-1]['state_tag'] = tag
 
             for old_element_api_name in old_elements.keys():
-                if old_element_api_name not in tag_elements[tag]['elements']:
-                    tag_elements[tag]['elements'].append(old_element_api_name)
+                if old_element_api_name not in record_tag_elements[iteration]['elements']:
+                    record_tag_elements[iteration]['elements'].append(old_element_api_name)
 
         interacted_element_name = user_interaction['name']
 
@@ -443,16 +508,18 @@ def extract_additional_elements(annotation_log_path, annotation_states_path, des
         else:
             print(f"Element {interacted_element_name} not found in the list.")
 
-
-        iteration += 1
-        if not os.path.exists(output_file_name.rsplit('/', 1)[0]):
-            os.makedirs(output_file_name.rsplit('/', 1)[0], exist_ok=True)
-        with open(intermediate_path, 'wb') as file:
-                pickle.dump({
-                    'screen_name_elements': screen_name_elements,
-                    'tag_elements': tag_elements, 
-                    'iteration': iteration
-                }, file)
+    screen_records = get_screen_records(data, tag_screen, temp_dir)
+    run_chains(
+        list(screen_records.values()), 
+        lambda iteration: prepare_record(data, iteration, annotation_states_path, include_image), 
+        extract_record, 
+        max_workers=max_workers,
+    )
+
+    # in the order of the records, as if they were extracted one by one
+    screen_name_elements = {screen_name: screen_name_elements[screen_name] for screen_name in screen_records}
+    for iteration in sorted(record_tag_elements):
+        tag_elements[data[iteration]["tag"]] = record_tag_elements[iteration]
     # import pdb;pdb.set_trace()
     dump_json_file(f"{output_file_name}_screen_elements.json", screen_name_elements)
     dump_json_file(f"{output_file_name}_tag_elements.json", tag_elements)
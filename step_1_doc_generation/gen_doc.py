@@ -1,11 +1,15 @@
 import argparse
 import os
+import json
+import time
+import tempfile
 import tools as tools
-from .describe_interactions import describe
-from .build_xpath import ScreenSkeletonBuilder, XPathBuilder
-from .build_dependency import DependencyGraph
-from .post_process_doc import post_process
-from .extract_additional_elements import extract_additional_elements
+from describe_interactions import describe
+from build_xpath import ScreenSkeletonBuilder, XPathBuilder
+from build_dependency import DependencyGraph
+from post_process_doc import post_process
+from extract_additional_elements import extract_additional_elements
+from task_graph import DEFAULT_MAX_WORKERS
 from pathlib import Path
 import copy
 import logging
@@ -25,12 +29,14 @@ def parse_args():
     parser.add_argument('-d', '--annotation_dir', default='data/llama_touch/explore_data/settings', help='Path to annotation directory')
     parser.add_argument('-a', '--app_name', default="Discord")
     parser.add_argument('-i', '--include_image', action='store_true', default=True, help='Include images in the output')
+    parser.add_argument('-w', '--max_workers', type=int, default=DEFAULT_MAX_WORKERS, help='Number of records described and extracted at once')
+    parser.add_argument('--temp_dir', default='temp', help='Directory of the intermediate prompts')
 
     args = parser.parse_args()
 
     return args
 
-def split_mismatched_screen(app_name, screen_data, tag_state, temperature):
+def split_mismatched_screen(app_name, screen_data, tag_state, temperature, temp_dir='temp'):
     prefix = f"You are an app tester and you are testing a {app_name} app on a smartphone. You currently collect a series of UIs, the name of which are {screen_data['api_name']}. However, the layout of these UIs are not similar, therefore, they are not the same type of UIs. The UIs (described in HTML) are as follows:\n\n"
     id_to_tag_mapping = {}
     all_states_desc = ''
@@ -58,7 +64,7 @@ You should note that:
   - Note that all your 'uis' should include all the UIs from UI0 to UI{len(screen_data['tags'])-1} in the output.
 """
     prompt = prefix + all_states_desc + instruction
-    tools.write_txt_file('temp/prompts/split_screen_prompt.txt', prompt)
+    tools.write_txt_file(f'{temp_dir}/prompts/split_screen_prompt.txt', prompt)
     answer = tools.debug_query_gptv2(prompt, 'gpt-4o', temperature=temperature)
     print(answer)
     answer = tools.convert_gpt_answer_to_json(answer, 'gpt-4o')
@@ -136,7 +142,7 @@ def build_tag_uiname_lookup_table(step_history, raw_log):
         tag_uiname_lookup_table[record['tag']] = step_history[str(record_id)]['ui']
     return tag_uiname_lookup_table
 
-def describe_each_splitted_screen(app_name, screen_data, tag_state, raw_log, step_history, all_screen_data, old_api_names):
+def describe_each_splitted_screen(app_name, screen_data, tag_state, raw_log, step_history, all_screen_data, old_api_names, temp_dir='temp'):
     prefix = f"""You are an app tester and you are testing a {app_name} app on a smartphone. You currently collect a series of UIs, you should give an api name to these UIs for further reference. You should follow the following instructions: 
 ## Input: 
     * HTML description of the UIs needed to summarize into an api name. 
@@ -188,7 +194,7 @@ Note that:
 - Output **only** a valid JSON response in the form of the above mentioned document. Enclose every property name and value in double quotes. It must be a valid JSON response!
 """
     prompt = prefix + all_states_desc + instruction
-    tools.write_txt_file('temp/prompts/describe_split_screen_prompt.txt', prompt)
+    tools.write_txt_file(f'{temp_dir}/prompts/describe_split_screen_prompt.txt', prompt)
     answer = tools.debug_query_gptv2(prompt, 'gpt-4o')
     print(answer)
     answer = tools.convert_gpt_answer_to_json(answer, 'gpt-4o')
@@ -196,7 +202,7 @@ Note that:
     screen_data['description'] = answer['description']
     return screen_data
 
-def check_mismatched_uis(app_name, descriptions_output_file, annotation_log, screens, tag_state, output_path, timestamp):
+def check_mismatched_uis(app_name, descriptions_output_file, annotation_log, screens, tag_state, output_path, timestamp, temp_dir='temp'):
     if os.path.exists(f"{output_path}/descriptions_{timestamp}_after_split.json"):
         return
     skeleton_builder = ScreenSkeletonBuilder(f"{descriptions_output_file}.json", f"{descriptions_output_file}_states.json")
@@ -214,14 +220,14 @@ def check_mismatched_uis(app_name, descriptions_output_file, annotation_log, scr
 
             retry_times, randomness = 0, 0.3
             while not all_uis_matched and retry_times < MAX_RETRY:
-                new_screen_datas, all_uis_matched = split_mismatched_screen(app_name, screen_data, tag_state, temperature=randomness)
+                new_screen_datas, all_uis_matched = split_mismatched_screen(app_name, screen_data, tag_state, temperature=randomness, temp_dir=temp_dir)
                 retry_times += 1
                 randomness += 0.05
 
             forbidden_screen_names = [screen]
             logging.info(f"split screen {screen} into {new_screen_datas.keys()}")            
             for new_screen, new_screen_data in new_screen_datas.items():
-                new_screen_data = describe_each_splitted_screen(app_name, new_screen_data, tag_state, raw_log, step_history, screens, forbidden_screen_names)
+                new_screen_data = describe_each_splitted_screen(app_name, new_screen_data, tag_state, raw_log, step_history, screens, forbidden_screen_names, temp_dir=temp_dir)
                 if new_screen_data["api_name"] not in new_screens.keys():
                     new_screens[new_screen_data['api_name']] = new_screen_data
                 else:
@@ -235,6 +241,114 @@ def check_mismatched_uis(app_name, descriptions_output_file, annotation_log, scr
     # save the new screens to file
     tools.dump_json_file(f"{output_path}/descriptions_{timestamp}_after_split.json", new_screens)
 
+class DocGenerator:
+    '''
+    the stages of the generation of the document of an app, the completed stages are recorded in a manifest in the
+    output folder, so that a re-run continues from the first stage not completed
+    '''
+    STAGES = ['describe', 'split', 'extract', 'xpath', 'dependency', 'post_process']
+    MANIFEST_FILE = 'manifest.json'
+
+    def __init__(self, app_name, annotation_dir, output_path, timestamp, model="gpt-4o", include_image=True, max_workers=DEFAULT_MAX_WORKERS, temp_dir='temp'):
+        self.app_name = app_name
+        self.output_path = output_path
+        self.timestamp = timestamp
+        self.model = model
+        self.include_image = include_image
+        self.max_workers = max_workers
+        self.temp_dir = temp_dir
+
+        self.annotation_log = os.path.join(annotation_dir, f'log.yaml')
+        self.annotation_states = os.path.join(annotation_dir, 'states')
+
+        self.descriptions_output_file = os.path.join(output_path, f'descriptions_{timestamp}')
+        self.extractions_output_file = os.path.join(output_path, f'extraction')
+        self.doc_output_file = os.path.join(output_path, f'doc.json')
+        self.describe_prompts_answers_path = os.path.join(temp_dir, f'describe_prompts_answers_{timestamp}.json')
+        self.manifest_path = os.path.join(output_path, self.MANIFEST_FILE)
+
+    def describe(self):
+        '''screens: {
+           screen_api_name(title): 
+           {
+                api_name, 
+                description, 
+                tags: [a list of tag strings], 
+                interactions: [a list of dict: {'action', 'description', 'effect', 'api_name', 'current_screen', 'next_screen', 'element', 'element_type', 'input', 'action_type', 'state_tag'}]
+           }
+        }; 
+        tag_state: {state_tag: <state HTML description>}; '''
+        # screens, tag_state = describev2(annotation_log,annotation_states, descriptions_output_file, model, describe_prompts_answers_path)
+        describe(self.annotation_log, self.annotation_states, self.descriptions_output_file, self.model, self.describe_prompts_answers_path, include_image=self.include_image, max_workers=self.max_workers)
+
+    def split(self):
+        screens = tools.load_json_file(f"{self.descriptions_output_file}.json")
+        tag_state = tools.load_json_file(f"{self.descriptions_output_file}_states.json")
+        check_mismatched_uis(self.app_name, self.descriptions_output_file, self.annotation_log, screens, tag_state, self.output_path, self.timestamp, temp_dir=self.temp_dir)
+
+    def extract(self):
+        extract_additional_elements(
+            annotation_log_path=self.annotation_log, 
+            annotation_states_path=self.annotation_states,
+            descriptions_file_path=f'{self.descriptions_output_file}_after_split.json', 
+            output_file_name=self.extractions_output_file, 
+            prompt_answer_path=f'{self.extractions_output_file}_prompt_answer.json',
+            model='gpt-4o', 
+            include_image=self.include_image, 
+            max_workers=self.max_workers, 
+            temp_dir=self.temp_dir
+        )
+
+    def xpath(self):
+        # for droidtask dataset, we do not include image, and the description and text are used for xpath generation
+        use_desc_and_text = not self.include_image
+        xpath_builder = XPathBuilder(f'{self.descriptions_output_file}_after_split.json', f'{self.descriptions_output_file}_states.json', f"{self.extractions_output_file}_screen_elements.json", use_desc=use_desc_and_text, use_text=use_desc_and_text)
+        xpath_builder.save_xpath_and_skeleton_to_file(self.doc_output_file)
+
+    def dependency(self):
+        dep_graph = DependencyGraph(self.annotation_log, self.doc_output_file, f"{self.extractions_output_file}_tag_elements.json", f"{self.descriptions_output_file}_step_history.json")
+        dep_graph.show_graph(path=self.output_path)
+        dep_graph.get_all_elements_paths()
+
+    def post_process(self):
+        post_process(self.doc_output_file)
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            return tools.load_json_file(self.manifest_path)
+        return {"app_name": self.app_name, "stages": {}}
+
+    def _dump_manifest(self, manifest):
+        # the manifest is replaced as a whole, an interrupted run leaves the previous one
+        fd, tmp_path = tempfile.mkstemp(dir=self.output_path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+    def run(self, durations=None):
+        '''
+        @param durations: filled with the stages run so far, e.g. to report the stages before a failure
+        @return: {stage: seconds taken by the stage, None if the stage was completed by a former run}
+        '''
+        Path(self.output_path).mkdir(parents=True, exist_ok=True)
+        Path(self.temp_dir, 'prompts').mkdir(parents=True, exist_ok=True)
+        manifest = self.load_manifest()
+        durations = {} if durations is None else durations
+        rerun = False
+        for stage in self.STAGES:
+            # the stages after a stage that ran again use its new outputs
+            if not rerun and manifest["stages"].get(stage, {}).get("done"):
+                durations[stage] = None
+                continue
+            rerun = True
+            logging.info(f"{self.app_name}: {stage}")
+            start = time.time()
+            getattr(self, stage)()
+            durations[stage] = time.time() - start
+            manifest["stages"][stage] = {"done": True, "seconds": round(durations[stage], 3), "finished_at": time.strftime('%Y-%m-%d %H:%M:%S')}
+            self._dump_manifest(manifest)
+        return durations
+
 if __name__ == '__main__':
     
     # timestamp = "07100300"
@@ -243,54 +357,5 @@ if __name__ == '__main__':
     # annotation_dir = "output/broccoli"
     args = parse_args()
 
-    timestamp = args.timestamp
-    output_path = args.output_path
-    model = args.model
-    annotation_dir = args.annotation_dir
-
-    dir_path = Path(output_path)
-    dir_path.mkdir(parents=True, exist_ok=True)
-
-    annotation_log = os.path.join(annotation_dir, f'log.yaml')
-    annotation_states = os.path.join(annotation_dir, 'states')
-
-    descriptions_output_file = os.path.join(output_path, f'descriptions_{timestamp}')
-    extractions_output_file = os.path.join(output_path, f'extraction')
-    doc_output_file = os.path.join(output_path, f'doc.json')
-
-    describe_prompts_answers_path = f'doc_generation/temp/describe_prompts_answers_{timestamp}.json'
-
-    '''screens: {
-       screen_api_name(title): 
-       {
-            api_name, 
-            description, 
-            tags: [a list of tag strings], 
-            interactions: [a list of dict: {'action', 'description', 'effect', 'api_name', 'current_screen', 'next_screen', 'element', 'element_type', 'input', 'action_type', 'state_tag'}]
-       }
-    }; 
-    tag_state: {state_tag: <state HTML description>}; '''
-    # screens, tag_state = describev2(annotation_log,annotation_states, descriptions_output_file, model, describe_prompts_answers_path)
-    screens, tag_state = describe(annotation_log,annotation_states, descriptions_output_file, model, describe_prompts_answers_path, include_image=args.include_image)
-
-    check_mismatched_uis(args.app_name, descriptions_output_file, annotation_log, screens, tag_state, output_path, timestamp)
-    
-    extract_additional_elements(
-        annotation_log_path=annotation_log, 
-        annotation_states_path=annotation_states,
-        descriptions_file_path=f'{descriptions_output_file}_after_split.json', 
-        output_file_name=extractions_output_file, 
-        prompt_answer_path=f'{extractions_output_file}_prompt_answer.json',
-        model='gpt-4o', 
-        include_image=args.include_image
-    )
-    # for droidtask dataset, we do not include image, and the description and text are used for xpath generation
-    use_desc_and_text = not args.include_image
-    xpath_builder = XPathBuilder(f'{descriptions_output_file}_after_split.json', f'{descriptions_output_file}_states.json', f"{extractions_output_file}_screen_elements.json", use_desc=use_desc_and_text, use_text=use_desc_and_text)
-    xpath_builder.save_xpath_and_skeleton_to_file(doc_output_file)
-
-    dep_graph = DependencyGraph(annotation_log, doc_output_file, f"{extractions_output_file}_tag_elements.json", f"{descriptions_output_file}_step_history.json")
-    dep_graph.show_graph(path=output_path)
-    dep_graph.get_all_elements_paths()
-    
-    post_process(doc_output_file)
+    doc_generator = DocGenerator(args.app_name, args.annotation_dir, args.output_path, args.timestamp, args.model, include_image=args.include_image, max_workers=args.max_workers, temp_dir=args.temp_dir)
+    doc_generator.run()
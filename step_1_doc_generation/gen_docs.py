@@ -0,0 +1,119 @@
+"""
+Generation of the documents of several apps at once.
+
+Every app runs the stages of gen_doc.DocGenerator (describe -> split -> extract -> xpath -> dependency -> post_process)
+in a process of a bounded pool, with its own temp directory, and logs to <output_path>/gen_doc.log. The completed
+stages are recorded in <output_path>/manifest.json, so a re-run only runs the stages left, e.g. after a failure:
+
+    python gen_docs.py -t 0814 -p 4 \
+        --app "Clock" data/droidtask/explore_data/clock output/droidtask/clock_0814 \
+        --app "Notes" data/droidtask/explore_data/notes output/droidtask/notes_0814
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from gen_doc import DocGenerator
+from task_graph import DEFAULT_MAX_WORKERS
+
+DEFAULT_PROCESSES = 4
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate the documents of several apps.")
+    parser.add_argument('--app', nargs=3, action='append', required=True, metavar=('APP_NAME', 'ANNOTATION_DIR', 'OUTPUT_PATH'), help='App name, path to annotation directory and path to output directory of an app')
+    parser.add_argument('-m', '--model', default="gpt-4o", help='Model name')
+    parser.add_argument('-t', '--timestamp', default="1025", help='Timestamp, using to distinguish the file')
+    parser.add_argument('-i', '--include_image', action='store_true', default=True, help='Include images in the output')
+    parser.add_argument('-p', '--processes', type=int, default=DEFAULT_PROCESSES, help='Number of apps processed at once')
+    parser.add_argument('-w', '--max_workers', type=int, default=DEFAULT_MAX_WORKERS, help='Number of records of an app described and extracted at once')
+    parser.add_argument('--temp_dir', default='temp', help='Directory of the intermediate prompts, with a sub-directory per app')
+    return parser.parse_args()
+
+
+def gen_app_doc(app_name, annotation_dir, output_path, timestamp, model, include_image, max_workers, temp_dir):
+    '''
+    run in a process of the pool
+    @return: ({stage: seconds taken, None if completed by a former run}, the error or None)
+    '''
+    os.makedirs(output_path, exist_ok=True)
+    durations = {}
+    with open(os.path.join(output_path, 'gen_doc.log'), 'a') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=log, force=True)
+        try:
+            DocGenerator(app_name, annotation_dir, output_path, timestamp, model, include_image=include_image, max_workers=max_workers, temp_dir=temp_dir).run(durations)
+        except Exception as e:
+            traceback.print_exc()
+            return durations, f"{type(e).__name__}: {e}"
+    return durations, None
+
+
+def _format_duration(seconds):
+    return '-' if seconds is None else f'{seconds:.1f}s'
+
+
+def print_summary(results, wall_time):
+    '''
+    @param results: {app_name: (durations, error)}
+    '''
+    stages = DocGenerator.STAGES
+    name_width = max(len('app'), *(len(app_name) for app_name in results)) + 2
+    print(f"{'app':<{name_width}}" + ''.join(f'{stage:>14}' for stage in stages) + f"{'total':>10}")
+    totals = {stage: 0.0 for stage in stages}
+    for app_name, (durations, error) in results.items():
+        row = f'{app_name:<{name_width}}'
+        for stage in stages:
+            if stage in durations:
+                row += f'{_format_duration(durations[stage]):>14}'
+                totals[stage] += durations[stage] or 0.0
+            else:
+                row += f"{'failed' if error is not None and stage == stages[len(durations)] else '':>14}"
+        row += f'{_format_duration(sum(seconds or 0.0 for seconds in durations.values())):>10}'
+        print(row)
+    print(f"{'all apps':<{name_width}}" + ''.join(f'{_format_duration(totals[stage]):>14}' for stage in stages) + f"{_format_duration(wall_time):>10} (wall)")
+    print("('-': completed by a former run)")
+    for app_name, (_, error) in results.items():
+        if error is not None:
+            print(f'{app_name} failed: {error}')
+
+
+def main():
+    args = parse_args()
+    app_names = [app_name for app_name, _, _ in args.app]
+    output_paths = [os.path.normpath(output_path) for _, _, output_path in args.app]
+    if len(set(app_names)) != len(app_names) or len(set(output_paths)) != len(output_paths):
+        print('Error: the app names or the output paths are not unique.')
+        sys.exit(1)
+
+    start = time.time()
+    results = {}
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        futures = {}
+        for app_name, annotation_dir, output_path in args.app:
+            # the apps do not share the intermediate files
+            app_temp_dir = os.path.join(args.temp_dir, os.path.normpath(output_path).strip(os.sep).replace(os.sep, '_'))
+            future = pool.submit(gen_app_doc, app_name, annotation_dir, output_path, args.timestamp, args.model, args.include_image, args.max_workers, app_temp_dir)
+            futures[future] = (app_name, output_path)
+        for future in as_completed(futures):
+            app_name, output_path = futures[future]
+            try:
+                results[app_name] = future.result()
+            except Exception as e:
+                # e.g. the process was killed
+                results[app_name] = ({}, f"{type(e).__name__}: {e}")
+            status = 'done' if results[app_name][1] is None else f'failed, see {output_path}/gen_doc.log'
+            print(f'[{len(results)}/{len(futures)}] {app_name}: {status}')
+
+    print_summary({app_name: results[app_name] for app_name in app_names}, time.time() - start)
+    if any(error is not None for _, error in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
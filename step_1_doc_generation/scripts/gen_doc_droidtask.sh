@@ -55,12 +55,13 @@ if [ ${#RAW_LOG_PATHS[@]} -ne ${#APPNAMES[@]} ] || [ ${#RAW_LOG_PATHS[@]} -ne ${
     exit 1
 fi
 
+APPS=()
 for i in "${!RAW_LOG_PATHS[@]}"; do
-    python gen_doc.py -d "${RAW_LOG_PATHS[$i]}" \
-                        -m gpt-4o \
-                        -t 0814 \
-                        -a "${APPNAMES[$i]}" \
-                        -o "${OUTPUT_FILE_NAMES[$i]}" &
+    APPS+=(--app "${APPNAMES[$i]}" "${RAW_LOG_PATHS[$i]}" "${OUTPUT_FILE_NAMES[$i]}")
 done
 
-wait
+# PROCESSES apps at once, a re-run continues the apps from the stages not completed
+python gen_docs.py -m gpt-4o \
+                   -t 0814 \
+                   -p "${PROCESSES:-4}" \
+                   "${APPS[@]}"
@@ -0,0 +1,97 @@
+"""
+Dependency-aware execution of the per-record stages of the document generation (describe_interactions.describe and
+extract_additional_elements.extract_additional_elements).
+
+The records of log.yaml are split into chains, a record only depends on the records before it in its chain:
+describe has a single chain, as every prompt holds the answers to all the previous records, while
+extract_additional_elements has a chain per screen, as a prompt holds the elements extracted from the previous records
+of its screen. The chains run concurrently on a bounded pool, the records of a chain in order. The inputs of a record
+that do not depend on any answer (the parsed state, the action notation, the encoded screenshots) are prepared while
+the previous record of the chain is queried.
+
+The answers are checkpointed per record, under <output_file_name>_records/<iteration>.pkl, so an interrupted stage
+only queries the records left. The stages assemble their outputs in the order of the records, as they did serially.
+"""
+import os
+import pickle
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tools import dump_json_file
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class RecordCheckpoints:
+
+    def __init__(self, output_file_name):
+        self.dir_path = f"{output_file_name}_records"
+        os.makedirs(self.dir_path, exist_ok=True)
+
+    def _get_path(self, iteration):
+        return os.path.join(self.dir_path, f"{iteration}.pkl")
+
+    def load(self, iteration):
+        '''
+        @return: the checkpoint of the record, or None if the record was not answered yet
+        '''
+        path = self._get_path(iteration)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    def save(self, iteration, checkpoint):
+        # an interrupted write does not leave a broken checkpoint
+        fd, tmp_path = tempfile.mkstemp(dir=self.dir_path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(checkpoint, file)
+        os.replace(tmp_path, self._get_path(iteration))
+
+
+class PromptAnswers:
+    '''
+    the prompts and answers of the records, dumped to a json file in the order of the records
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def update(self, iteration, fields):
+        with self._lock:
+            self.entries.setdefault(iteration, {}).update(fields)
+            dump_json_file(self.path, dict(sorted(self.entries.items())))
+
+    def get(self, iteration):
+        with self._lock:
+            return dict(self.entries.get(iteration, {}))
+
+
+def run_chains(chains, prepare, step, max_workers=DEFAULT_MAX_WORKERS):
+    '''
+    @param chains: the chains of records, each a list of the iterations of its records in order
+    @param prepare: prepare(iteration) -> the inputs of the record that do not depend on the previous records
+    @param step: step(iteration, inputs), called for the records of a chain in order
+    @param max_workers: the chains processed at once
+    The chains continue when a record of another chain fails, the first error is raised once they are done.
+    '''
+    with ThreadPoolExecutor(max_workers, thread_name_prefix='prepare') as prepare_pool, \
+            ThreadPoolExecutor(max_workers, thread_name_prefix='chain') as chain_pool:
+
+        def run_chain(chain):
+            next_inputs = prepare_pool.submit(prepare, chain[0])
+            for idx, iteration in enumerate(chain):
+                inputs = next_inputs.result()
+                if idx + 1 < len(chain):
+                    next_inputs = prepare_pool.submit(prepare, chain[idx + 1])
+                step(iteration, inputs)
+
+        futures = [chain_pool.submit(run_chain, chain) for chain in chains if chain]
+        errors = [future.exception() for future in futures]
+
+    for error in errors:
+        if error is not None:
+            raise error
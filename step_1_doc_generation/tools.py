@@ -3,14 +3,14 @@ import random
 import time
 from openai import OpenAI
 import openai
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
-import torch
 import requests
 import json
 import yaml
 import ast
 from bs4 import BeautifulSoup, Tag, NavigableString
 import tiktoken
+from llm_cache import cached_query
+import model_server
 
 gpt_models = [
     "gpt-3.5-turbo", "gpt-3.5-turbo-16k", "gpt-4", "gpt-4-32k", "gpt-4o",
@@ -30,7 +30,7 @@ def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> i
 def query_model(model, prompt):
     try:
         if model in gpt_models:
-            answer = query_gpt(prompt, model_name=model)
+            answer = query_gpt(prompt, model=model)
         elif model in claude_models:
             answer = query_claude(prompt, model_name=model)
         elif model == "autodroidv2":
@@ -42,13 +42,10 @@ def query_model(model, prompt):
         raise e
     
 def query_autodroidv2(prompt: str):
-    model_path = "autodroidv2"
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float16, device_map="auto")
-    inputs = tokenizer(prompt, return_tensors="pt").to("cuda" if torch.cuda.is_available() else "cpu")
-    output = model.generate(**inputs, max_length=100, pad_token_id=tokenizer.eos_token_id)
-    return tokenizer.decode(output[0], skip_special_tokens=True)
+    # the weights are loaded once per process (or not at all if a model server is used)
+    return model_server.query_autodroidv2(prompt, model_path="autodroidv2", max_length=100)
 
+@cached_query
 def query_gpt(prompt, model="gpt-3.5-turbo"):
   '''
   @param model:
@@ -134,6 +131,7 @@ def dump_json_file(json_path, data):
     with open(json_path, 'w') as f:
         json.dump(data, f)
         
+@cached_query
 def debug_query_gptv2(prompt: str, model_name: str, temperature: float = 0.2, timeout: int = 120):
     client = OpenAI(
         base_url='https://tbnx.plus7.plus/v1',
@@ -355,7 +353,11 @@ def _convert_str_to_json(input_str):
        converted_answer = json.loads(input_str)
        return converted_answer
 
-def convert_gpt_answer_to_json(answer, model_name, default_value={'default': 'format wrong'}, query_func=debug_query_gptv2):
+def convert_gpt_answer_to_json(answer, model_name, default_value={'default': 'format wrong'}, query_func=debug_query_gptv2, refresh=False):
+    '''
+    @param refresh: ask the model to convert again instead of using the cached conversions,
+        e.g. when the caller rejected the result of a former call
+    '''
     import ast
     convert_prompt = f'''
 Convert the following data into JSON dict format. Return only the dict. Ensuring it's valid for Python parsing (pay attention to single/double quotes in the strings).
@@ -374,7 +376,7 @@ data:
 
     except:
         print('*'*10, 'converting', '*'*10, '\n', answer, '\n', '*'*50)
-        converted_answer = query_func(convert_prompt, model_name)
+        converted_answer = query_func(convert_prompt, model_name, refresh=refresh)
         print('*'*10, 'converted v1', '*'*10, '\n', converted_answer, '\n', '*'*10)
         if isinstance(converted_answer, str):
             try:
@@ -394,7 +396,7 @@ is wrong and can not be parsed in python. Please check it and convert it properl
 
 **Please do not output any content other than the JSON dict format!!!**
 '''
-                converted_answer = query_func(new_convert, model_name)
+                converted_answer = query_func(new_convert, model_name, refresh=refresh)
                 print('*'*10, 'converted v2', '*'*10, '\n', converted_answer, '\n', '*'*10)
                 if isinstance(converted_answer, str):
                     try:
@@ -479,6 +481,7 @@ def safe_get_value(dictionary, key, default=None):
     return default 
 
 
+@cached_query
 def query_claude(prompt: str,
             model_name="claude-3-haiku-20240307",
             retry_times=6):
@@ -506,6 +509,7 @@ def query_claude(prompt: str,
     print(f'Claude answer: {res}')
     return res
 
+@cached_query
 def query_llm(prompt: str, model_name="", retry_times=6):
     openai.base_url = os.environ.get('OPENAI_API_URL')
     openai.api_key = os.environ.get('OPENAI_API_KEY')
@@ -6,6 +6,7 @@ import re
 import traceback
 import tools as tools
 import agent.environment as environment
+from agent.droidbot import trace_log
 from agent.script_utils.ui_apis import CodeConfig, CodeStatus, Verifier, regenerate_script, _save2log
 from agent.script_utils.bug_processor import BugProcessorV3
 from agent.script_utils.solution_generator import SolutionGenerator
@@ -192,7 +193,7 @@ class CodeAgent():
       tools.dump_json_file(f'{self.save_path}/line_mappings.json', line_mappings)
       
       # in case some silly scripts include no UI actions at all, we make an empty log for batch_verifying
-      tools.dump_yaml_file(os.path.join(self.save_path, f'log.yaml'), {'records': [], 'step_num': 0})
+      trace_log.reset_trace(os.path.join(self.save_path, f'log.yaml'))
       
       env = self.env
       self.code_config.set(self.save_path, code, code_script, line_mappings)
@@ -221,6 +222,7 @@ class CodeAgent():
         error_path = os.path.join(self.save_path, f'error.json')
         tools.dump_json_file(error_path, error_info)
         err = e
+        trace_log.close_trace(self.code_config.log_file)
     
     result = {
       'is_completed': done,
@@ -253,6 +255,7 @@ class CodeAgent():
         currently_executing_code=None,
         comment='done',
         screenshot=None)
+    trace_log.close_trace(self.code_config.log_file)
     
     tools.dump_json_file(f'{self.save_path}/runtime.json', runtime)
     tools.dump_json_file(f'{self.save_path}/agent_actions_save_time.json', self.env.actions_taken)
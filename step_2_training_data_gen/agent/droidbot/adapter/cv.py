@@ -115,6 +115,39 @@ def find_views(img):
     return result_rectangles
 
 
+def get_views(img, width, height):
+    """
+    Get the views of droidbot from a UI screenshot
+    :param img: numpy.ndarray, representing an image in opencv
+    :param width: width of the screen
+    :param height: height of the screen
+    :return: a list of views, the root view and the views found by find_views()
+    """
+    view_bounds = find_views(img)
+    root_view = {
+        "class": "CVViewRoot",
+        "bounds": [[0, 0], [width, height]],
+        "enabled": True,
+        "temp_id": 0
+    }
+    views = [root_view]
+    temp_id = 1
+    for x,y,w,h in view_bounds:
+        view = {
+            "class": "CVView",
+            "bounds": [[x,y], [x+w, y+h]],
+            "enabled": True,
+            "temp_id": temp_id,
+            "signature": calculate_dhash(img[y:y+h, x:x+w]),
+            "parent": 0,
+            "children": []
+        }
+        views.append(view)
+        temp_id += 1
+    root_view["children"] = list(range(1, temp_id))
+    return views
+
+
 def calculate_dhash(img):
     """
     Calculate the dhash value of an image.
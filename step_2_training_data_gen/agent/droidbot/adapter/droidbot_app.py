@@ -52,6 +52,7 @@ class DroidBotAppConn(Adapter):
 
         self.sock = None
         self.last_acc_event = None
+        self.last_acc_event_time = None
         self.enable_accessibility_hard = device.enable_accessibility_hard
         self.ignore_ad = device.ignore_ad
         if self.ignore_ad:
@@ -159,6 +160,7 @@ class DroidBotAppConn(Adapter):
                 self.logger.warning("Invalid data before packet head: " + message[:acc_event_idx])
             body = json.loads(message[acc_event_idx + len("AccEvent >>> "):])
             self.last_acc_event = body
+            self.last_acc_event_time = time.time()
             return
 
         rotation_idx = message.find("rotation >>> ")
@@ -171,6 +173,31 @@ class DroidBotAppConn(Adapter):
         self.logger.warning("Unhandled message from droidbot app: " + message)
         raise DroidBotAppConnException()
 
+    def wait_for_idle(self, idle_time, timeout, since, reaction_time):
+        """
+        wait until the accessibility event stream has been quiet for a while
+        :param idle_time: seconds without any AccEvent after which the screen is considered settled
+        :param timeout: maximum seconds to wait
+        :param since: time of the last input event, AccEvents before it are ignored
+        :param reaction_time: seconds to wait for the first AccEvent after `since`; if none arrives
+                              in time, the input is considered to have no visible effect
+        :return: True if the screen settled, False if it timed out
+        """
+        deadline = time.time() + timeout
+        while True:
+            last_event_time = self.last_acc_event_time
+            if last_event_time is not None and last_event_time >= since:
+                settle_time = last_event_time + idle_time
+            else:
+                settle_time = since + reaction_time
+            now = time.time()
+            if now >= settle_time:
+                return True
+            if now >= deadline:
+                return False
+            # a new AccEvent during the sleep moves settle_time forward, which is checked on wake up
+            time.sleep(min(settle_time, deadline) - now)
+
     def check_connectivity(self):
         """
         check if droidbot app is connected
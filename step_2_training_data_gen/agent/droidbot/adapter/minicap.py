@@ -5,6 +5,7 @@ import time
 import os
 from datetime import datetime
 from .adapter import Adapter
+from .frame_source import Frame, FrameBuffer
 
 
 MINICAP_REMOTE_ADDR = "localabstract:minicap"
@@ -49,6 +50,7 @@ class Minicap(Adapter):
 
         self.last_screen = None
         self.last_screen_time = None
+        self.frames = FrameBuffer()
         self.last_views = []
         self.last_rotation_check_time = datetime.now()
 
@@ -217,6 +219,7 @@ class Minicap(Adapter):
             self.logger.warning("Frame body does not start with JPG header")
         self.last_screen = frameBody
         self.last_screen_time = datetime.now()
+        self.frames.put(Frame(frameBody, time.time(), "jpg"))
         self.last_views = None
         self.logger.debug("Received an image at %s" % self.last_screen_time)
         self.check_rotation()
@@ -280,28 +283,7 @@ class Minicap(Adapter):
 
         from . import cv
         img = cv.load_image_from_buf(self.last_screen)
-        view_bounds = cv.find_views(img)
-        root_view = {
-            "class": "CVViewRoot",
-            "bounds": [[0, 0], [self.width, self.height]],
-            "enabled": True,
-            "temp_id": 0
-        }
-        views = [root_view]
-        temp_id = 1
-        for x,y,w,h in view_bounds:
-            view = {
-                "class": "CVView",
-                "bounds": [[x,y], [x+w, y+h]],
-                "enabled": True,
-                "temp_id": temp_id,
-                "signature": cv.calculate_dhash(img[y:y+h, x:x+w]),
-                "parent": 0,
-                "children": []
-            }
-            views.append(view)
-            temp_id += 1
-        root_view["children"] = list(range(1, temp_id))
+        views = cv.get_views(img, self.width, self.height)
 
         self.last_views = views
         return views
@@ -13,12 +13,21 @@ from .adapter.process_monitor import ProcessMonitor
 from .adapter.telnet import TelnetConsole
 from .adapter.user_input_monitor import UserInputMonitor
 from .adapter.droidbot_ime import DroidBotIme
+from .adapter.frame_source import ScreencapStream, FrameSourceException
 from .app import App
+from .artifact_store import ArtifactStore
 from .intent import Intent
 
 DEFAULT_NUM = '1234567890'
 DEFAULT_CONTENT = 'Hello world!'
 
+# separates the outputs of the dumpsys commands batched in one adb shell call
+STATE_DUMP_SEPARATOR = '__DROIDBOT_STATE_DUMP_SEPARATOR__'
+
+ACTIVITY_LINE_RE = re.compile(r'\*\s*Hist\s*#\d+:\s*ActivityRecord\{[^ ]+\s*[^ ]+\s*([^ ]+)\s*t(\d+)}')
+ACTIVITY_LINE_TASK_RE = re.compile(r'^\s*Task\s*id\s*#(\d+)|^\s*Task\{\w+\s*#(\d+)')
+SERVICE_LINE_RE = re.compile('^.+ServiceRecord{.+ ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)')
+
 
 class Device(object):
     """
@@ -27,11 +36,14 @@ class Device(object):
 
     def __init__(self, device_serial=None, is_emulator=False, output_dir=None,
                  cv_mode=False, grant_perm=False, telnet_auth_token=None,
-                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False):
+                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False,
+                 perceptual_dedupe=False, recompress_screenshots=False):
         """
         initialize a device connection
         :param device_serial: serial number of target device
         :param is_emulator: boolean, type of device, True for emulator, False for real device
+        :param perceptual_dedupe: boolean, if True, the screenshots with the same dHash are stored once
+        :param recompress_screenshots: boolean, if True, the png screenshots are losslessly recompressed
         :return:
         """
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -56,6 +68,12 @@ class Device(object):
         self.enable_accessibility_hard = enable_accessibility_hard
         self.humanoid = humanoid
         self.ignore_ad = ignore_ad
+        # the screenshots of the states, see capture_screenshot()
+        self.artifact_store = None
+        if output_dir is not None:
+            self.artifact_store = ArtifactStore(os.path.join(output_dir, "temp", "artifacts"),
+                                                perceptual_dedupe=perceptual_dedupe,
+                                                recompress=recompress_screenshots)
 
         # basic device information
         self.settings = {}
@@ -69,6 +87,7 @@ class Device(object):
         self.last_know_state = None
         self.__used_ports = []
         self.pause_sending_event = False
+        self.last_event_time = 0
 
         # adapters
         self.adb = ADB(device=self)
@@ -79,6 +98,7 @@ class Device(object):
         self.user_input_monitor = UserInputMonitor(device=self)
         self.process_monitor = ProcessMonitor(device=self)
         self.droidbot_ime = DroidBotIme(device=self)
+        self.screencap_stream = ScreencapStream(device=self)
 
         self.adapters = {
             self.adb: True,
@@ -88,7 +108,8 @@ class Device(object):
             self.logcat: True,
             self.user_input_monitor: True,
             self.process_monitor: True,
-            self.droidbot_ime: True
+            self.droidbot_ime: True,
+            self.screencap_stream: True
         }
 
         # minicap currently not working on emulators
@@ -181,6 +202,7 @@ class Device(object):
             adapter.disconnect()
 
         if self.output_dir is not None:
+            self.artifact_store.clear()
             temp_dir = os.path.join(self.output_dir, "temp")
             if os.path.exists(temp_dir):
                 import shutil
@@ -484,8 +506,23 @@ class Device(object):
         :param event: the event to be sent
         :return:
         """
+        self.last_event_time = time.time()
         event.send(self)
 
+    def wait_for_ui_idle(self, idle_time, timeout, reaction_time):
+        """
+        wait for the UI to settle after the last event, driven by the accessibility events of droidbot app
+        :param idle_time: seconds without any UI change after which the UI is considered idle
+        :param timeout: maximum seconds to wait
+        :param reaction_time: seconds to wait for the UI to start changing after the last event
+        :return: True if the UI is idle, False if it timed out,
+                 None if the accessibility events are not available (the caller should fall back to polling)
+        """
+        if not (self.droidbot_app and self.adapters[self.droidbot_app] and self.droidbot_app.connected):
+            return None
+        return self.droidbot_app.wait_for_idle(idle_time, timeout, since=self.last_event_time,
+                                               reaction_time=reaction_time)
+
     def start_app(self, app):
         """
         start an app on the device
@@ -502,6 +539,7 @@ class Device(object):
             self.logger.warning("unsupported param " + app + " with type: ", type(app))
             return
         intent = Intent(suffix=package_name)
+        self.last_event_time = time.time()
         self.send_intent(intent)
 
         
@@ -528,10 +566,9 @@ class Device(object):
         Get current activity
         """
         r = self.adb.shell("dumpsys activity activities")
-        activity_line_re = re.compile(r'\*\s*Hist\s*#\d+:\s*ActivityRecord\{[^ ]+\s*[^ ]+\s*([^ ]+)\s*t(\d+)}')
-        m = activity_line_re.search(r)
-        if m:
-            return m.group(1)
+        top_activity = self.__parse_top_activity_name(r)
+        if top_activity:
+            return top_activity
         # data = self.adb.shell("dumpsys activity top").splitlines()
         # regex = re.compile("\s*ACTIVITY ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)")
         # m = regex.search(data[1])
@@ -545,8 +582,49 @@ class Device(object):
         Get current activity stack
         :return: a list of str, each str is an activity name, the first is the top activity name
         """
-        task_to_activities = self.get_task_activities()
-        top_activity = self.get_top_activity_name()
+        activities_dump = self.adb.shell("dumpsys activity activities")
+        return self.__parse_current_activity_stack(activities_dump)
+
+    def get_task_activities(self):
+        """
+        Get current tasks and corresponding activities.
+        :return: a dict mapping each task id to a list of activities, from top to down.
+        """
+        return self.__parse_task_activities(self.adb.shell("dumpsys activity activities"))
+
+    def get_service_names(self):
+        """
+        get current running services
+        :return: list of services
+        """
+        return self.__parse_service_names(self.adb.shell('dumpsys activity services'))
+
+    def get_activities_and_services(self):
+        """
+        get the top activity, the activity stack and the running services with a single adb shell round trip
+        :return: a tuple of (top activity name, activity stack, list of services)
+        """
+        # pass the command line as one argument, so that the device shell runs both dumpsys commands
+        r = self.adb.run_cmd(["shell", "dumpsys activity activities; echo %s; dumpsys activity services"
+                              % STATE_DUMP_SEPARATOR])
+        activities_dump, _, services_dump = r.partition(STATE_DUMP_SEPARATOR)
+        top_activity = self.__parse_top_activity_name(activities_dump)
+        if not top_activity:
+            self.logger.warning("Unable to get top activity name.")
+        activity_stack = self.__parse_current_activity_stack(activities_dump)
+        background_services = self.__parse_service_names(services_dump)
+        return top_activity, activity_stack, background_services
+
+    @staticmethod
+    def __parse_top_activity_name(activities_dump):
+        m = ACTIVITY_LINE_RE.search(activities_dump)
+        if m:
+            return m.group(1)
+        return None
+
+    def __parse_current_activity_stack(self, activities_dump):
+        task_to_activities = self.__parse_task_activities(activities_dump)
+        top_activity = self.__parse_top_activity_name(activities_dump)
         if top_activity:
             for task_id in task_to_activities:
                 activities = task_to_activities[task_id]
@@ -557,20 +635,13 @@ class Device(object):
         else:
             return None
 
-    def get_task_activities(self):
-        """
-        Get current tasks and corresponding activities.
-        :return: a dict mapping each task id to a list of activities, from top to down.
-        """
+    @staticmethod
+    def __parse_task_activities(activities_dump):
         task_to_activities = {}
 
-        lines = self.adb.shell("dumpsys activity activities").splitlines()
-        activity_line_re = re.compile(r'\*\s*Hist\s*#\d+:\s*ActivityRecord\{[^ ]+\s*[^ ]+\s*([^ ]+)\s*t(\d+)}')
-
-        for line in lines:
+        for line in activities_dump.splitlines():
             line = line.strip()
-            activity_line_task_re = re.compile(r'^\s*Task\s*id\s*#(\d+)|^\s*Task\{\w+\s*#(\d+)')
-            activity_line_task_m = activity_line_task_re.match(line)
+            activity_line_task_m = ACTIVITY_LINE_TASK_RE.match(line)
             if activity_line_task_m:
                 if activity_line_task_m.group(1):
                     task_id = activity_line_task_m.group(1)
@@ -578,7 +649,7 @@ class Device(object):
                     task_id = activity_line_task_m.group(2)
                 task_to_activities[task_id] = []
             elif re.match(r'\*\s*Hist\s*#', line):
-                m = activity_line_re.match(line)
+                m = ACTIVITY_LINE_RE.match(line)
                 if m:
                     activity = m.group(1)
                     task_id = m.group(2)
@@ -588,18 +659,11 @@ class Device(object):
 
         return task_to_activities
 
-    def get_service_names(self):
-        """
-        get current running services
-        :return: list of services
-        """
+    @staticmethod
+    def __parse_service_names(services_dump):
         services = []
-        dat = self.adb.shell('dumpsys activity services')
-        lines = dat.splitlines()
-        service_re = re.compile('^.+ServiceRecord{.+ ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)')
-
-        for line in lines:
-            m = service_re.search(line)
+        for line in services_dump.splitlines():
+            m = SERVICE_LINE_RE.search(line)
             if m:
                 package = m.group(1)
                 service = m.group(2)
@@ -787,6 +851,47 @@ class Device(object):
     def pull_file(self, remote_file, local_file):
         self.adb.run_cmd(["pull", remote_file, local_file])
 
+    def capture_screenshot(self, store=None):
+        """
+        capture the screen into an artifact store
+        :param store: ArtifactStore, the store of the device if None
+        :return: the reference of the screenshot in the store, to be released by the caller
+        """
+        store = store if store is not None else self.artifact_store
+        frame = self.get_screen_frame()
+        if frame is not None:
+            data, ext = frame.encode()
+            return store.put_bytes(data, ext)
+        from datetime import datetime
+        tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        local_image_path = os.path.join(self.output_dir, "temp", "screen_%s.png" % tag)
+        self._pull_screenshot(local_image_path)
+        return store.put_file(local_image_path, move=True)
+
+    def get_screen_frame(self):
+        """
+        get the screen from a streaming source (minicap, or screencap through a persistent adb shell), in memory
+        :return: Frame, None if no streaming source is available
+        """
+        if self.adapters[self.minicap] and self.minicap.last_screen:
+            return self.minicap.frames.latest()
+        if self.adapters[self.screencap_stream] and self.screencap_stream.check_connectivity():
+            try:
+                return self.screencap_stream.capture()
+            except (OSError, subprocess.CalledProcessError, FrameSourceException) as e:
+                self.logger.warning("exception in get_screen_frame: %s" % e)
+        return None
+
+    def _pull_screenshot(self, local_image_path):
+        # screencap use png format
+        local_image_dir = os.path.dirname(local_image_path)
+        if not os.path.exists(local_image_dir):
+            os.makedirs(local_image_dir)
+        remote_image_path = "/sdcard/%s" % os.path.basename(local_image_path)
+        self.adb.shell("screencap -p %s" % remote_image_path)
+        self.pull_file(remote_image_path, local_image_path)
+        self.adb.shell("rm %s" % remote_image_path)
+
     def take_screenshot(self, image_path=None, name=None):
         # image = None
         #
@@ -800,51 +905,60 @@ class Device(object):
         # except IOError as e:
         #     self.logger.warning("exception in take_screenshot: %s" % e)
         # return image
+        if image_path is None:
+            # the screenshot stays in the store of the device until it disconnects
+            return self.artifact_store.path(self.capture_screenshot())
+
         from datetime import datetime
         tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
         
-        local_image_dir = image_path if image_path is not None else os.path.join(self.output_dir, "temp")
+        local_image_dir = image_path
         
         if not os.path.exists(local_image_dir):
             os.makedirs(local_image_dir)
 
-        if self.adapters[self.minicap] and self.minicap.last_screen:
-            # minicap use jpg format
-            image_name = name if f"{name}.jpg" is not None else "screen_%s.jpg" % tag
+        frame = self.get_screen_frame()
+        if frame is not None:
+            # minicap use jpg format, the raw frames of screencap are saved as png
+            data, ext = frame.encode()
+            image_name = f"{name}{ext}" if name is not None else "screen_%s%s" % (tag, ext)
             local_image_path = os.path.join(local_image_dir, image_name)
             with open(local_image_path, 'wb') as local_image_file:
-                local_image_file.write(self.minicap.last_screen)
+                local_image_file.write(data)
             return local_image_path
-        else:
-            # screencap use png format
-            image_name = f"{name}.png" if name is not None else "screen_%s.png" % tag
-            local_image_path = os.path.join(local_image_dir, image_name)
-            remote_image_path = f"/sdcard/{image_name}"
-            self.adb.shell("screencap -p %s" % remote_image_path)
-            self.pull_file(remote_image_path, local_image_path)
-            self.adb.shell("rm %s" % remote_image_path)
 
+        image_name = f"{name}.png" if name is not None else "screen_%s.png" % tag
+        local_image_path = os.path.join(local_image_dir, image_name)
+        self._pull_screenshot(local_image_path)
         return local_image_path
 
-    def get_current_state(self):
+    def get_current_state(self, with_screenshot=True):
+        """
+        get the current state of the device
+        :param with_screenshot: if set to False, skip capturing the screen, the state has no screenshot
+        :return: DeviceState
+        """
         self.logger.debug("getting current device state...")
         current_state = None
         while True:
             try:
                 views = self.get_views()
-                foreground_activity = self.get_top_activity_name()
-                activity_stack = self.get_current_activity_stack()
-                background_services = self.get_service_names()
-                screenshot_path = self.take_screenshot()
+                foreground_activity, activity_stack, background_services = self.get_activities_and_services()
+                screenshot_ref = self.capture_screenshot() if with_screenshot else None
                 self.logger.debug("finish getting current device state...")
                 from .device_state import DeviceState
                 
-                current_state = DeviceState(self,
-                                            views=views,
-                                            foreground_activity=foreground_activity,
-                                            activity_stack=activity_stack,
-                                            background_services=background_services,
-                                            screenshot_path=screenshot_path)
+                try:
+                    current_state = DeviceState(self,
+                                                views=views,
+                                                foreground_activity=foreground_activity,
+                                                activity_stack=activity_stack,
+                                                background_services=background_services,
+                                                screenshot_ref=screenshot_ref)
+                except Exception:
+                    if screenshot_ref is not None:
+                        self.artifact_store.release(screenshot_ref)
+                    raise
                 self.logger.debug("finish getting current device state...")
                 self.last_know_state = current_state
                 if not current_state:
@@ -899,9 +1013,14 @@ class Device(object):
         self.adb.shell("reboot -p")
 
     def get_views(self):
-        if self.cv_mode and self.adapters[self.minicap]:
+        if self.cv_mode:
             # Get views using cv module
-            views = self.minicap.get_views()
+            if self.adapters[self.minicap]:
+                views = self.minicap.get_views()
+            else:
+                from .adapter import cv
+                frame = self.get_screen_frame()
+                views = cv.get_views(frame.to_array(bgr=True), frame.width, frame.height) if frame else None
             if views:
                 return views
             else:
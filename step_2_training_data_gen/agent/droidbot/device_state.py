@@ -1,13 +1,16 @@
-import copy
+import functools
+import hashlib
 import math
 import os
 import json
 import re
+import threading
+import collections
 import tools as tools
 
 from lxml import etree
 
-from .utils import md5
+from .utils import md5, lazy_property
 from .input_event import TouchEvent, LongTouchEvent, ScrollEvent, SetTextEvent, KeyEvent
 
 class DeviceState(object):
@@ -15,7 +18,12 @@ class DeviceState(object):
     the state of the current device
     """
 
-    def __init__(self, device, views, foreground_activity, activity_stack, background_services, tag=None, screenshot_path=None):
+    def __init__(self, device, views, foreground_activity, activity_stack, background_services, tag=None,
+                 screenshot_path=None, screenshot_ref=None):
+        """
+        :param screenshot_ref: the reference of the screenshot in the artifact store of the device, released with the
+            state; screenshot_path is the path of a screenshot outside the store
+        """
         self.device = device
         self.foreground_activity = foreground_activity
         self.activity_stack = activity_stack if isinstance(activity_stack, list) else []
@@ -24,10 +32,16 @@ class DeviceState(object):
             from datetime import datetime
             tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
         self.tag = tag
-        self.screenshot_path = screenshot_path
+        self.screenshot_ref = None
+        self._screenshot_release = None
+        self._screenshot_path = screenshot_path
+        if screenshot_ref is not None:
+            self.set_screenshot_ref(screenshot_ref)
         self.views = self.__parse_views(views)
-        self.view_tree = {}
-        self.__assemble_view_tree(self.view_tree, self.views)
+        # the nested view tree is only needed by humanoid, it is assembled on the first access from these snapshots,
+        # taken before get_text_representation() annotates the views and drops their invalid children
+        self.__view_snapshots = [dict(view_dict, children=list(self.__safe_dict_get(view_dict, 'children', [])))
+                                 for view_dict in self.views]
         self.__generate_view_strs()
         self.state_str_ = self.__get_state_str()[:6]
         self.structure_str_ = self.__get_content_free_state_str()[:6]
@@ -41,6 +55,27 @@ class DeviceState(object):
             self.is_popup = self.is_popup_window()
             self.parent_state = None
 
+    @property
+    def screenshot_path(self):
+        if self._screenshot_path is None and self.screenshot_ref is not None:
+            return self.device.artifact_store.path(self.screenshot_ref)
+        return self._screenshot_path
+
+    @screenshot_path.setter
+    def screenshot_path(self, screenshot_path):
+        self._screenshot_path = screenshot_path
+
+    def set_screenshot_ref(self, screenshot_ref):
+        """
+        take over a reference of a screenshot in the artifact store of the device, released with the state; the
+        screenshot held before is released now
+        """
+        if self._screenshot_release is not None:
+            self._screenshot_release()
+        self.screenshot_ref = screenshot_ref
+        self._screenshot_path = None
+        self._screenshot_release = self.device.artifact_store.release_with(self, screenshot_ref)
+
     @property
     def state_str(self):
         if self.is_popup and self.parent_state is not None:
@@ -101,19 +136,18 @@ class DeviceState(object):
             views.append(view_dict)
         return views
 
-    def __assemble_view_tree(self, root_view, views):
-        if not len(self.view_tree): # bootstrap
-            if not len(views): # to fix if views is empty
-                return
-            self.view_tree = copy.deepcopy(views[0])
-            self.__assemble_view_tree(self.view_tree, views)
-        else:
-            children = list(enumerate(root_view["children"]))
-            if not len(children):
-                return
-            for i, j in children:
-                root_view["children"][i] = copy.deepcopy(self.views[j])
-                self.__assemble_view_tree(root_view["children"][i], views)
+    @lazy_property
+    def view_tree(self):
+        """
+        the views nested in a tree, i.e. the children of a view are dicts instead of temp ids
+        :return: dict, the root view
+        """
+        if not len(self.__view_snapshots): # to fix if views is empty
+            return {}
+        # every view is in the tree once, so the snapshots become the nodes of the tree
+        for view_dict in self.__view_snapshots:
+            view_dict['children'] = [self.__view_snapshots[child_id] for child_id in view_dict['children']]
+        return self.__view_snapshots[0]
 
     def __generate_view_strs(self):
         for view_dict in self.views:
@@ -215,8 +249,11 @@ class DeviceState(object):
             state_json_file = open(dest_state_json_path, "w")
             state_json_file.write(self.to_json())
             state_json_file.close()
-            import shutil
-            shutil.copyfile(self.screenshot_path, dest_screenshot_path)
+            if self._screenshot_path is None and self.screenshot_ref is not None:
+                self.device.artifact_store.link(self.screenshot_ref, dest_screenshot_path)
+            else:
+                import shutil
+                shutil.copyfile(self.screenshot_path, dest_screenshot_path)
             self.screenshot_path = dest_screenshot_path
             # from PIL.Image import Image
             # if isinstance(self.screenshot_path, Image):
@@ -516,7 +553,7 @@ class DeviceState(object):
                ['android:id/navigationBarBackground',
                 'android:id/statusBarBackground']:
                 enabled_view_ids.append(view_dict['temp_id'])
-        
+        enabled_view_id_set = set(enabled_view_ids)
 
         view_descs = []
         indexed_views = []
@@ -528,7 +565,7 @@ class DeviceState(object):
             view = self.views[view_id]
             idx = view.get('temp_id', -1)
             child_ids = view.get('children', [])
-            ele_attr = EleAttr(idx, child_ids, view, self.views,  enabled_view_ids=enabled_view_ids)
+            ele_attr = EleAttr(idx, child_ids, view, self.views,  enabled_view_ids=enabled_view_id_set)
             element_attr[view_id] = ele_attr
             ele_attr.set_type('div')
             if view_id in removed_view_ids:
@@ -571,7 +608,7 @@ class DeviceState(object):
                     view_text, content_description = self._merge_text(clickable_children_ids)
                     checked = self._get_children_checked(clickable_children_ids)
                     for clickable_child in clickable_children_ids:
-                        if clickable_child in enabled_view_ids and clickable_child != view_id:
+                        if clickable_child in enabled_view_id_set and clickable_child != view_id:
                             removed_view_ids.append(clickable_child)
             elif scrollable:
                 ele_attr.set_type('scrollbar')
@@ -616,7 +653,40 @@ class DeviceState(object):
         element_tree = ElementTree(ele_attrs=element_attr,views=self.views, valid_ele_ids=[view['temp_id'] for view in indexed_views])
         return state_desc, indexed_views, element_tree
 
+    # the properties inherited from the ancestors, e.g. a text in a clickable layout is clickable as well
+    ANCESTORS_PROPERTIES = ['clickable', 'checkable', 'long_clickable']
+
+    @lazy_property
+    def _ancestors_properties(self):
+        """
+        propagate ANCESTORS_PROPERTIES from the ancestors down to their successors, in a single pass over the views
+        :return: dict, property name -> list of the first truthy value of the view or its ancestors, by temp id
+        """
+        properties = {key: [None] * len(self.views) for key in self.ANCESTORS_PROPERTIES}
+        visited = [False] * len(self.views)
+        for view_id in range(len(self.views)):
+            # collect the ancestors not visited yet, then fill them from the top down
+            path = []
+            while 0 <= view_id < len(self.views) and not visited[view_id]:
+                visited[view_id] = True
+                path.append(view_id)
+                view_id = self.__safe_dict_get(self.views[view_id], 'parent', -1)
+            parent_id = view_id
+            for view_id in reversed(path):
+                view_dict = self.views[view_id]
+                for key, values in properties.items():
+                    value = self.__safe_dict_get(view_dict, key)
+                    if not value and 0 <= parent_id < len(self.views):
+                        value = values[parent_id]
+                    values[view_id] = value if value else None
+                parent_id = view_id
+        return properties
+
     def _get_self_ancestors_property(self, view, key, default=None):
+        view_id = self.__safe_dict_get(view, 'temp_id', -1)
+        if key in self.ANCESTORS_PROPERTIES and 0 <= view_id < len(self.views) and self.views[view_id] is view:
+            value = self._ancestors_properties[key][view_id]
+            return value if value else default
         all_views = [view] + [self.views[i] for i in self.get_all_ancestors(view)]
         for v in all_views:
             value = self.__safe_dict_get(v, key)
@@ -883,6 +953,14 @@ class EleAttr(object):
     @property
     def desc_html_end(self) -> str:
         return f'</{tools.escape_xml_chars(self.type_)}>'
+
+    @property
+    def html_key(self) -> tuple:
+        '''
+        all that desc_html_start and desc_html_end render except the id, the tag name and resource_id come first
+        '''
+        resource_id = self.resource_id.split('/')[-1] if self.resource_id else ''
+        return (self.type_, resource_id, self.alt or '', tuple(self.status) if self.status else (), self.content or '')
     
     @property
     def desc_visible_html_start(self) -> str:
@@ -918,7 +996,27 @@ class ElementTree(object):
         self.size = len(self.ele_map)
         # result
         self.str = self.get_str()
-        self.skeleton = HTMLSkeleton(self.str)
+        self._compute_digests(self.root)
+        # two trees have the same str iff they have the same digest
+        self.digest: bytes = self.root.digest
+
+    @lazy_property
+    def skeleton(self):
+        '''
+        the skeleton only depends on the tag names and resource ids, it is shared by the trees where they are the same,
+        e.g. the consecutive states of a screen
+        '''
+        with _skeleton_cache_lock:
+            skeleton = _skeleton_cache.get(self.root.skeleton_digest)
+            if skeleton is not None:
+                _skeleton_cache.move_to_end(self.root.skeleton_digest)
+                return skeleton
+        skeleton = HTMLSkeleton.from_element_tree(self)
+        with _skeleton_cache_lock:
+            _skeleton_cache[self.root.skeleton_digest] = skeleton
+            if len(_skeleton_cache) > SKELETON_CACHE_SIZE:
+                _skeleton_cache.popitem(last=False)
+        return skeleton
 
     def get_ele_by_id(self, index: int):
         return self.ele_map.get(index, None)
@@ -933,6 +1031,10 @@ class ElementTree(object):
             self.id = nid
             self.parent = pid
             self.leaves = set()
+            # Merkle digests of the subtree, see ElementTree._compute_digests()
+            self.digest: bytes = None
+            self.content_digest: bytes = None
+            self.skeleton_digest: bytes = None
 
         def get_leaves(self):
             for child in self.children:
@@ -1021,6 +1123,88 @@ class ElementTree(object):
 
         return root, ele_map, _valid_ele_ids
 
+    def _compute_digests(self, node: node):
+        '''
+        compute the Merkle digests of the subtrees, bottom-up:
+        - digest: the subtree as rendered in self.str
+        - content_digest: the same without the element ids, which shift when views are added or removed anywhere before
+        - skeleton_digest: the tag names and resource ids, all that HTMLSkeleton keeps
+        '''
+        for child in node.children:
+            self._compute_digests(child)
+        attr = self.ele_map[node.id]
+        html_key = attr.html_key
+        digest = hashlib.blake2b(repr((attr.id, html_key)).encode(), digest_size=16)
+        content_digest = hashlib.blake2b(repr(html_key).encode(), digest_size=16)
+        skeleton_digest = hashlib.blake2b(repr(html_key[:2]).encode(), digest_size=16)
+        for child in node.children:
+            digest.update(child.digest)
+            content_digest.update(child.content_digest)
+            skeleton_digest.update(child.skeleton_digest)
+        node.digest = digest.digest()
+        node.content_digest = content_digest.digest()
+        node.skeleton_digest = skeleton_digest.digest()
+
+    def is_same_screen(self, other: 'ElementTree') -> bool:
+        '''
+        same as self.str == other.str, in constant time
+        '''
+        return other is not None and self.digest == other.digest
+
+    def diff(self, previous: 'ElementTree') -> 'ElementTreeDiff':
+        '''
+        compare the tree with the tree of a previous state, e.g. to tell what changed after an action. The elements are
+        matched by their content (not by their ids), the subtrees with the same content digests are skipped.
+        '''
+        result = ElementTreeDiff()
+        if previous is None:
+            result.appeared = self._subtree_eles(self.root)
+            return result
+
+        def _match(prev_node, node):
+            prev_attr, attr = previous.ele_map[prev_node.id], self.ele_map[node.id]
+            if prev_node.content_digest == node.content_digest:
+                return
+            if prev_attr.html_key != attr.html_key:
+                result.changed.append((prev_attr, attr))
+            # identical subtrees first, in order
+            unmatched_prev = collections.defaultdict(collections.deque)
+            for prev_child in prev_node.children:
+                unmatched_prev[prev_child.content_digest].append(prev_child)
+            remaining = []
+            for child in node.children:
+                if unmatched_prev[child.content_digest]:
+                    unmatched_prev[child.content_digest].popleft()
+                else:
+                    remaining.append(child)
+            # then the elements with the same tag name and resource id, whose subtrees changed
+            prev_by_name = collections.defaultdict(collections.deque)
+            for prev_child in prev_node.children:
+                if prev_child in unmatched_prev[prev_child.content_digest]:
+                    prev_by_name[previous.ele_map[prev_child.id].html_key[:2]].append(prev_child)
+            for child in remaining:
+                candidates = prev_by_name[self.ele_map[child.id].html_key[:2]]
+                if candidates:
+                    _match(candidates.popleft(), child)
+                else:
+                    result.appeared.extend(self._subtree_eles(child))
+            for candidates in prev_by_name.values():
+                for prev_child in candidates:
+                    result.disappeared.extend(previous._subtree_eles(prev_child))
+
+        if previous.ele_map[previous.root.id].html_key[:2] == self.ele_map[self.root.id].html_key[:2]:
+            _match(previous.root, self.root)
+        else:
+            result.appeared = self._subtree_eles(self.root)
+            result.disappeared = previous._subtree_eles(previous.root)
+        return result
+
+    def _subtree_eles(self, node: node) -> list[EleAttr]:
+        eles = [self.ele_map[node.id]]
+        for child in node.children:
+            eles.extend(self._subtree_eles(child))
+        return eles
+
     def get_str(self, is_color=False) -> str:
         '''
     use to print the tree in terminal with color
@@ -1074,22 +1258,35 @@ class ElementTree(object):
             html_view = re.sub(r"id='\d+'", '', html_view)
         return html_view
 
+    @lazy_property
+    def xml_root(self):
+        '''
+        the lxml tree of self.str, parsed only once per state
+        '''
+        return etree.fromstring(self.str)
+
+    @lazy_property
+    def xml_ele_map(self) -> dict:
+        '''
+        map each lxml node of self.xml_root to its EleAttr, so that the xpath results
+        can be resolved without serializing them back to strings
+        '''
+        xml_ele_map = {}
+        for xml_node in self.xml_root.iter():
+            ele_id = xml_node.get('id')
+            if ele_id is None or not ele_id.isdigit():
+                continue
+            ele = self.ele_map.get(int(ele_id), None)
+            if ele:
+                xml_ele_map[xml_node] = ele
+        return xml_ele_map
+
     def _get_ele_by_xpath(self, xpath: str) -> EleAttr | None:
-        html_view = self.str
-        root = etree.fromstring(html_view)
-        eles = root.xpath(xpath)
-        if not eles:
+        eles = _compile_xpath(xpath)(self.xml_root)
+        if not eles or not isinstance(eles, list):
             return None
-        ele_desc = etree.tostring(
-            eles[0], pretty_print=True).decode('utf-8')  # only for father node
-        id_str = re.search(r' id="(\d+)"', ele_desc).group(1)
-        try:
-            id = int(id_str)
-        except Exception as e:
-            print('fail to analyze xpath, err: {e}')
-            raise e  # todo:: add a better way to handle this
         # print('found element with id', id)
-        return self.ele_map.get(id, None)
+        return self.xml_ele_map.get(eles[0], None)
 
     def get_ele_by_xpath(self, xpath: list[str] | str):
         target_ele = None
@@ -1292,15 +1489,76 @@ class ElementTree(object):
             ele_attrs=_ele_attr,views=self.views, valid_ele_ids=_valid_ele_ids, root_id=ele_id)
 
 
+class ElementTreeDiff(object):
+    '''
+    the changes from the tree of a previous state, see ElementTree.diff()
+    '''
+
+    def __init__(self):
+        # the elements only in the current tree
+        self.appeared: list[EleAttr] = []
+        # the elements only in the previous tree
+        self.disappeared: list[EleAttr] = []
+        # (previous element, current element) of the matched elements whose alt, status or content changed
+        self.changed: list[tuple[EleAttr, EleAttr]] = []
+
+    @property
+    def is_same(self) -> bool:
+        return not (self.appeared or self.disappeared or self.changed)
+
+    def __repr__(self) -> str:
+        return f'ElementTreeDiff(appeared={len(self.appeared)}, disappeared={len(self.disappeared)}, changed={len(self.changed)})'
+
+
+# the skeletons of the latest screens, by the skeleton digest of their trees
+SKELETON_CACHE_SIZE = 256
+_skeleton_cache: collections.OrderedDict = collections.OrderedDict()
+_skeleton_cache_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile_xpath(xpath: str) -> etree.XPath:
+    '''
+    the xpaths in the api docs are shared by all states, so compile each of them only once
+    '''
+    return etree.XPath(xpath)
+
+
 from bs4 import BeautifulSoup, Tag, NavigableString
 
+# the tags that html.parser closes at once (bs4 HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS), their children become their
+# next siblings
+_VOID_TAGS = frozenset([
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img', 'input',
+    'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track', 'wbr'
+])
+# the tags whose content html.parser or prettify() do not handle as nested tags
+_RAW_CONTENT_TAGS = frozenset([
+    'iframe', 'noembed', 'noframes', 'noscript', 'plaintext', 'pre', 'rp', 'rt', 'script', 'style', 'template',
+    'textarea', 'title', 'xmp'
+])
+_PLAIN_TAG_NAME_RE = re.compile(r'[A-Za-z][A-Za-z0-9_$.:-]*')
+
+
+def _quote_attribute_value(value: str) -> str:
+    '''
+    quote the value as prettify() does
+    '''
+    value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return '"' + value.replace('"', '&quot;') + '"'
+
+
 class HTMLSkeleton():
 
     def __init__(self, html: str | BeautifulSoup, is_formatted=False):
         if isinstance(html, str):
-            self.soup = BeautifulSoup(html, 'html.parser')
+            self._soup = BeautifulSoup(html, 'html.parser')
         else:
-            self.soup = html
+            self._soup = html
 
         if not is_formatted:
             self._remove_attributes()
@@ -1308,6 +1566,88 @@ class HTMLSkeleton():
 
         self.str = self.soup.prettify()
 
+    @classmethod
+    def from_element_tree(cls, element_tree: ElementTree) -> 'HTMLSkeleton':
+        '''
+    Same as HTMLSkeleton(element_tree.str), computed from the nodes of the tree without parsing the html.
+    '''
+        ele_map = element_tree.ele_map
+
+        def _nodes(node) -> list[tuple]:
+            html_key = ele_map[node.id].html_key
+            name = html_key[0]
+            if not name or not _PLAIN_TAG_NAME_RE.fullmatch(name) or name.lower() in _RAW_CONTENT_TAGS:
+                raise ValueError(name)
+            name = name.lower()
+            attrs = (('resource_id', html_key[1]),) if html_key[1] else ()
+            children = [child_node for child in node.children for child_node in _nodes(child)]
+            if name in _VOID_TAGS:
+                return [(name, attrs, ())] + children
+            return [(name, attrs, children)]
+
+        def _remove_repeated_siblings(nodes) -> tuple:
+            unique_nodes = []
+            seen_signatures = set()
+            for name, attrs, children in nodes:
+                if (name, attrs) not in seen_signatures:
+                    seen_signatures.add((name, attrs))
+                    unique_nodes.append((name, attrs, _remove_repeated_siblings(children)))
+            return tuple(unique_nodes)
+
+        try:
+            canonical = _remove_repeated_siblings(_nodes(element_tree.root))
+        except ValueError:
+            # the tag names that html.parser would not read as plain tags
+            return cls(element_tree.str)
+        skeleton = cls.__new__(cls)
+        skeleton._soup = None
+        skeleton._lazy_canonical = canonical
+        skeleton.str = cls._render(canonical)
+        return skeleton
+
+    @staticmethod
+    def _render(canonical: tuple) -> str:
+        '''
+    the output of prettify() for the canonical form
+    '''
+        lines = []
+
+        def _render_node(node, depth):
+            name, attrs, children = node
+            indent = ' ' * depth
+            attrs_str = ''.join(f' {key}={_quote_attribute_value(value)}' for key, value in attrs)
+            if name in _VOID_TAGS:
+                lines.append(f'{indent}<{name}{attrs_str}/>')
+                return
+            lines.append(f'{indent}<{name}{attrs_str}>')
+            for child in children:
+                _render_node(child, depth + 1)
+            lines.append(f'{indent}</{name}>')
+
+        for node in canonical:
+            _render_node(node, 0)
+        return ''.join(line + '\n' for line in lines)
+
+    @property
+    def soup(self) -> BeautifulSoup:
+        if self._soup is None:
+            # only built from the nodes, parse the skeleton itself
+            self._soup = HTMLSkeleton(self.str)._soup
+        return self._soup
+
+    @lazy_property
+    def canonical(self) -> tuple:
+        '''
+    The structure of the skeleton as nested (tag name, sorted attributes, children) tuples, one per top tag
+    '''
+
+        def _canonical(tag):
+            attrs = tuple(sorted((key, tuple(value) if isinstance(value, list) else value)
+                                 for key, value in tag.attrs.items()))
+            return (tag.name, attrs, tuple(_canonical(child) for child in tag.find_all(recursive=False)))
+
+        return tuple(_canonical(tag) for tag in self.soup.find_all(recursive=False))
+
     def _remove_attributes(self):
         '''
     use bs4 to remove all other attributes except for the tag name and resource_id from the html
@@ -1354,7 +1694,10 @@ class HTMLSkeleton():
     Count the number of tags in the HTML skeleton.
     For comparing the complexity of two HTML skeletons.
     """
-        return len(self.soup.find_all(recursive=True))
+        def _count(nodes):
+            return sum(1 + _count(children) for _, _, children in nodes)
+
+        return _count(self.canonical)
 
     def extract_common_skeleton(self, skeleton):
         '''
@@ -1391,10 +1734,37 @@ class HTMLSkeleton():
             return HTMLSkeleton('', is_formatted=False)
         return HTMLSkeleton(common_structure, is_formatted=True)
 
+    @lazy_property
+    def tag_paths(self) -> frozenset[str]:
+        '''
+    The fingerprint of the skeleton: the positional tag path (child index and tag name
+    of every step from the root) of each tag below the root, prefixed by the root tag name.
+    The common structure of two skeletons consists exactly of the paths they share, so
+    len(a.tag_paths & b.tag_paths) == a.extract_common_skeleton(b).count()
+    '''
+        if not self.canonical:
+            return frozenset()
+        paths = set()
+
+        def _collect(node, prefix):
+            for idx, child in enumerate(node[2]):
+                path = f'{prefix}/{idx}:{child[0]}'
+                paths.add(path)
+                _collect(child, path)
+
+        _collect(self.canonical[0], self.canonical[0][0])
+        return frozenset(paths)
+
+    def count_common(self, skeleton) -> int:
+        '''
+    Same as self.extract_common_skeleton(skeleton).count(), without building the common tree.
+    '''
+        return len(self.tag_paths & skeleton.tag_paths)
+
     def __eq__(self, value: object) -> bool:
         if not isinstance(value, HTMLSkeleton):
             return False
-        return self.soup == value.soup
+        return self.canonical == value.canonical
 
     def __ne__(self, value: object) -> bool:
         return not self.__eq__(value)
@@ -18,6 +18,7 @@ import pandas as pd
 from .input_event import *
 from .input_policy import UtgBasedInputPolicy
 from .device_state import ElementTree, EleAttr, DeviceState
+from . import trace_log
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s")
 DEBUG = True
@@ -104,18 +105,7 @@ def get_view_without_id(view_desc):
 
 
 def _save2yaml(file_name, state_prompt, idx, inputs=None, action_type='touch', state_str=None, structure_str=None, tag=None, width=None, height=None, raw_prompt=None, raw_answer=None, currently_executing_code=None):
-    if not os.path.exists(file_name):
-        tmp_data = {
-        'step_num': 0,
-        'records': []
-        }
-        with open(file_name, 'w', encoding='utf-8') as f:
-            yaml.dump(tmp_data, f)
-
-    with open(file_name, 'r', encoding='utf-8') as f:
-        old_yaml_data = yaml.safe_load(f)
-    new_records = old_yaml_data['records']
-    new_records.append(
+    trace_log.get_trace_writer(file_name).append(
             {'State': state_prompt,
             'Choice': idx,
             'Action': action_type,
@@ -129,12 +119,6 @@ def _save2yaml(file_name, state_prompt, idx, inputs=None, action_type='touch', s
             'raw_answer':raw_answer,
             'currently_executing_code':currently_executing_code}
         )
-    data = {
-        'step_num': len(list(old_yaml_data['records'])),
-        'records': new_records
-    }
-    with open(file_name, 'w', encoding='utf-8') as f:
-        yaml.dump(data, f)
 '''end for manual mode'''
 
 class GPT:
@@ -1472,6 +1456,8 @@ class Memory_Guided_Policy(UtgBasedInputPolicy):
         file_path = os.path.join(self.device.output_dir, output_path)
         idx = -1 if not crash else 'crashed'
         _save2yaml(file_path, state_desc_with_bbox, idx, None, None, state.state_str, state.structure_str, state.tag, state.width, state.height)
+        # the task is over, write its log
+        trace_log.close_trace(file_path)
          
     def parse_all_executable_actions(self, state):
         state_info = self.memory._memorize_state(state)
@@ -1947,6 +1933,8 @@ class Code_Policy(UtgBasedInputPolicy):
         file_path = os.path.join(self.device.output_dir, output_path)
         idx = -1 if not crash else 'crashed'
         _save2yaml(file_path, state_desc, idx, None, action_desc, state.state_str, state.structure_str, state.tag, state.width, state.height, currently_executing_code=self.code_to_be_executed['statement'])
+        # the task is over, write its log
+        trace_log.close_trace(file_path)
          
     def parse_all_executable_actions(self, state):
         state_info = self.memory._memorize_state(state)
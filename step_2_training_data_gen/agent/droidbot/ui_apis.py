@@ -9,6 +9,7 @@ import time
 
 from .input_event import RestartAppEvent, IntentEvent, KeyEvent
 from .device_state import ElementTree, EleAttr
+from . import trace_log
 
 api_names = ['long_tap', 
              'tap', 
@@ -104,18 +105,7 @@ def get_api_semantic_dependency(dependency_paths, api_xpaths):
     return ele_semantic_dependencies
 
 def _save2yaml(file_name, state_prompt, idx, inputs=None, action_type='touch', state_str=None, structure_str=None, tag=None, width=None, height=None, raw_prompt=None, raw_answer=None, currently_executing_code=None):
-    if not os.path.exists(file_name):
-        tmp_data = {
-        'step_num': 0,
-        'records': []
-        }
-        with open(file_name, 'w', encoding='utf-8') as f:
-            yaml.dump(tmp_data, f)
-
-    with open(file_name, 'r', encoding='utf-8') as f:
-        old_yaml_data = yaml.safe_load(f)
-    new_records = old_yaml_data['records']
-    new_records.append(
+    trace_log.get_trace_writer(file_name).append(
             {'State': state_prompt,
             'Choice': idx,
             'Action': action_type,
@@ -129,14 +119,6 @@ def _save2yaml(file_name, state_prompt, idx, inputs=None, action_type='touch', s
             'raw_answer':raw_answer,
             'currently_executing_code':currently_executing_code}
         )
-    data = {
-        'step_num': len(list(old_yaml_data['records'])),
-        'records': new_records
-    }
-    t1 = time.time()
-    with open(file_name, 'w', encoding='utf-8') as f:
-        yaml.dump(data, f)
-    print(f'save to yaml time: {time.time() - t1}')
         
 def save_current_ui_to_log(input_policy, api_name, currently_executing_code=None):
     log_path = os.path.join(input_policy.device.output_dir, f'log_{input_policy.task_id}.yaml')
@@ -145,7 +127,7 @@ def save_current_ui_to_log(input_policy, api_name, currently_executing_code=None
     state_desc = element_tree.get_str(is_color=False)
     
     if os.path.exists(log_path):
-        output_log = tools.load_yaml_file(log_path)
+        output_log = trace_log.load_log(log_path)
         if len(output_log['records']) == 0:
             return
         last_state_str = output_log['records'][-1]['state_str']
@@ -411,7 +393,7 @@ class Verifier:
             self.input_policy.start(input_manager=self.input_manager, code_policy=True)
     
     def check_output_crash(self, api_name):
-        output_log = tools.load_yaml_file(os.path.join(self.input_policy.device.output_dir, f'log_{self.input_manager.task_id}.yaml'))
+        output_log = trace_log.load_log(os.path.join(self.input_policy.device.output_dir, f'log_{self.input_manager.task_id}.yaml'))
         if output_log['records'][-1]['Choice'] == 'crashed':
             raise Exception(f'Action not found when executing tap {api_name}')
 
@@ -33,6 +33,18 @@ class EmulatorController:
         except Exception as e:
             self.logger.error(f"Error loading emulator with snapshot: {e}")
 
+    def attach(self):
+        """
+        attach to the emulator if it is already running, so that snapshots are reloaded on it instead of booting a new instance.
+
+        Returns:
+        bool: whether the emulator is running.
+        """
+        result = subprocess.run(["adb", "-s", f"{self.device_serial}", "get-state"], capture_output=True, text=True)
+        if result.returncode == 0 and result.stdout.strip() == "device":
+            self.state = "on"
+        return self.state == "on"
+
     def exit_emulator(self):
         """
         exit the current running emulator instance.
@@ -57,6 +69,24 @@ class EmulatorController:
         except Exception as e:
             self.logger.error(f"Error running adb command: {e}")
             
+    def start_adb_command(self, command):
+        """
+        start the specified adb command without waiting for it.
+
+        Args:
+        command (str): the adb command to run.
+
+        Returns:
+        subprocess.Popen: the running command, or None if it could not be started.
+        """
+        try:
+            self.logger.info(f"Starting adb command: {command}")
+            return subprocess.Popen(["adb", "-s", f"{self.device_serial}"] + command.split(),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except Exception as e:
+            self.logger.error(f"Error starting adb command: {e}")
+            return None
+
     def reload_snapshot(self, snapshot_name="default_boot"):
         """
         reload the specified snapshot.
@@ -65,13 +95,43 @@ class EmulatorController:
         snapshot_name (str): the name of snapshot。
         """
         if self.state == "on":
-            cmd = ["adb", "emu", "avd", "snapshot", "load", snapshot_name]
+            cmd = ["adb", "-s", f"{self.device_serial}", "emu", "avd", "snapshot", "load", snapshot_name]
             self.logger.info(f"cmd: {cmd}")
             try:
                 self.logger.info(f"Loading emulator '{self.avd_name}' with snapshot '{snapshot_name}'.")
-                subprocess.Popen(cmd)
+                # wait for the snapshot to be loaded, the device is not usable before that
+                result = subprocess.run(cmd, capture_output=True, text=True)
+                # the console answers "OK", or "KO: <reason>" if the snapshot could not be loaded
+                if result.returncode != 0 or "KO" in result.stdout:
+                    self.logger.error(f"Error reseting emulator with snapshot: {snapshot_name}, console: {result.stdout.strip()}")
                 self.state = "on"
             except Exception as e:
                 self.logger.error(f"Error reseting emulator with snapshot: {snapshot_name}, error: {e}")
         else:
             self.load_emulator_with_snapshot(snapshot_name)
+
+    def _get_output(self, args, timeout=5):
+        """
+        run an adb command and return its output, or None if it failed or timed out.
+        """
+        try:
+            result = subprocess.run(["adb", "-s", f"{self.device_serial}"] + args, capture_output=True, text=True,
+                                    timeout=timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if result.returncode != 0:
+            return None
+        return result.stdout.strip()
+
+    def is_running(self):
+        """
+        check, through the emulator console, that the virtual device is running, i.e. not paused by a snapshot load.
+        """
+        status = self._get_output(["emu", "avd", "status"])
+        return status is not None and "running" in status
+
+    def is_boot_completed(self):
+        """
+        check that adb is online and the system has finished booting (sys.boot_completed).
+        """
+        return self._get_output(["shell", "getprop", "sys.boot_completed"]) == "1"
@@ -3,6 +3,7 @@ import json
 import logging
 import os
 import time
+import threading
 import dataclasses
 
 import traceback
@@ -13,6 +14,12 @@ import pandas as pd
 from agent.droidbot.device_state import ElementTree
 from agent.emulator_controller import EmulatorController
 
+# The UI is considered settled once no accessibility event arrived for this many seconds.
+UI_IDLE_SECONDS = 0.3
+
+# If no accessibility event arrives this many seconds after an action, the action is assumed to have no visible effect.
+UI_REACTION_SECONDS = 0.8
+
 @dataclasses.dataclass(frozen=True)
 class State():
   """State of the Android environment.
@@ -95,6 +102,15 @@ class AsyncEnv(abc.ABC):
           True if UI is considered stable, False if it never stabilizes within the
           timeout.
       """
+
+  def wait_after_action(self, max_wait: float) -> None:
+    """Waits for the screen to react to the last executed action.
+
+    Environments that can observe UI changes should return as soon as the screen
+    settles; the fallback is to simply wait for `max_wait` seconds.
+    """
+    time.sleep(max_wait)
+
   @abc.abstractmethod
   def execute_action(self, action: dict) -> None:
     """Executes action on the environment."""
@@ -135,8 +151,11 @@ class AsyncEnv(abc.ABC):
     
 from agent.droidbot.device import Device
 from agent.droidbot.app import App
+from agent.droidbot.artifact_store import ArtifactStore
+from agent.droidbot.background_writer import BackgroundWriter
 from agent.droidbot.device_state import DeviceState
 from agent.droidbot import input_event
+from agent.readiness import DeviceReadiness, ResetTimer
 
 class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
   
@@ -150,9 +169,18 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
     self._prior_state = None
     self.local_output_path = local_output_path
     self.device_logs = f"{local_output_path}/device_logs"
+    # the dumps of all traces, the trace folders link to them; the files of the traces hold the references
+    self.artifact_store = ArtifactStore(f"{local_output_path}/artifacts")
+    # the dumps of the actions are written in the background, overlapping the next actions
+    self.dump_writer = BackgroundWriter(name="action-dump-writer")
+    # the capture of the last action still running on the device: its uiautomator dump, then its activity
+    self._device_capture = None
     self.logger = logging.getLogger(self.__class__.__name__)
     
     self.emulator_controller = EmulatorController(avd_name=avd_name,device_serial=self.device_serial,params=emulator_controller_args)
+    self.readiness = DeviceReadiness(self.emulator_controller)
+    # task output path -> the latencies of the resets of the task
+    self.reset_latencies = {}
 
     self._state: DeviceState = None
     self._element_tree: ElementTree = None
@@ -186,6 +214,8 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
 
   @property
   def actions_taken(self) -> list:
+    # the write times are known once the dumps are written
+    self.dump_writer.flush()
     return self._actions_taken
   
   @property
@@ -198,15 +228,16 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
   def set_up(self) -> None:
     self.logger.info("loading emulator...")
     self.emulator_controller.load_emulator_with_snapshot()
-    time.sleep(30) # waiting for emulator to start
+    self.readiness.wait_for_boot()
     self.logger.info("connecting to device...")
     self.device = Device(
         is_emulator=True,
         device_serial=self.device_serial,
         output_dir=self.device_logs)
+    self.readiness.device = self.device
     self.device.set_up()
     self.device.connect()
-    time.sleep(2)
+    self.readiness.wait_for_droidbot_app()
     self.logger.info("AgentEnv setup over!")
 
   def reset(self, go_home: bool = False) -> State:
@@ -215,7 +246,7 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
     return self.get_state()
   
   def reset_env(self, app_name, wipe_intermidiate_task_data = False):
-    if wipe_intermidiate_task_data and len(self.actions_taken) == 0:
+    if wipe_intermidiate_task_data and len(self._actions_taken) == 0:
       return
     
     self.logger.info("resetting agent env...")
@@ -224,8 +255,10 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
     self.episode_end = False
     self._actions_taken = []
     self.app_name = app_name
+    timer = ResetTimer()
+    # the dumps of the previous task are pulled from the device before it is restored
+    self._wait_for_dumps()
     self.device.disconnect()
-    time.sleep(15)
     # if wipe_intermidiate_task_data:
     #   self.logger.info("wiping intermidiate results...")
     #   # os.system(f"del  -rf {self.task_output_path}/*")
@@ -234,15 +267,16 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
 
     # if self.app_name != app_name or self.home_screen != self._element_tree.str:
     self.emulator_controller.reload_snapshot(self.config.EMULATOR_CONTROLLER_AGRS["snapshot"])
-    time.sleep(15)
+    timer.lap("reload_snapshot", self.readiness.wait_for_snapshot())
     self.device.set_up()
     self.device.connect()
-    time.sleep(5)
-    self.prepare(app_name)
+    timer.lap("connect", self.readiness.wait_for_droidbot_app())
+    self.prepare(app_name, timer)
+    self._record_reset_latency(timer)
       
-    self.logger.info("agent env reset successfully!")
+    self.logger.info(f"agent env reset successfully in {timer.as_dict()['seconds']}s!")
   
-  def prepare(self, app_name = None):
+  def prepare(self, app_name = None, timer: ResetTimer = None):
     if app_name != None:
       self.app_name = app_name
 
@@ -252,11 +286,24 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
     
     self.device.send_event(input_event.RestartAppEvent(app=app))
     self.device.start_app(app)
-    time.sleep(10)
+    ready = self.readiness.wait_for_foreground(app)
+    # the first screen of the app is drawn once the UI settles
+    self.wait_for_stable_state()
+    if timer is not None:
+      timer.lap("start_app", ready)
     self._update_state()
 
+  def _record_reset_latency(self, timer: ResetTimer) -> None:
+    """Appends the latency of the reset to reset_latency.json of the task; a task is reset again on a retry."""
+    latencies = self.reset_latencies.setdefault(self.task_output_path, [])
+    latencies.append(timer.as_dict())
+    with open(os.path.join(self.task_output_path, "reset_latency.json"), "w", encoding="utf-8") as file:
+      json.dump(latencies, file, indent=2)
+
   def close(self) -> None:
     self.logger.info(f"tear down the agent env...")
+    self._wait_for_dumps()
+    self.dump_writer.close()
     self.device.disconnect()
     time.sleep(5)
     self.emulator_controller.exit_emulator()
@@ -298,19 +345,24 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
     elif action_type == 'back':
       event = input_event.KeyEvent(name='BACK')
     if event != None:
+      # the capture of the previous action must not see the screen of this one
+      self._wait_for_device_capture()
       self.device.send_event(event)
     
     t1 = time.time()
     formatted_action = self._trans_action_format(action_type, action_params, width, height)
+    action_taken = {"action":formatted_action, "log_time":None, "write_time":None, "location_time": time_spent_locating}
     try:
-      self._dump_action_state(formatted_action)
+      self._dump_action_state(formatted_action, action_taken)
     except Exception as e:
         tb_str = traceback.format_exc()
         print(f"Exception caught: {e}")
         print("Traceback details:")
         print(tb_str)
     t2 = time.time()
-    self.actions_taken.append({"action":formatted_action, "log_time":t2 - t1, "location_time": time_spent_locating})
+    # log_time is spent before the next action, write_time in the background while the next actions run
+    action_taken["log_time"] = t2 - t1
+    self._actions_taken.append(action_taken)
 
   def _trans_action_format(self, action_type, action_para, width, height) -> Any:
       if action_type == "click" or action_type == "long_press":
@@ -332,29 +384,85 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
       else:
           raise ValueError("action_type not supported")
       
-  def _dump_action_state(self, formatted_action):
-        tag = len(self.actions_taken)
-        view_hierarchy_json_path = os.path.join(self.vh_json_dir_path, f"{tag}.vh")
-        activity_path = os.path.join(self.activity_dir_path, f"{tag}.activity")
-        action_path = os.path.join(self.action_dir_path, f"{tag}.action")
-        ep_installed_fp = os.path.join(self.ep_installed_dir, "installed_apps.txt")
-
-        with open(ep_installed_fp, 'w') as file:
-          # Intentionally set to '' as we ignore tasks related to installing applications
-            file.write("")
-            
-        self._do_dump_hierarchy(tag, self.vh_dir_path)   
-
-        with open(view_hierarchy_json_path, "w", encoding="utf-8") as vh_json_file:
-            json.dump(self._state.views, vh_json_file, ensure_ascii=False, indent=4)
-        
-        with open(activity_path, "w", encoding="utf-8") as activity_file:
-            activity_file.write(self.foreground_activity_name)
-        
-        with open(action_path, "w", encoding="utf-8") as action_file:
-            action_file.write(formatted_action)
-        
-        self.device.take_screenshot(self.screenshot_dir_path,tag)
+  def _dump_action_state(self, formatted_action, action_taken):
+    """Captures the state of the action and hands it to the background writer.
+
+    Only what changes with the screen is captured here: the frame of the screen, and the uiautomator dump, started on
+    the device. The views are those of the last state. Once the dump is over, the activity is queried in the
+    background, after the event took effect as before. The dump is pulled, and the trace files are written, by the
+    writer.
+    """
+    tag = len(self._actions_taken)
+    views = self._state.views
+    frame = self.device.get_screen_frame()
+    # without a streaming source of frames, the screen is pulled right away
+    screenshot_ref = self.device.capture_screenshot(self.artifact_store) if frame is None else None
+    dump_process = self.emulator_controller.start_adb_command(f"shell uiautomator dump /sdcard/{tag}.xml")
+    paths = (self.screenshot_dir_path, self.activity_dir_path, self.vh_dir_path, self.vh_json_dir_path,
+             self.action_dir_path, self.ep_installed_dir)
+    captured = {}
+
+    def capture_activity():
+      dump_process.wait()
+      try:
+        captured["activity"] = self.foreground_activity_name
+      except Exception as e:
+        self.logger.warning(f"failed to get the activity of action {tag}: {e}")
+
+    device_capture = threading.Thread(target=capture_activity, name=f"action-capture-{tag}", daemon=True)
+    device_capture.start()
+    self._device_capture = device_capture
+
+    def write():
+      device_capture.join()
+      self._write_action_state(tag, paths, formatted_action, views, captured.get("activity"), frame, screenshot_ref,
+                               dump_process)
+
+    def on_done(seconds):
+      action_taken["write_time"] = seconds
+
+    self.dump_writer.submit(write, on_done)
+
+  def _write_action_state(self, tag, paths, formatted_action, views, activity, frame, screenshot_ref, dump_process):
+    screenshot_dir_path, activity_dir_path, vh_dir_path, vh_json_dir_path, action_dir_path, ep_installed_dir = paths
+    view_hierarchy_json_path = os.path.join(vh_json_dir_path, f"{tag}.vh")
+    activity_path = os.path.join(activity_dir_path, f"{tag}.activity")
+    action_path = os.path.join(action_dir_path, f"{tag}.action")
+    ep_installed_fp = os.path.join(ep_installed_dir, "installed_apps.txt")
+
+    if not os.path.exists(ep_installed_fp):
+      with open(ep_installed_fp, 'w') as file:
+        # Intentionally set to '' as we ignore tasks related to installing applications
+        file.write("")
+
+    with open(action_path, "w", encoding="utf-8") as action_file:
+      action_file.write(formatted_action)
+
+    with open(activity_path, "w", encoding="utf-8") as activity_file:
+      activity_file.write(activity or "")
+
+    if frame is not None:
+      data, ext = frame.encode()
+      screenshot_ref = self.artifact_store.put_bytes(data, ext)
+    screenshot_ext = os.path.splitext(screenshot_ref)[1]
+    self.artifact_store.link(screenshot_ref, os.path.join(screenshot_dir_path, f"{tag}{screenshot_ext}"))
+
+    vh_json_ref = self.artifact_store.put_json(views, ensure_ascii=False, indent=4)
+    self.artifact_store.link(vh_json_ref, view_hierarchy_json_path)
+
+    self._do_dump_hierarchy(tag, vh_dir_path, dump_process)
+    xml_path = os.path.join(vh_dir_path, f"{tag}.xml")
+    self.artifact_store.link(self.artifact_store.put_file(xml_path), xml_path)
+
+  def _wait_for_device_capture(self) -> None:
+    if self._device_capture is not None:
+      self._device_capture.join()
+      self._device_capture = None
+
+  def _wait_for_dumps(self) -> None:
+    """Waits until the dumps of the actions taken so far are written."""
+    self._wait_for_device_capture()
+    self.dump_writer.flush()
   
   def get_state(self) -> State:
     # if self._element_tree is None:
@@ -364,8 +472,8 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
     #   return self._get_stable_state()
     return State.create_and_infer_elements(screenshot=self._state.screenshot_path, element_tree=self._element_tree)
   
-  def _update_state(self) -> State:
-    self._state = self.device.get_current_state()
+  def _update_state(self, with_screenshot: bool = True) -> State:
+    self._state = self.device.get_current_state(with_screenshot=with_screenshot)
     _, _, element_tree = self._state.text_representation
     self._element_tree = element_tree
 
@@ -388,24 +496,31 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
         True if UI is considered stable, False if it never stabilizes within the
         timeout.
     """
+    if self.device.wait_for_ui_idle(UI_IDLE_SECONDS, timeout, UI_REACTION_SECONDS) is not None:
+      # the accessibility events tell when the screen settles, no need to poll the UI tree
+      return self.get_state()
+
     if self._state is None:
       self.get_state()
 
     stable_checks = 0
     elapsed_time = 0
-    prioir_element_tree = self._element_tree
+    # the digests of the trees are compared, not the html strings
+    prior_tree_digest = self._element_tree.digest
 
     while stable_checks < stability_threshold and elapsed_time < timeout:
       try:
-        self._update_state()
-        if prioir_element_tree.str == self._element_tree.str:
+        # the pixels of the intermediate states are never used
+        self._update_state(with_screenshot=False)
+        tree_digest = self._element_tree.digest
+        if prior_tree_digest == tree_digest:
           stable_checks += 1
           if stable_checks == stability_threshold:
             print("State updated!")
             break  # Exit early if stability is achieved.
         else:
           stable_checks = 0  # Reset if any change is detected
-          prioir_element_tree = self._element_tree
+          prior_tree_digest = tree_digest
 
         time.sleep(check_interval)
         elapsed_time += check_interval
@@ -415,10 +530,24 @@ class AsyncDroidBotEnvForLlamaTouch(AsyncEnv):
         elapsed_time += check_interval
         print("Error getting state! Trying again..",e)
 
-  
-  def _do_dump_hierarchy(self, name, dump_location) -> str:
+    # only the settled screen needs pixels, the screenshot is released with the state
+    self._state.set_screenshot_ref(self.device.capture_screenshot())
+    return State.create_and_infer_elements(screenshot=self._state.screenshot_path, element_tree=self._element_tree)
+
+  def wait_after_action(self, max_wait: float) -> None:
+    if self.device.wait_for_ui_idle(UI_IDLE_SECONDS, max_wait, UI_REACTION_SECONDS) is None:
+      time.sleep(max_wait)
+
+  def _do_dump_hierarchy(self, name, dump_location, dump_process=None) -> str:
+        """
+        Args:
+          dump_process: the uiautomator dump already started on the device, waited for instead of dumping again
+        """
         device_dump_location = f"/sdcard/{name}.xml"
-        self.emulator_controller.run_adb_command(f"shell uiautomator dump {device_dump_location}")
+        if dump_process is not None:
+            dump_process.wait()
+        else:
+            self.emulator_controller.run_adb_command(f"shell uiautomator dump {device_dump_location}")
         self.emulator_controller.run_adb_command(f"pull {device_dump_location} {dump_location}")
         # read the content from the dumped file 
         with open(f"{dump_location}/{name}.xml", "r", encoding="utf-8") as file:
@@ -505,9 +634,13 @@ class AsyncDroidBotEnv(AsyncEnv):
     if not event:
       return
     self.device.send_event(event)
+
+  def wait_after_action(self, max_wait: float) -> None:
+    if self.device.wait_for_ui_idle(UI_IDLE_SECONDS, max_wait, UI_REACTION_SECONDS) is None:
+      time.sleep(max_wait)
     
-  def _get_state(self) -> State:
-    state = self.device.get_current_state()
+  def _get_state(self, with_screenshot: bool = True) -> State:
+    state = self.device.get_current_state(with_screenshot=with_screenshot)
     self._state = state
     _, element_list, element_tree = state.text_representation
     return State.create_and_infer_elements(screenshot=state.screenshot_path, element_tree=element_tree)
@@ -531,15 +664,19 @@ class AsyncDroidBotEnv(AsyncEnv):
         True if UI is considered stable, False if it never stabilizes within the
         timeout.
     """
+    if self.device.wait_for_ui_idle(UI_IDLE_SECONDS, timeout, UI_REACTION_SECONDS) is not None:
+      # the accessibility events tell when the screen settles, no need to poll the UI tree
+      return self._get_state()
+
     if not self._prior_state:
-      self._prior_state = self._get_state()
+      self._prior_state = self._get_state(with_screenshot=False)
 
     stable_checks = 0
     elapsed_time = 0.0
-    current_state = self._get_state()
+    current_state = self._get_state(with_screenshot=False)
 
     while stable_checks < stability_threshold and elapsed_time < timeout:
-      if self._prior_state.element_tree.str == current_state.element_tree.str:
+      if current_state.element_tree.is_same_screen(self._prior_state.element_tree):
         stable_checks += 1
         if stable_checks == stability_threshold:
           break  # Exit early if stability is achieved.
@@ -549,9 +686,11 @@ class AsyncDroidBotEnv(AsyncEnv):
 
       time.sleep(sleep_duration)
       elapsed_time += sleep_duration
-      current_state = self._get_state()
+      current_state = self._get_state(with_screenshot=False)
 
-    return current_state
+    # only the settled screen needs pixels, the screenshot is released with the state
+    self._state.set_screenshot_ref(self.device.capture_screenshot())
+    return State.create_and_infer_elements(screenshot=self._state.screenshot_path, element_tree=current_state.element_tree)
   
   @property
   def foreground_activity_name(self) -> str:
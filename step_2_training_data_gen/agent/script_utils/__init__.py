@@ -1,6 +1,7 @@
 # constants
 
-# Wait a few seconds for the screen to stabilize after executing an action.
+# Wait at most a few seconds for the screen to stabilize after executing an action.
+# Environments that receive accessibility events return as soon as the screen settles.
 WAIT_AFTER_ACTION_SECONDS = 1.5
 
 MAX_SCROLL_NUM = 4
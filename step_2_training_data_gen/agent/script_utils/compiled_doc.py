@@ -0,0 +1,131 @@
+'''
+Compiled form of an API document, loaded by ApiDoc instead of the json document when it is up to date.
+
+Loading a json document parses the skeleton of every screen and every dependency path of every element, which takes
+seconds for the larger apps. The compiled document keeps the results: the fingerprints of the normalized skeletons,
+the table of the API names with their xpaths, the parsed dependency actions and the rendered element descriptions.
+The screens are pickled one by one behind a small header and only unpickled (from a memory-mapped file) when a screen
+is used.
+
+ApiDoc compiles a json document the first time it loads it; to compile documents ahead of time, e.g. after generating
+them:
+
+  python -m agent.script_utils.compiled_doc <doc.json> [<doc.json> ...]
+'''
+import os
+import sys
+import mmap
+import struct
+import pickle
+import argparse
+import tempfile
+
+COMPILED_DOC_SUFFIX = '.apidoc'
+COMPILED_DOC_VERSION = 1
+_MAGIC = b'APIDOC'
+# magic, version, length of the header
+_PREAMBLE = struct.Struct('<6sHQ')
+
+
+def get_compiled_path(doc_path: str) -> str:
+  return os.path.splitext(doc_path)[0] + COMPILED_DOC_SUFFIX
+
+
+def is_up_to_date(doc_path: str, compiled_path: str) -> bool:
+  if not os.path.exists(compiled_path):
+    return False
+  return os.path.getmtime(compiled_path) >= os.path.getmtime(doc_path)
+
+
+def write_compiled_doc(doc, compiled_path: str):
+  '''
+  @param doc: the ApiDoc loaded from the json document
+  '''
+  screen_names = list(doc.doc)
+  api_names, api_xpaths = [], []
+  screen_blobs = []
+  for screen_name in screen_names:
+    elements = []
+    for api_key, ele in doc.doc[screen_name].items():
+      elements.append((len(api_names), ele.raw,
+                       [[action.to_dict() for action in path] for path in ele.dependency_action]))
+      api_names.append(api_key)
+      api_xpaths.append(doc.api_xpath.get(api_key))
+    screen_blobs.append(pickle.dumps(elements, protocol=pickle.HIGHEST_PROTOCOL))
+
+  offsets, offset = [], 0
+  for blob in screen_blobs:
+    offsets.append((offset, len(blob)))
+    offset += len(blob)
+  header = pickle.dumps({
+      'screen_names': screen_names,
+      'main_screen': doc.main_screen,
+      'skeletons': [doc.screen_name2raw_skeleton[screen_name] for screen_name in screen_names],
+      'tag_paths': [sorted(doc.screen_name2tag_paths[screen_name]) for screen_name in screen_names],
+      'api_names': api_names,
+      'api_xpaths': api_xpaths,
+      'all_element_desc': {is_show_xpath: doc.get_all_element_desc(is_show_xpath) for is_show_xpath in [False, True]},
+      'offsets': offsets,
+  }, protocol=pickle.HIGHEST_PROTOCOL)
+
+  # several agents may load the same document at once, the file is replaced as a whole
+  compiled_dir = os.path.dirname(os.path.abspath(compiled_path))
+  fd, tmp_path = tempfile.mkstemp(dir=compiled_dir, suffix=COMPILED_DOC_SUFFIX + '.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(_PREAMBLE.pack(_MAGIC, COMPILED_DOC_VERSION, len(header)))
+      f.write(header)
+      for blob in screen_blobs:
+        f.write(blob)
+    os.replace(tmp_path, compiled_path)
+  except BaseException:
+    os.remove(tmp_path)
+    raise
+
+
+class CompiledDoc():
+
+  def __init__(self, compiled_path: str):
+    self.compiled_path = compiled_path
+    with open(compiled_path, 'rb') as f:
+      self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, header_len = _PREAMBLE.unpack_from(self._data)
+    if magic != _MAGIC or version != COMPILED_DOC_VERSION:
+      raise ValueError(f'Unsupported compiled doc: {compiled_path}')
+    header = pickle.loads(self._data[_PREAMBLE.size:_PREAMBLE.size + header_len])
+    self._data_start = _PREAMBLE.size + header_len
+
+    self.screen_names: list[str] = header['screen_names']
+    self.main_screen: str = header['main_screen']
+    self.skeletons: dict[str, str] = dict(zip(self.screen_names, header['skeletons']))
+    self.tag_paths: dict[str, frozenset[str]] = {
+        screen_name: frozenset(tag_paths) for screen_name, tag_paths in zip(self.screen_names, header['tag_paths'])
+    }
+    self.api_names: list[str] = [sys.intern(api_name) for api_name in header['api_names']]
+    self.api_xpath: dict[str, str] = dict(zip(self.api_names, header['api_xpaths']))
+    self.all_element_desc: dict[bool, str] = header['all_element_desc']
+    self._offsets = dict(zip(self.screen_names, header['offsets']))
+
+  def load_screen(self, screen_name: str) -> list[tuple[str, dict, list[list[dict]]]]:
+    '''
+    @return: (api name, raw element, attributes of the dependency actions) of the elements in the screen
+    '''
+    offset, length = self._offsets[screen_name]
+    start = self._data_start + offset
+    elements = pickle.loads(self._data[start:start + length])
+    return [(self.api_names[api_idx], raw, dependency_action) for api_idx, raw, dependency_action in elements]
+
+
+def compile_doc(doc_path: str) -> str:
+  from agent.script_utils.api_doc import ApiDoc
+  compiled_path = get_compiled_path(doc_path)
+  write_compiled_doc(ApiDoc(doc_path, use_compiled=False), compiled_path)
+  return compiled_path
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Compile API documents for fast loading.")
+  parser.add_argument('doc_paths', nargs='+')
+  args = parser.parse_args()
+  for doc_path in args.doc_paths:
+    print(f'{doc_path} -> {compile_doc(doc_path)}')
@@ -1,6 +1,6 @@
 import json
-import multiprocessing
-import tools as tools
+import asyncio
+from llm_client import LLMClient
 
 
 class MultiProcessingQuery:
@@ -47,20 +47,14 @@ class MultiProcessingQuery:
       print("Error decoding JSON.")
     return results
 
-  def save_to_json(self, key, result):
-    with open(self.output_file, "a") as f:
-      json.dump({key: result}, f)
-      f.write("\n")
-
-  def process_func(self, key_value):
-    key, value = key_value
-
+  async def process_prompt(self, client, key, prompt):
     if self.is_json:
       retry = 0
       err = None
       while retry < self.json_retry:
         try:
-          res = tools.query_llm(value)
+          # the responses are cached by the client, a retry asks the model again
+          res = await client.complete(self.model, prompt, refresh=retry > 0)
           result = json.loads(res)
           break
         except json.JSONDecodeError as e:
@@ -76,23 +70,32 @@ class MultiProcessingQuery:
 
     else:
       try:
-        result = tools.query_llm(value)
+        result = await client.complete(self.model, prompt)
       except Exception as err:
         print(f"Error processing {key=}: {err}")
         result = None
 
-    self.save_to_json(key, result)
+    return result
+
+  async def _query_all_dicts(self, dict_questions, worker_num):
+    # worker_num bounds the requests in flight to each provider, as the processes of the former pool did
+    with LLMClient(max_concurrency=worker_num) as client, open(self.output_file,
+                                                               "a") as f:
+
+      async def process(key, prompt):
+        result = await self.process_prompt(client, key, prompt)
+        # every result is written as soon as it is received
+        f.write(json.dumps({key: result}) + "\n")
+        f.flush()
+
+      await asyncio.gather(*(process(key, prompt)
+                             for key, prompt in dict_questions.items()))
 
   def query_all_dicts(self, dict_questions, worker_num=4):
-    pool = multiprocessing.Pool(processes=worker_num)
     try:
-      with pool:
-        pool.map(self.process_func, dict_questions.items())
+      asyncio.run(self._query_all_dicts(dict_questions, worker_num))
     except KeyboardInterrupt:
-      pool.close()
-      pool.terminate()
-      pool.join()
-      exit(1)  # still need to exit the program by ps -a and kill -9
+      exit(1)
 
   def convert_list_to_dict(self, list_questions):
     return {str(i): question for i, question in enumerate(list_questions)}
@@ -1,8 +1,7 @@
 import tools as tools
+import model_server
 import agent.environment as environment
 from agent.script_utils.api_doc import ApiDoc
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
-import torch
 
 
 ACTIONS_DSL_PROMPT_DESCRIPTION = '''
@@ -53,15 +52,29 @@ Above are examples of how to use the provided APIs. Please focus on the actual u
 
 class SolutionGenerator:
 
+  AUTODROIDV2_MODEL_PATH = "autodroidv2"
+  # put the start screen and the task after the app document, so that all tasks of an app share its KV cache.
+  # autodroidv2 was fine-tuned on the default order, only enable this after checking the accuracy of the reordered prompt
+  TASK_LAST_PROMPT = False
+
   def __init__(self, app_name: str, task: str, doc: ApiDoc, model_name:str):
     self.app_name = app_name
     self.task = task
     self.doc = doc
-    model_name = model_name
+    self.model_name = model_name
     if model_name == "autodroidv2":
       self.load_autodroidv2()
     
   def make_prompt(self, env: environment.AsyncEnv):
+    prefix, suffix = self.make_prompt_parts(env)
+    return prefix + suffix
+
+  def make_prompt_parts(self, env: environment.AsyncEnv):
+    '''
+    returns the prompt as (prefix, suffix), the prefix does not depend on the task, so its KV cache can be shared by
+    all tasks of the app. By default the prompt keeps the order autodroidv2 was fine-tuned on and the prefix is only
+    the preamble; with TASK_LAST_PROMPT the document comes first and the start screen and the task are in the suffix.
+    '''
     # all elements
     all_elements_desc = self.doc.get_all_element_desc()
     
@@ -73,7 +86,7 @@ class SolutionGenerator:
     element_tree = state.element_tree
     visible_html_view = element_tree.get_str_with_visible()
     
-    return f'''Imagine that you are a robot operating a smartphone to use the {self.app_name} app. Like how humans operate the smartphone, you can tap, long tap, input text, scroll, and get attributes of the UI elements in the {self.app_name} app. However, unlike humans, you cannot see the screen or interact with the physical buttons on the smartphone. Therefore, you need to write scripts to manipulate the UI elements (buttons, text fields, scrollers, element_lists, etc) in the app. 
+    head = f'''Imagine that you are a robot operating a smartphone to use the {self.app_name} app. Like how humans operate the smartphone, you can tap, long tap, input text, scroll, and get attributes of the UI elements in the {self.app_name} app. However, unlike humans, you cannot see the screen or interact with the physical buttons on the smartphone. Therefore, you need to write scripts to manipulate the UI elements (buttons, text fields, scrollers, element_lists, etc) in the app. 
 
 You are provided with: 
 1. Your ultimate task to be completed using the app. 
@@ -90,14 +103,16 @@ You should output a python-style code to complete the task.
 
 
 
-And here is the start screen of the app described by HTML:
+'''
+    screen = f'''And here is the start screen of the app described by HTML:
 {visible_html_view}
 
-Now, {ACTIONS_DSL_PROMPT_DESCRIPTION}
-
-**Your ultimate task is: {self.task}**
+'''
+    actions = f'''Now, {ACTIONS_DSL_PROMPT_DESCRIPTION}
 
-You can use the following important UI elements:
+'''
+    task = f'''**Your ultimate task is: {self.task}**'''
+    elements = f'''You can use the following important UI elements:
 {all_elements_desc}
 
 
@@ -113,28 +128,28 @@ Note that:
 - **you should only output the JSON content.**
 - **you must use '$' only before any UI element**
 - **pay attention to save the changes to the app settings, if save appears in the UI**'''
+    if self.TASK_LAST_PROMPT:
+      return head + actions + elements, '\n\n' + screen + task
+    return head, screen + actions + task + '\n\n' + elements
   
   def load_autodroidv2(self):
-      model_path = "autodroidv2"
-      tokenizer = AutoTokenizer.from_pretrained(model_path)
-      model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float16, device_map="auto")
-      return model, tokenizer
+      # the weights are loaded once per process (or not at all if a model server is used)
+      model_server.load_autodroidv2(self.AUTODROIDV2_MODEL_PATH)
       
-  def query_autodroidv2(self, prompt: str):
-      inputs = self.tokenizer(prompt, return_tensors="pt").to("cuda" if torch.cuda.is_available() else "cpu")
-      output = self.model.generate(**inputs, max_length=1000, pad_token_id=self.tokenizer.eos_token_id)
-      return self.tokenizer.decode(output[0], skip_special_tokens=True)
+  def query_autodroidv2(self, prompt: str, prefix: str = None):
+      return model_server.query_autodroidv2(prompt, model_path=self.AUTODROIDV2_MODEL_PATH, max_length=1000, prefix=prefix)
 
   def get_solution(self,
                    prompt_answer_path: str,
                    env: environment.AsyncEnv,
                    model_name='gpt-4o'):
-    prompt = self.make_prompt(env)
+    prompt_prefix, prompt_suffix = self.make_prompt_parts(env)
+    prompt = prompt_prefix + prompt_suffix
     print("Query GPT-4o for solution")
     # write the prompt to a txt file concately
     tools.append_to_txt_file(prompt_answer_path.replace('.json', '.txt'), f'{prompt}\n'+('='*50)+'\n\n')
     if self.model_name == "autodroidv2":
-      answer = self.query_autodroidv2(prompt)
+      answer = self.query_autodroidv2(prompt, prefix=prompt_prefix)
     else:
       answer = tools.query_model(model=model_name, prompt=prompt)
 
@@ -14,6 +14,7 @@ import traceback
 import pkg_resources
 import shutil
 import subprocess
+from agent.droidbot import trace_log
 from agent.droidbot.device import Device
 from agent.droidbot.app import App
 from agent.droidbot.input_event import RestartAppEvent
@@ -327,7 +328,7 @@ Answer: (True if the task has been fully completed, else False.)
     tools.dump_json_file(f'{self.save_path}/line_mappings.json', line_mappings)
     
     # in case some silly scripts include no UI actions at all, we make an empty log for batch_verifying
-    tools.dump_yaml_file(os.path.join(self.save_path, f'log.yaml'), {'records': [], 'step_num': 0})
+    trace_log.reset_trace(os.path.join(self.save_path, f'log.yaml'))
     
     env = self.env
     self.code_config.set(self.save_path, code, code_script, line_mappings)
@@ -370,6 +371,7 @@ Answer: (True if the task has been fully completed, else False.)
         currently_executing_code=None,
         comment='done',
         screenshot=None)
+    trace_log.close_trace(self.code_config.log_file)
 
     device.disconnect()
     
@@ -0,0 +1,204 @@
+"""
+Process-wide registry of the locally hosted autodroidv2 model, and an optional inference server sharing it.
+
+The weights are loaded lazily, once per process. To load them once per machine instead, start the server:
+
+    python model_server.py --model_path autodroidv2 --port 8300
+
+and set AUTODROIDV2_SERVER_URL=http://localhost:8300 for the pipeline stages; their queries are then sent to the server.
+
+Prompts sharing a long stable prefix (the per-app document) can pass it as `prefix`: its KV cache is computed once and
+reused by later queries, so only the task-specific rest of the prompt is prefilled.
+"""
+import os
+import copy
+import json
+import hashlib
+import argparse
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+SERVER_URL_ENV = 'AUTODROIDV2_SERVER_URL'
+
+_models = {}
+_models_lock = threading.Lock()
+# generate() is not thread safe, and one model only serves one query at a time anyway
+_generate_lock = threading.Lock()
+
+# Number of prefix KV caches kept in memory, the least recently used one is evicted first.
+MAX_PREFIX_CACHES = 8
+_prefix_caches = collections.OrderedDict()
+
+
+def get_server_url():
+    return os.environ.get(SERVER_URL_ENV)
+
+
+def load_autodroidv2(model_path: str):
+    '''
+    load the model and tokenizer at model_path, only the first call of a process loads the weights.
+    @return: (model, tokenizer), or None if the queries are sent to a server
+    '''
+    if get_server_url():
+        return None
+    return _load(model_path)
+
+
+def _load(model_path: str):
+    with _models_lock:
+        if model_path not in _models:
+            import torch
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+            model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float16, device_map="auto")
+            _models[model_path] = (model, tokenizer)
+        return _models[model_path]
+
+
+def _get_prefix_cache(model_path: str, model, tokenizer, prefix: str, device: str):
+    import torch
+    from transformers import DynamicCache
+    key = (model_path, hashlib.md5(prefix.encode()).hexdigest())
+    if key in _prefix_caches:
+        _prefix_caches.move_to_end(key)
+        return _prefix_caches[key]
+
+    prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids.to(device)
+    with torch.no_grad():
+        past_key_values = model(prefix_ids, use_cache=True).past_key_values
+    if isinstance(past_key_values, tuple):
+        past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+    _prefix_caches[key] = (prefix_ids[0].tolist(), past_key_values)
+    if len(_prefix_caches) > MAX_PREFIX_CACHES:
+        _prefix_caches.popitem(last=False)
+    return _prefix_caches[key]
+
+
+def _generate(model_path: str, prompt: str, max_length: int, prefix: str = None):
+    import torch
+    model, tokenizer = _load(model_path)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    with _generate_lock:
+        inputs = tokenizer(prompt, return_tensors="pt").to(device)
+        generate_kwargs = {}
+        if prefix and prompt.startswith(prefix):
+            prefix_ids, past_key_values = _get_prefix_cache(model_path, model, tokenizer, prefix, device)
+            input_ids = inputs.input_ids[0].tolist()
+            # the last tokens of the prefix may be merged with the rest of the prompt, only reuse the common part,
+            # and leave at least one token to be prefilled
+            reused_len = 0
+            max_reused_len = min(len(prefix_ids), len(input_ids) - 1)
+            while reused_len < max_reused_len and prefix_ids[reused_len] == input_ids[reused_len]:
+                reused_len += 1
+            if reused_len > 0:
+                # generate() extends the cache in place, keep the cached prefix intact
+                past_key_values = copy.deepcopy(past_key_values)
+                past_key_values.crop(reused_len)
+                generate_kwargs['past_key_values'] = past_key_values
+        output = model.generate(**inputs, max_length=max_length, pad_token_id=tokenizer.eos_token_id, **generate_kwargs)
+    return tokenizer.decode(output[0], skip_special_tokens=True)
+
+
+def _generate_batch(model_path: str, prompts: list[str], max_new_tokens: int, stop_strings: list[str] = None):
+    import torch
+    model, tokenizer = _load(model_path)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    with _generate_lock:
+        # the answers continue from the last token of the prompts, so the prompts are padded on the left; the
+        # tokenizer is shared with _generate, its settings are restored afterwards
+        padding_side, pad_token = tokenizer.padding_side, tokenizer.pad_token
+        try:
+            tokenizer.padding_side = 'left'
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(device)
+            output = model.generate(**inputs, max_new_tokens=max_new_tokens, pad_token_id=tokenizer.pad_token_id,
+                                    stop_strings=stop_strings, tokenizer=tokenizer)
+        finally:
+            tokenizer.padding_side, tokenizer.pad_token = padding_side, pad_token
+    # only the generated tokens, without the prompts
+    return tokenizer.batch_decode(output[:, inputs.input_ids.shape[1]:], skip_special_tokens=True)
+
+
+def query_autodroidv2(prompt: str, model_path: str = "autodroidv2", max_length: int = 1000, prefix: str = None,
+                      timeout: int = 600):
+    '''
+    @param prefix: the stable beginning of the prompt shared with other queries, e.g. the part describing the app
+    '''
+    server_url = get_server_url()
+    if not server_url:
+        return _generate(model_path, prompt, max_length, prefix)
+    # the server answers with the model it was started with
+    response = requests.post(f'{server_url.rstrip("/")}/generate',
+                             json={'prompt': prompt, 'max_length': max_length, 'prefix': prefix},
+                             timeout=timeout)
+    response.raise_for_status()
+    return response.json()['answer']
+
+
+def query_autodroidv2_batch(prompts: list[str], model_path: str = "autodroidv2", max_new_tokens: int = 1024,
+                            stop_strings: list[str] = None, batch_size: int = 8, timeout: int = 600):
+    '''
+    generate the answers of many prompts, batch_size prompts at a time. Unlike query_autodroidv2, the answers do not
+    include the prompts; they are yielded in the order of the prompts as soon as their batch is generated.
+    @param stop_strings: a sequence stops as soon as it generates one of these strings (which is kept in the answer)
+    '''
+    server_url = get_server_url()
+    for start in range(0, len(prompts), batch_size):
+        batch = prompts[start:start + batch_size]
+        if not server_url:
+            answers = _generate_batch(model_path, batch, max_new_tokens, stop_strings)
+        else:
+            response = requests.post(f'{server_url.rstrip("/")}/generate_batch',
+                                     json={'prompts': batch, 'max_new_tokens': max_new_tokens,
+                                           'stop_strings': stop_strings},
+                                     timeout=timeout)
+            response.raise_for_status()
+            answers = response.json()['answers']
+        yield from answers
+
+
+class _GenerateHandler(BaseHTTPRequestHandler):
+    model_path = None
+
+    def do_POST(self):
+        if self.path not in ['/generate', '/generate_batch']:
+            self.send_error(404)
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if self.path == '/generate':
+                result = {'answer': _generate(self.model_path, body['prompt'], body.get('max_length', 1000),
+                                              body.get('prefix'))}
+            else:
+                result = {'answers': _generate_batch(self.model_path, body['prompts'], body.get('max_new_tokens', 1024),
+                                                     body.get('stop_strings'))}
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(model_path: str, host: str = 'localhost', port: int = 8300):
+    _load(model_path)
+    handler = type('GenerateHandler', (_GenerateHandler,), {'model_path': model_path})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f'serving {model_path} on http://{host}:{port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the autodroidv2 model to all pipeline stages.")
+    parser.add_argument('--model_path', default="autodroidv2")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8300)
+    args = parser.parse_args()
+    serve(args.model_path, args.host, args.port)
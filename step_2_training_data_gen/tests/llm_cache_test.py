@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import llm_cache
+from llm_cache import LLMCache, cached_query
+
+IMAGE_PROMPT = [
+    {'type': 'text', 'text': 'describe the screen'},
+    {'type': 'image_url', 'image_url': {'url': 'data:image/jpeg;base64,aGVsbG8='}},
+]
+
+
+class TestLLMCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = LLMCache(os.path.join(self.cache_dir, 'responses.sqlite'), 2**20)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_text_and_multimodal_prompts(self):
+        for prompt in ['describe the screen', IMAGE_PROMPT]:
+            self.assertIsNone(self.cache.get('gpt-4o', prompt))
+            self.cache.put('gpt-4o', prompt, f'answer to {type(prompt).__name__}')
+        self.assertEqual(self.cache.get('gpt-4o', 'describe the screen'), 'answer to str')
+        self.assertEqual(self.cache.get('gpt-4o', IMAGE_PROMPT), 'answer to list')
+        # the key does not depend on the order of the keys of the parts
+        reordered = [dict(reversed(list(part.items()))) for part in IMAGE_PROMPT]
+        self.assertEqual(LLMCache.make_key('gpt-4o', reordered), LLMCache.make_key('gpt-4o', IMAGE_PROMPT))
+        self.assertNotEqual(LLMCache.make_key('gpt-4o', IMAGE_PROMPT),
+                            LLMCache.make_key('gpt-4o', IMAGE_PROMPT[:1]))
+
+    def test_cached_query(self):
+        queried = []
+
+        @cached_query
+        def query(prompt, model_name, temperature=0.2):
+            queried.append(prompt)
+            return f'answer {len(queried)}'
+
+        # the process-wide cache is created again in the temporary directory
+        environ = {'LLM_CACHE_PATH': os.path.join(self.cache_dir, 'shared.sqlite'), 'LLM_CACHE_DISABLED': '0'}
+        with mock.patch.dict(os.environ, environ), mock.patch.object(llm_cache, '_cache', None):
+            for prompt in ['describe the screen', IMAGE_PROMPT]:
+                first = query(prompt, 'gpt-4o')
+                self.assertEqual(query(prompt, 'gpt-4o'), first)
+        self.assertEqual(queried, ['describe the screen', IMAGE_PROMPT])
+
+    def test_refresh_replaces_a_rejected_answer(self):
+        answers = ['not json', '{"id": 1}']
+
+        @cached_query
+        def query(prompt, model_name, temperature=0.2):
+            return answers.pop(0)
+
+        environ = {'LLM_CACHE_PATH': os.path.join(self.cache_dir, 'shared.sqlite'), 'LLM_CACHE_DISABLED': '0'}
+        with mock.patch.dict(os.environ, environ), mock.patch.object(llm_cache, '_cache', None):
+            self.assertEqual(query(IMAGE_PROMPT, 'gpt-4o'), 'not json')
+            self.assertEqual(query(IMAGE_PROMPT, 'gpt-4o'), 'not json')
+            self.assertEqual(query(IMAGE_PROMPT, 'gpt-4o', refresh=True), '{"id": 1}')
+            # the new answer replaced the rejected one
+            self.assertEqual(query(IMAGE_PROMPT, 'gpt-4o'), '{"id": 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()
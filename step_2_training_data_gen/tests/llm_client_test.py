@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_client import DEFAULT_GPT_API_URL, LLMClient, Provider, default_providers, parse_retry_after
+from parallel_query import MultiProcessingQuery
+
+
+class MockLLMServer:
+    """
+    OpenAI-compatible chat completions endpoint answering "echo: <prompt>"
+    """
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # prompt -> the responses to send before the answer, e.g. [(429, {'Retry-After': '1'})]
+        self.failures = {}
+        # prompt -> the answers to send in turn, instead of the echo
+        self.answers = {}
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                prompt = body['messages'][0]['content']
+                with server.lock:
+                    server.requests.append((time.monotonic(), prompt))
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                    failures = server.failures.get(prompt)
+                    failure = failures.pop(0) if failures else None
+                    answers = server.answers.get(prompt)
+                    answer = answers.pop(0) if answers else f'echo: {prompt}'
+                time.sleep(server.delay)
+                with server.lock:
+                    server.in_flight -= 1
+                if failure is not None:
+                    status, headers = failure
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    return
+                data = json.dumps({'choices': [{'message': {'content': answer}}]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/v1'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestLLMClient(unittest.TestCase):
+    def setUp(self):
+        self.server = MockLLMServer()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.output_dir)
+
+    def make_client(self, max_concurrency=4, requests_per_second=100.0, burst=100, **kwargs):
+        providers = {
+            name: Provider(name, 'openai', self.server.url, 'test-key', max_concurrency, requests_per_second, burst)
+            for name in ['gpt', 'claude', 'llm']
+        }
+        return LLMClient(providers, use_cache=False, base_backoff=0.05, **kwargs)
+
+    def run_prompts(self, client, prompts, model='gpt-4o'):
+        async def run():
+            return await asyncio.gather(*(client.complete(model, prompt) for prompt in prompts))
+        return asyncio.run(run())
+
+    def test_identical_prompts_in_flight_are_sent_once(self):
+        with self.make_client() as client:
+            responses = self.run_prompts(client, ['hello'] * 5 + ['world'])
+        self.assertEqual(responses, ['echo: hello'] * 5 + ['echo: world'])
+        self.assertEqual(sorted(prompt for _, prompt in self.server.requests), ['hello', 'world'])
+        self.assertEqual(client.stats['coalesced'], 4)
+
+    def test_concurrency_and_rate_limits(self):
+        prompts = [f'prompt {i}' for i in range(12)]
+        with self.make_client(max_concurrency=2, requests_per_second=20.0, burst=1) as client:
+            t0 = time.monotonic()
+            responses = self.run_prompts(client, prompts)
+            duration = time.monotonic() - t0
+        self.assertEqual(responses, [f'echo: {prompt}' for prompt in prompts])
+        self.assertLessEqual(self.server.max_in_flight, 2)
+        # one request every 50 ms after the first
+        self.assertGreaterEqual(duration, 11 * 0.05 * 0.9)
+
+    def test_retry_after_is_honored(self):
+        self.server.failures['slow down'] = [(429, {'Retry-After': '1'})]
+        self.server.failures['flaky'] = [(503, {}), (502, {})]
+        self.server.failures['bad request'] = [(400, {})]
+        with self.make_client() as client:
+            self.assertEqual(self.run_prompts(client, ['slow down', 'flaky']), ['echo: slow down', 'echo: flaky'])
+            with self.assertRaises(Exception):
+                self.run_prompts(client, ['bad request'])
+        times = [t for t, prompt in self.server.requests if prompt == 'slow down']
+        self.assertEqual(len(times), 2)
+        self.assertGreaterEqual(times[1] - times[0], 0.95)
+        self.assertEqual(len([prompt for _, prompt in self.server.requests if prompt == 'flaky']), 3)
+        self.assertEqual(client.stats['retries'], 3)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('3'), 3.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertAlmostEqual(parse_retry_after(time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 60))),
+                               60, delta=2)
+
+    def test_default_providers(self):
+        # OPENAI_API_URL is the server of the other models, not the proxy of the GPT models
+        with mock.patch.dict(os.environ, {'OPENAI_API_URL': self.server.url}):
+            os.environ.pop('GPT_API_URL', None)
+            providers = default_providers()
+        self.assertEqual(providers['gpt'].base_url, DEFAULT_GPT_API_URL)
+        self.assertEqual(providers['llm'].base_url, self.server.url)
+
+    def test_query_a_list_output(self):
+        os.environ['LLM_CACHE_DISABLED'] = '1'
+        os.environ['GPT_API_URL'] = self.server.url
+        # the invalid json is asked again
+        self.server.answers['prompt 3'] = ['not json', '```json\n{"id": 3}```']
+        prompts = [f'prompt {i}' for i in range(6)]
+        for i in [0, 1, 2, 4, 5]:
+            self.server.answers[prompts[i]] = [json.dumps({'id': i})]
+        output_file = os.path.join(self.output_dir, 'answers.json')
+        try:
+            results = MultiProcessingQuery(output_file, 'gpt-4o', is_json=True).query_a_list(prompts, worker_num=3)
+        finally:
+            del os.environ['LLM_CACHE_DISABLED']
+            del os.environ['GPT_API_URL']
+        self.assertEqual([json.loads(result) for result in results], [{'id': i} for i in range(6)])
+        with open(output_file) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(sorted(key for line in lines for key in line), [str(i) for i in range(6)])
+        self.assertLessEqual(self.server.max_in_flight, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,9 @@ import subprocess
 import logging
 import re
 import shlex
+import threading
+import queue
+import uuid
 from .adapter import Adapter
 import time
 try:
@@ -18,6 +21,91 @@ class ADBException(Exception):
     pass
 
 
+class ADBShellSession(object):
+    """
+    A long-lived `adb shell` process that runs commands one after another,
+    so that a shell command does not cost a fork/exec of adb on the host.
+    Each command is followed by an end marker carrying its exit code.
+    """
+    def __init__(self, serial, timeout=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.serial = serial
+        self.timeout = timeout
+        self.marker = ("__ADB_SHELL_SESSION_%s__" % uuid.uuid4().hex).encode()
+        self.process = None
+        self.lines = None
+        self.lock = threading.Lock()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def open(self):
+        self.process = subprocess.Popen(["adb", "-s", self.serial, "shell"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.lines = queue.Queue()
+        listen_thread = threading.Thread(target=self.read_output, args=(self.process, self.lines))
+        listen_thread.daemon = True
+        listen_thread.start()
+
+    def close(self):
+        if self.process is not None:
+            self.process.kill()
+        self.process = None
+
+    @staticmethod
+    def read_output(process, lines):
+        for line in iter(process.stdout.readline, b''):
+            lines.put(line)
+        # EOF, the shell is gone
+        lines.put(None)
+
+    def run(self, cmd_line, timeout=None):
+        """
+        run a command line in the session
+        :param cmd_line: str, the command line, as `adb shell` would receive it
+        :param timeout: seconds to wait for the command to finish, the session is closed on timeout,
+            by default the timeout of the session, None to wait as long as the command runs
+        :return: output of the command
+        raises OSError if the command could not be sent to the shell, in which case it did not run,
+        ADBException if the shell exits before the command finishes or on timeout
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self.lock:
+            # the group keeps commands from reading the following ones from stdin
+            script = "{ %s\n} </dev/null\nprintf '\\n%%s %%s\\n' %s \"$?\"\n" % (cmd_line, self.marker.decode())
+            try:
+                if not self.is_alive():
+                    self.open()
+                self.process.stdin.write(script.encode())
+                self.process.stdin.flush()
+            except OSError:
+                self.close()
+                raise
+
+            output = []
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                try:
+                    line = self.lines.get(timeout=None if deadline is None else max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    self.close()
+                    raise ADBException("adb shell session timed out after %ss: %s" % (timeout, cmd_line))
+                if line is None:
+                    # the command may have run, it is not sent again
+                    self.close()
+                    raise ADBException("adb shell session closed: %s" % cmd_line)
+                if line.startswith(self.marker):
+                    return_code = int(line[len(self.marker):].strip() or 0)
+                    break
+                output.append(line)
+
+        r = b''.join(output).strip().decode()
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, cmd_line, output=r)
+        return r
+
+
 class ADB(Adapter):
     """
     interface of ADB
@@ -33,11 +121,12 @@ class ADB(Adapter):
     RO_SECURE_PROPERTY = 'ro.secure'
     RO_DEBUGGABLE_PROPERTY = 'ro.debuggable'
 
-    def __init__(self, device=None):
+    def __init__(self, device=None, use_shell_session=True):
         """
         initiate a ADB connection from serial no
         the serial no should be in output of `adb devices`
         :param device: instance of Device
+        :param use_shell_session: run shell commands in a persistent `adb shell`, instead of one adb process each
         :return:
         """
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -47,6 +136,7 @@ class ADB(Adapter):
         self.device = device
 
         self.cmd_prefix = ['adb', "-s", device.serial]
+        self.shell_session = ADBShellSession(device.serial) if use_shell_session else None
 
     def run_cmd(self, extra_args):
         """
@@ -61,6 +151,18 @@ class ADB(Adapter):
             self.logger.warning(msg)
             raise ADBException(msg)
 
+        if self.shell_session is not None and len(extra_args) > 1 and extra_args[0] == "shell":
+            # adb joins the shell arguments with spaces, do the same for the session
+            cmd_line = " ".join(extra_args[1:])
+            if "\n" not in cmd_line:
+                try:
+                    self.logger.debug('session command:')
+                    self.logger.debug(cmd_line)
+                    return self.shell_session.run(cmd_line)
+                except OSError as e:
+                    # the command could not be sent, e.g. adb exited, fall back to a new process
+                    self.logger.warning("adb shell session failed, fall back to subprocess: %s" % e)
+
         args = [] + self.cmd_prefix
         args += extra_args
 
@@ -107,6 +209,8 @@ class ADB(Adapter):
         """
         disconnect adb
         """
+        if self.shell_session is not None:
+            self.shell_session.close()
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
     def get_property(self, property_name):
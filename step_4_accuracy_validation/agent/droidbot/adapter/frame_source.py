@@ -0,0 +1,257 @@
+import io
+import time
+import uuid
+import struct
+import logging
+import threading
+import subprocess
+from collections import deque
+
+from .adapter import Adapter
+
+# the frames kept in memory, older frames are dropped
+FRAME_BUFFER_SIZE = 8
+
+# width, height and pixel format at the start of the raw output of screencap, followed by the color space since
+# android 9 (the size of the header is measured on the device)
+RAW_HEADER = struct.Struct('<III')
+# android PixelFormat: (bytes per pixel, PIL raw mode)
+RAW_PIXEL_FORMATS = {
+    1: (4, 'RGBA'),  # RGBA_8888
+    2: (4, 'RGBX'),  # RGBX_8888
+    3: (3, 'RGB'),  # RGB_888
+}
+
+
+class FrameSourceException(Exception):
+    """
+    Exception in the capture of a frame
+    """
+    pass
+
+
+class Frame(object):
+    """
+    a frame of the screen, kept in memory as it was received
+    """
+
+    def __init__(self, data, timestamp, image_format, width=None, height=None, pixel_format=None, offset=0):
+        """
+        :param data: bytes of the frame
+        :param timestamp: time.time() when the capture of the frame started
+        :param image_format: "jpg" or "png" for encoded frames, "raw" for the pixels of screencap
+        :param width: width of a raw frame
+        :param height: height of a raw frame
+        :param pixel_format: android PixelFormat of a raw frame
+        :param offset: position of the pixels of a raw frame in data
+        """
+        self.data = data
+        self.timestamp = timestamp
+        self.image_format = image_format
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.offset = offset
+
+    def _raw_pixels(self):
+        bytes_per_pixel, _ = RAW_PIXEL_FORMATS[self.pixel_format]
+        return memoryview(self.data)[self.offset:self.offset + self.width * self.height * bytes_per_pixel]
+
+    def to_image(self):
+        """
+        :return: PIL.Image of the frame, sharing the memory of a raw frame
+        """
+        from PIL import Image
+        if self.image_format != "raw":
+            return Image.open(io.BytesIO(self.data))
+        _, raw_mode = RAW_PIXEL_FORMATS[self.pixel_format]
+        image_mode = "RGBA" if raw_mode == "RGBA" else "RGB"
+        return Image.frombuffer(image_mode, (self.width, self.height), self._raw_pixels(), "raw", raw_mode, 0, 1)
+
+    def to_array(self, bgr=False):
+        """
+        :param bgr: if True, the channels are in the BGR order of opencv
+        :return: numpy.ndarray of shape (height, width, 3), a read-only view of a raw frame in the RGB order
+        """
+        import numpy as np
+        if self.image_format == "raw":
+            bytes_per_pixel, _ = RAW_PIXEL_FORMATS[self.pixel_format]
+            pixels = np.frombuffer(self._raw_pixels(), dtype=np.uint8)
+            img = pixels.reshape(self.height, self.width, bytes_per_pixel)[:, :, :3]
+        else:
+            with self.to_image() as image:
+                img = np.asarray(image.convert("RGB"))
+        if bgr:
+            return np.ascontiguousarray(img[:, :, ::-1])
+        return img
+
+    def encode(self):
+        """
+        :return: (bytes of the encoded frame, file extension), a raw frame is encoded as png
+        """
+        if self.image_format != "raw":
+            return bytes(self.data), ".%s" % self.image_format
+        output = io.BytesIO()
+        # favor speed, the screenshots may be recompressed by the artifact store
+        self.to_image().save(output, format="PNG", compress_level=1)
+        return output.getvalue(), ".png"
+
+
+class FrameBuffer(object):
+    """
+    ring buffer of the latest frames
+    """
+
+    def __init__(self, size=FRAME_BUFFER_SIZE):
+        self.frames = deque(maxlen=size)
+        self.condition = threading.Condition()
+
+    def put(self, frame):
+        with self.condition:
+            self.frames.append(frame)
+            self.condition.notify_all()
+
+    def latest(self):
+        """
+        :return: the latest frame, None if no frame was received
+        """
+        with self.condition:
+            return self.frames[-1] if self.frames else None
+
+    def wait_for(self, since, timeout):
+        """
+        wait for a frame captured after a time
+        :param since: time.time() before which the frames are too old
+        :param timeout: seconds to wait
+        :return: the frame, None on timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.frames and self.frames[-1].timestamp >= since, timeout)
+            frame = self.frames[-1] if self.frames else None
+        return frame if frame is not None and frame.timestamp >= since else None
+
+    def clear(self):
+        with self.condition:
+            self.frames.clear()
+
+
+class ScreencapStream(Adapter):
+    """
+    captures the raw frames of `screencap` through a persistent `adb shell`, instead of writing a png on the device and
+    pulling it. Falls back to one `adb exec-out screencap` per frame if the shell does not pass binary output through
+    (e.g. the devices without the shell protocol v2, whose shell is a pty).
+    """
+
+    def __init__(self, device=None, buffer_size=FRAME_BUFFER_SIZE):
+        """
+        :param device: instance of Device
+        :param buffer_size: number of the latest frames kept in memory
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if device is None:
+            from droidbot.device import Device
+            device = Device()
+        self.device = device
+        self.frames = FrameBuffer(buffer_size)
+        self.header_size = None
+        self.connected = False
+        self.process = None
+        self.use_pipe = True
+        # echoed after every frame, its line ending tells whether the output is binary safe
+        self.marker = ("__SCREENCAP_%s__" % uuid.uuid4().hex).encode()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        measure the header of the raw frames
+        """
+        try:
+            self.header_size = self._measure_header_size(self._exec_out_capture())
+        except (OSError, subprocess.CalledProcessError, FrameSourceException) as e:
+            self.logger.warning("raw screencap is not available: %s" % e)
+            return
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+        self._close_pipe()
+        self.frames.clear()
+
+    def check_connectivity(self):
+        return self.connected
+
+    @staticmethod
+    def _measure_header_size(data):
+        if len(data) < RAW_HEADER.size:
+            raise FrameSourceException("screencap output is too short: %d bytes" % len(data))
+        width, height, pixel_format = RAW_HEADER.unpack_from(data)
+        if pixel_format not in RAW_PIXEL_FORMATS:
+            raise FrameSourceException("unsupported pixel format: %d" % pixel_format)
+        header_size = len(data) - width * height * RAW_PIXEL_FORMATS[pixel_format][0]
+        if header_size not in [12, 16]:
+            raise FrameSourceException("unexpected screencap output: %d bytes for %dx%d" % (len(data), width, height))
+        return header_size
+
+    def _exec_out_capture(self):
+        return subprocess.check_output(["adb", "-s", self.device.serial, "exec-out", "screencap"])
+
+    def _open_pipe(self):
+        self.process = subprocess.Popen(["adb", "-s", self.device.serial, "shell"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def _close_pipe(self):
+        if self.process is not None:
+            self.process.kill()
+        self.process = None
+
+    def _read_exactly(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            n = self.process.stdout.readinto(view[received:])
+            if not n:
+                raise EOFError("adb shell closed")
+            received += n
+        return data
+
+    def _pipe_capture(self):
+        if self.process is None or self.process.poll() is not None:
+            self._open_pipe()
+        self.process.stdin.write(b"screencap; echo %s\n" % self.marker)
+        self.process.stdin.flush()
+        header = self._read_exactly(self.header_size)
+        width, height, pixel_format = RAW_HEADER.unpack_from(header)
+        if pixel_format not in RAW_PIXEL_FORMATS or width * height == 0:
+            raise FrameSourceException("corrupted screencap header")
+        end = self.marker + b"\n"
+        pixels = self._read_exactly(width * height * RAW_PIXEL_FORMATS[pixel_format][0] + len(end))
+        if pixels[-len(end):] != end:
+            raise FrameSourceException("the output of adb shell is not binary safe")
+        # the frame refers to the received buffer, the header is kept apart
+        return Frame(pixels, None, "raw", width, height, pixel_format)
+
+    def capture(self):
+        """
+        capture a frame and put it in the buffer
+        :return: Frame
+        """
+        with self.lock:
+            timestamp = time.time()
+            frame = None
+            if self.use_pipe:
+                try:
+                    frame = self._pipe_capture()
+                except (OSError, EOFError, FrameSourceException) as e:
+                    self.logger.warning("screencap through adb shell failed, fall back to exec-out: %s" % e)
+                    self._close_pipe()
+                    self.use_pipe = False
+            if frame is None:
+                data = self._exec_out_capture()
+                width, height, pixel_format = RAW_HEADER.unpack_from(data)
+                if pixel_format not in RAW_PIXEL_FORMATS:
+                    raise FrameSourceException("unsupported pixel format: %d" % pixel_format)
+                frame = Frame(data, None, "raw", width, height, pixel_format, offset=self.header_size)
+            frame.timestamp = timestamp
+        self.frames.put(frame)
+        return frame
@@ -0,0 +1,219 @@
+"""
+Content-addressed store of the screenshots and view hierarchies captured during a run.
+
+An artifact is stored once per distinct content, under `<root_dir>/<ref[:2]>/<ref>`, where the reference `ref` is the
+sha256 of the content followed by the file extension. The states keep the references instead of their own copies, and
+every reference is counted: the file is removed when its last reference is released. Traces that need the artifacts at
+their own paths get hard links to the stored files (copies where links are not supported), so identical frames share
+the same disk blocks.
+
+Optionally, the screenshots are deduplicated by their perceptual hash (adapter/cv.calculate_dhash), i.e. a frame with
+the same dHash as a stored frame is not stored again but refers to that frame, and the PNG screenshots are losslessly
+recompressed before they are stored.
+"""
+import io
+import os
+import json
+import shutil
+import hashlib
+import logging
+import weakref
+import tempfile
+import threading
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg']
+
+
+def _is_cv2_available():
+    try:
+        import cv2
+        return True
+    except ImportError:
+        return False
+
+
+def _image_dhash(data):
+    """
+    :return: the dHash of the encoded image, or None if it cannot be decoded
+    """
+    import cv2
+    import numpy as np
+    from .adapter.cv import calculate_dhash
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    return calculate_dhash(img)
+
+
+def _recompress_png(data):
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as img:
+        output = io.BytesIO()
+        img.save(output, format='PNG', optimize=True)
+    recompressed = output.getvalue()
+    return recompressed if len(recompressed) < len(data) else data
+
+
+class ArtifactStore(object):
+    """
+    reference-counted store of artifacts, shared by the threads of a run
+    """
+
+    def __init__(self, root_dir, perceptual_dedupe=False, recompress=False):
+        """
+        :param root_dir: the folder of the stored files
+        :param perceptual_dedupe: if True, a screenshot with the same dHash as a stored one refers to the stored one;
+            requires opencv, ignored otherwise
+        :param recompress: if True, the PNG screenshots are losslessly recompressed before they are stored
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.root_dir = root_dir
+        self.perceptual_dedupe = perceptual_dedupe
+        if perceptual_dedupe and not _is_cv2_available():
+            self.logger.warning("opencv is not installed, the screenshots are only deduplicated by their content")
+            self.perceptual_dedupe = False
+        self.recompress = recompress
+        self._refcounts = {}
+        self._dhash2ref = {}
+        self._ref2dhash = {}
+        # bumped by clear(), the references taken before are not counted anymore
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def path(self, ref):
+        return os.path.join(self.root_dir, ref[:2], ref)
+
+    def put_bytes(self, data, ext):
+        """
+        store the content, or add a reference to the identical content stored before
+        :param ext: the file extension of the content, e.g. '.png'
+        :return: the reference of the stored content
+        """
+        ext = ext.lower()
+        ref = hashlib.sha256(data).hexdigest() + ext
+        with self._lock:
+            if ref in self._refcounts:
+                self._refcounts[ref] += 1
+                return ref
+
+        dhash = None
+        if self.perceptual_dedupe and ext in IMAGE_EXTENSIONS:
+            dhash = _image_dhash(data)
+            with self._lock:
+                similar_ref = self._dhash2ref.get(dhash)
+                if similar_ref is not None:
+                    self._refcounts[similar_ref] += 1
+                    return similar_ref
+        if self.recompress and ext == '.png':
+            data = _recompress_png(data)
+
+        with self._lock:
+            # stored by another thread in the meantime
+            if ref in self._refcounts:
+                self._refcounts[ref] += 1
+                return ref
+            self._write(self.path(ref), data)
+            self._refcounts[ref] = 1
+            if dhash is not None and dhash not in self._dhash2ref:
+                self._dhash2ref[dhash] = ref
+                self._ref2dhash[ref] = dhash
+        return ref
+
+    def put_file(self, file_path, move=True):
+        """
+        store the content of a file
+        :param move: if True, the file is removed once stored
+        :return: the reference of the stored content
+        """
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        ref = self.put_bytes(data, os.path.splitext(file_path)[1])
+        if move:
+            os.remove(file_path)
+        return ref
+
+    def put_json(self, obj, **kwargs):
+        """
+        store an object serialized to json
+        :param kwargs: the arguments of json.dumps
+        :return: the reference of the stored json
+        """
+        return self.put_bytes(json.dumps(obj, **kwargs).encode('utf-8'), '.json')
+
+    def retain(self, ref):
+        with self._lock:
+            self._refcounts[ref] += 1
+
+    def release(self, ref):
+        """
+        drop a reference, the stored file is removed with its last reference
+        """
+        with self._lock:
+            self._release(ref)
+
+    def release_with(self, obj, ref):
+        """
+        drop a reference once obj is garbage collected, unless the store is cleared before
+        :return: the weakref.finalize of obj, calling it drops the reference right away
+        """
+        with self._lock:
+            generation = self._generation
+        return weakref.finalize(obj, self._release_from, generation, ref)
+
+    def _release_from(self, generation, ref):
+        with self._lock:
+            # the same content stored again after clear() has a new count, which this reference is not part of
+            if generation == self._generation:
+                self._release(ref)
+
+    def _release(self, ref):
+        if ref not in self._refcounts:
+            return
+        self._refcounts[ref] -= 1
+        if self._refcounts[ref] > 0:
+            return
+        del self._refcounts[ref]
+        dhash = self._ref2dhash.pop(ref, None)
+        if dhash is not None:
+            del self._dhash2ref[dhash]
+        # removed under the lock, so that a put_bytes of the same content writes it again afterwards
+        try:
+            os.remove(self.path(ref))
+        except OSError as e:
+            self.logger.warning("failed to remove %s: %s" % (ref, e))
+
+    def link(self, ref, dest_path):
+        """
+        make the stored content available at dest_path, replacing the file there
+        """
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(self.path(ref), dest_path)
+        except OSError:
+            shutil.copyfile(self.path(ref), dest_path)
+
+    def clear(self):
+        """
+        remove all stored files, the references still held are ignored
+        """
+        with self._lock:
+            self._generation += 1
+            self._refcounts.clear()
+            self._dhash2ref.clear()
+            self._ref2dhash.clear()
+            if os.path.exists(self.root_dir):
+                shutil.rmtree(self.root_dir)
+
+    @staticmethod
+    def _write(path, data):
+        dir_path = os.path.dirname(path)
+        os.makedirs(dir_path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
@@ -0,0 +1,66 @@
+"""
+Background writer of the artifacts dumped after the actions, so that writing them overlaps with the next actions.
+
+The jobs are run one at a time, in the order they are submitted, by a single thread. The queue of pending jobs is
+bounded: submitting a job waits while the queue is full, so a device that produces dumps faster than they are written
+is held back instead of piling up the captured states in memory.
+"""
+import time
+import queue
+import logging
+import threading
+import traceback
+
+# the jobs waiting to be written, beyond which submit() blocks
+DEFAULT_QUEUE_SIZE = 4
+
+
+class BackgroundWriter(object):
+    """
+    bounded queue of jobs run by a background thread
+    """
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, name='background-writer'):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, job, on_done=None):
+        """
+        queue a job, waiting while the queue is full
+        :param job: callable without arguments
+        :param on_done: on_done(seconds) called once the job is run, with the seconds it took, even if it failed
+        :return: the seconds spent waiting for a free slot in the queue
+        """
+        t0 = time.time()
+        self._jobs.put((job, on_done))
+        return time.time() - t0
+
+    def flush(self):
+        """
+        wait until the jobs submitted so far are run
+        """
+        self._jobs.join()
+
+    def close(self):
+        self.flush()
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                self._jobs.task_done()
+                return
+            job, on_done = item
+            t0 = time.time()
+            try:
+                job()
+            except Exception as e:
+                self.logger.warning("failed to write: %s\n%s" % (e, traceback.format_exc()))
+            finally:
+                if on_done is not None:
+                    on_done(time.time() - t0)
+                self._jobs.task_done()
@@ -10,6 +10,7 @@ from lxml import etree
 
 
 import tools as tools
+from . import trace_log
 from .utils_v1.bug_processor import BugProcessorv2
 from .utils_v1.solution_generator import SolutionGenerator
 from .ui_apis import *
@@ -273,7 +274,7 @@ class InputManager(object):
                         tools.dump_json_file('tmp/line_mappings.json', line_mappings)
                         # in case some silly scripts include no UI actions at all, we make an empty log for batch_verifying
                         log_path = os.path.join(self.device.output_dir, f'log_{self.task_id}.yaml')
-                        tools.dump_yaml_file(log_path, {'records': [], 'step_num': 0})
+                        trace_log.reset_trace(log_path)
 
                         try:
                             # sys.settrace(tracefunc)
@@ -286,6 +287,8 @@ class InputManager(object):
                             error_info = process_error_info(code, code_script, tb_str, str(e), line_mappings)
 
                             tools.dump_json_file(error_path, error_info)
+                            # the bug processor reads the legacy log
+                            trace_log.close_trace(log_path)
 
                             bug_processor = BugProcessorv2(app_name='Notes', log_path=log_path, error_log_path=error_path, task=tools.load_txt_file('tmp/task.txt'), raw_solution=tools.load_txt_file('tmp/code.txt'), apis_path='output/notes0503/apis.json', api_xpath_file='tmp/api_xpaths_checked.json')
 
@@ -0,0 +1,235 @@
+"""
+Append-only trace of the actions logged during a run, replacing the rewrite of the whole log.yaml on every action.
+
+The records of a log `<name>.yaml` are appended to `<name>.trace.jsonl`, one json object per line. The large fields
+(the HTML of the state, the skeleton, the prompt) are stored once per distinct content, as blob lines keyed by their
+md5, and referenced by the records. The records are buffered and written by a background thread. When the trace is
+closed (or the process exits), it is converted to the legacy `<name>.yaml` layout ({'step_num': n, 'records': [...]})
+read by the bug processors and the evaluators. To convert a trace left by a crashed run:
+
+    python -m agent.droidbot.trace_log <name>.trace.jsonl
+"""
+import os
+import json
+import time
+import atexit
+import hashlib
+import logging
+import argparse
+import threading
+
+import yaml
+
+TRACE_SUFFIX = '.trace.jsonl'
+# the fields of the records stored as deduplicated blobs
+BLOB_FIELDS = ['State', 'skeleton', 'raw_prompt']
+# Write the buffered records every second.
+FLUSH_INTERVAL_SECONDS = 1.0
+
+_writers = {}
+_writers_lock = threading.Lock()
+_flusher = None
+
+
+def get_trace_path(log_path):
+    return os.path.splitext(log_path)[0] + TRACE_SUFFIX
+
+
+def _to_json(value):
+    # e.g. numpy integers of the element ids
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+def _dump_legacy_log(log_path, records):
+    with open(log_path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump({'step_num': len(records), 'records': records}, f)
+
+
+class TraceWriter(object):
+    """
+    buffered writer of the trace of one log, see get_trace_writer()
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.trace_path = get_trace_path(log_path)
+        self.num_records = 0
+        self._blob_hashes = set()
+        self._pending = []
+        self._lock = threading.Lock()
+        # keeps the records in order when the background thread and a reader flush at the same time
+        self._write_lock = threading.Lock()
+
+        if os.path.exists(self.trace_path):
+            # continue the trace of a previous run
+            for line in self._read_lines(self.trace_path):
+                if 'blob' in line:
+                    self._blob_hashes.add(line['blob'])
+                else:
+                    self.num_records += 1
+        elif os.path.exists(log_path):
+            # continue a legacy log
+            with open(log_path, 'r', encoding='utf-8') as f:
+                legacy_log = yaml.safe_load(f) or {}
+            for record in legacy_log.get('records', []):
+                self.append(record)
+        else:
+            # the log exists as soon as something is logged, as it used to
+            _dump_legacy_log(log_path, [])
+
+    def append(self, record):
+        with self._lock:
+            self._pending.append(record)
+            self.num_records += 1
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                records, self._pending = self._pending, []
+            if not records:
+                return
+            lines = []
+            new_blob_hashes = set()
+            for record in records:
+                record = dict(record)
+                blobs = {}
+                for field in BLOB_FIELDS:
+                    if not isinstance(record.get(field), str):
+                        continue
+                    data = record.pop(field)
+                    blob_hash = hashlib.md5(data.encode('utf-8')).hexdigest()
+                    if blob_hash not in self._blob_hashes and blob_hash not in new_blob_hashes:
+                        new_blob_hashes.add(blob_hash)
+                        lines.append(json.dumps({'blob': blob_hash, 'data': data}))
+                    blobs[field] = blob_hash
+                lines.append(json.dumps({'record': record, 'blobs': blobs}, default=_to_json))
+            with open(self.trace_path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            self._blob_hashes.update(new_blob_hashes)
+
+    def discard(self):
+        """
+        drop the records not written yet, and wait for the records being written
+        """
+        with self._write_lock:
+            with self._lock:
+                self._pending = []
+
+    def close(self):
+        """
+        write the remaining records, and the legacy log
+        """
+        self.flush()
+        _dump_legacy_log(self.log_path, load_trace(self.trace_path))
+
+    @staticmethod
+    def _read_lines(trace_path):
+        with open(trace_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # the last line of a crashed run may be incomplete
+                    continue
+
+
+def load_trace(trace_path):
+    """
+    :return: list of the records of the trace, in the legacy layout
+    """
+    blobs = {}
+    records = []
+    for line in TraceWriter._read_lines(trace_path):
+        if 'blob' in line:
+            blobs[line['blob']] = line['data']
+            continue
+        record = line['record']
+        for field, blob_hash in line['blobs'].items():
+            record[field] = blobs[blob_hash]
+        records.append(record)
+    return records
+
+
+def _flush_all():
+    while True:
+        time.sleep(FLUSH_INTERVAL_SECONDS)
+        with _writers_lock:
+            writers = list(_writers.values())
+        for writer in writers:
+            try:
+                writer.flush()
+            except Exception as e:
+                logging.getLogger('TraceWriter').warning(f'failed to write {writer.trace_path}: {e}')
+
+
+def get_trace_writer(log_path):
+    """
+    :return: the writer of the trace of the legacy log at log_path, shared by all callers in the process
+    """
+    global _flusher
+    key = os.path.abspath(log_path)
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = TraceWriter(log_path)
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_all, name='trace-flusher', daemon=True)
+            _flusher.start()
+        return _writers[key]
+
+
+def close_trace(log_path):
+    """
+    write everything logged to log_path so far, including the legacy log
+    """
+    with _writers_lock:
+        writer = _writers.pop(os.path.abspath(log_path), None)
+    if writer is not None:
+        writer.close()
+
+
+def reset_trace(log_path):
+    """
+    start an empty log at log_path, dropping what was logged there before
+    """
+    with _writers_lock:
+        writer = _writers.pop(os.path.abspath(log_path), None)
+    if writer is not None:
+        writer.discard()
+    trace_path = get_trace_path(log_path)
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+    _dump_legacy_log(log_path, [])
+
+
+def load_log(log_path):
+    """
+    read the log at log_path in the legacy layout, including the records not converted to it yet
+    """
+    with _writers_lock:
+        writer = _writers.get(os.path.abspath(log_path))
+    if writer is not None:
+        writer.flush()
+    trace_path = get_trace_path(log_path)
+    if not os.path.exists(trace_path):
+        with open(log_path, 'r', encoding='utf-8') as f:
+            return yaml.safe_load(f)
+    records = load_trace(trace_path)
+    return {'step_num': len(records), 'records': records}
+
+
+@atexit.register
+def close_all_traces():
+    with _writers_lock:
+        log_paths = [writer.log_path for writer in _writers.values()]
+    for log_path in log_paths:
+        close_trace(log_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert traces to the legacy yaml logs.")
+    parser.add_argument('trace_paths', nargs='+')
+    args = parser.parse_args()
+    for trace_path in args.trace_paths:
+        log_path = trace_path[:-len(TRACE_SUFFIX)] + '.yaml'
+        _dump_legacy_log(log_path, load_trace(trace_path))
+        print(f'{trace_path} -> {log_path}')
@@ -1,7 +1,7 @@
 import json
 import os
-import multiprocessing
-import tools as tools
+import asyncio
+from llm_client import LLMClient
 
 class MultiProcessingQuery:
 
@@ -38,31 +38,13 @@ class MultiProcessingQuery:
       print("Error decoding JSON.")
     return results
 
-  def query_llm(self, prompt):
-    try:
-      if self.model in self.gpt_models:
-        answer = tools.query_gpt(prompt, model_name=self.model)
-      elif self.model in self.claude_models:
-        answer = tools.query_claude(prompt, model_name=self.model)
-      else:
-        answer = tools.query_llm(prompt, model_name=self.model)
-      return answer
-    except Exception as e:
-      raise e
-
-  def save_to_json(self, key, result):
-    with open(self.output_file, "a") as f:
-      json.dump({key: result}, f)
-      f.write("\n") 
-
-  def process_func(self, key_value):
-    key, value = key_value
-    
+  async def process_prompt(self, client, key, prompt):
     retry = 0
     err = None
     while retry < self.json_retry:
       try:
-        res = self.query_llm(value)
+        # the responses are cached by the client, a retry asks the model again
+        res = await client.complete(self.model, prompt, refresh=retry > 0)
         
         if self.is_json and isinstance(res, str):
           res = res.strip()
@@ -89,18 +71,25 @@ class MultiProcessingQuery:
       print(f"Error processing {key=}: {err}")
       result = None
     
-    self.save_to_json(key, result)
+    return result
+
+  async def _query_all_dicts(self, dict_questions, worker_num):
+    # worker_num bounds the requests in flight to each provider, as the processes of the former pool did
+    with LLMClient(max_concurrency=worker_num) as client, open(self.output_file, "a") as f:
+
+      async def process(key, prompt):
+        result = await self.process_prompt(client, key, prompt)
+        # every result is written as soon as it is received
+        f.write(json.dumps({key: result}) + "\n")
+        f.flush()
+
+      await asyncio.gather(*(process(key, prompt) for key, prompt in dict_questions.items()))
 
   def query_all_dicts(self, dict_questions, worker_num=4):
-    pool = multiprocessing.Pool(processes=worker_num)
     try:
-      with pool:
-        pool.map(self.process_func, dict_questions.items())
+      asyncio.run(self._query_all_dicts(dict_questions, worker_num))
     except KeyboardInterrupt:
-      pool.close()
-      pool.terminate()
-      pool.join()
-      exit(1) # still need to exit the program by ps -a and kill -9
+      exit(1)
 
   def convert_list_to_dict(self, list_questions):
     return {str(i): question for i, question in enumerate(list_questions)}
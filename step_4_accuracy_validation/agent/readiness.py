@@ -0,0 +1,100 @@
+"""
+Readiness of the emulator after it is started or restored from a snapshot, polled instead of fixed sleeps.
+
+Every wait returns as soon as its probe holds, or False once its deadline is over, so a slow device still gets the
+time it needs while a fast one is not held back:
+
+  - the emulator console reports the virtual device running (the snapshot load is over),
+  - adb is online and sys.boot_completed is set,
+  - the socket of the droidbot app is connected,
+  - the target app is in the foreground.
+"""
+import logging
+import time
+
+POLL_INTERVAL_SECONDS = 0.25
+
+# Deadlines of the waits, generous enough for a cold boot of the emulator.
+BOOT_TIMEOUT_SECONDS = 180
+SNAPSHOT_TIMEOUT_SECONDS = 60
+DROIDBOT_APP_TIMEOUT_SECONDS = 20
+FOREGROUND_TIMEOUT_SECONDS = 20
+
+logger = logging.getLogger('Readiness')
+
+
+def wait_until(probe, timeout: float, interval: float = POLL_INTERVAL_SECONDS, name: str = None) -> bool:
+  """Polls `probe` until it returns True or `timeout` seconds passed.
+
+  The probes may raise while the device is going offline or online, which counts as not ready.
+
+  Returns:
+    True if the probe held before the deadline, False otherwise.
+  """
+  deadline = time.time() + timeout
+  while True:
+    try:
+      if probe():
+        return True
+    except Exception as e:
+      logger.debug(f"{name or probe.__name__} probe failed: {e}")
+    now = time.time()
+    if now >= deadline:
+      logger.warning(f"{name or probe.__name__} not ready after {timeout}s")
+      return False
+    time.sleep(min(interval, deadline - now))
+
+
+class DeviceReadiness():
+  """the readiness probes of an emulator, and of the droidbot device connected to it once there is one"""
+
+  def __init__(self, emulator_controller, device=None):
+    self.emulator_controller = emulator_controller
+    self.device = device
+
+  def wait_for_boot(self, timeout: float = BOOT_TIMEOUT_SECONDS) -> bool:
+    return wait_until(self.emulator_controller.is_boot_completed, timeout, name='boot')
+
+  def wait_for_snapshot(self, timeout: float = SNAPSHOT_TIMEOUT_SECONDS) -> bool:
+    """Waits for the emulator to run again after a snapshot load, and for adb to be back."""
+    deadline = time.time() + timeout
+    return wait_until(self.emulator_controller.is_running, timeout, name='snapshot load') \
+        and wait_until(self.emulator_controller.is_boot_completed, max(deadline - time.time(), 0), name='boot')
+
+  def wait_for_droidbot_app(self, timeout: float = DROIDBOT_APP_TIMEOUT_SECONDS) -> bool:
+    droidbot_app = self.device.droidbot_app
+    if not (droidbot_app and self.device.adapters[droidbot_app]):
+      return True
+    # the socket is marked connected by the listening thread started in connect()
+    return wait_until(droidbot_app.check_connectivity, timeout, name='droidbot app')
+
+  def wait_for_foreground(self, app, timeout: float = FOREGROUND_TIMEOUT_SECONDS) -> bool:
+    """
+    Args:
+      app: instance of App, or str of package name
+    """
+    return wait_until(lambda: self.device.is_foreground(app), timeout, name='foreground app')
+
+
+class ResetTimer():
+  """the latency of a reset of the environment, split into its phases"""
+
+  def __init__(self):
+    self.start = time.time()
+    self._last = self.start
+    self.phases = {}
+    self.ready = True
+
+  def lap(self, phase: str, ready: bool = True) -> None:
+    now = time.time()
+    self.phases[phase] = round(now - self._last, 3)
+    self._last = now
+    self.ready = self.ready and ready
+
+  def as_dict(self) -> dict:
+    return {
+        'seconds': round(self._last - self.start, 3),
+        'phases': self.phases,
+        # False if a wait reached its deadline, the device may not have been ready
+        'ready': self.ready,
+    }
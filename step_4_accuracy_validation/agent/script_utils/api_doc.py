@@ -1,9 +1,11 @@
 import json
 import re
 import datetime
+from collections.abc import Mapping
 import agent.environment as environment
 
 from agent.droidbot.device_state import HTMLSkeleton, ElementTree, EleAttr
+from agent.script_utils import compiled_doc
 
 UI_SCREEN_ELEMENT_DELIMITER = '__'
 class DependentAction():
@@ -82,6 +84,18 @@ class DependentAction():
     else:
       raise print(f'Unknown action type: {self.action_type} in {action}')
 
+  def to_dict(self):
+    return dict(vars(self))
+
+  @classmethod
+  def from_dict(cls, attributes: dict):
+    '''
+    restore an action parsed before, without parsing it again
+    '''
+    action = cls.__new__(cls)
+    action.__dict__.update(attributes)
+    return action
+
   @staticmethod
   def _extract_arguments(sentence):
     # This regex will match arguments, including those within quotes
@@ -118,7 +132,11 @@ class DependentAction():
 
 class ApiEle():
 
-  def __init__(self, screen_name: str, raw: dict):
+  def __init__(self, screen_name: str, raw: dict, dependency_action: list[list[DependentAction]] = None):
+    '''
+    @param dependency_action: the actions of the paths parsed before, e.g. by the compiled doc
+    '''
+    self.raw = raw
     self.id = raw.get('id', None)
     self.element: str = raw['element']
     self.type: str = raw['type']
@@ -132,6 +150,10 @@ class ApiEle():
     self.paths: list[list[str]] = raw.get('paths', [])
     self.dependency_action: list[list[DependentAction]] = []
 
+    if dependency_action is not None:
+      self.dependency_action = dependency_action
+      return
+
     for path in self.paths:
       _path_actions = []
       for action in path:
@@ -153,20 +175,63 @@ class ApiEle():
     }
 
 
+class _LazyMapping(Mapping):
+  '''
+  read-only mapping with known keys, whose values are only loaded on their first access
+  '''
+
+  def __init__(self, keys: list, load):
+    self._keys = list(keys)
+    self._key_set = set(self._keys)
+    self._load = load
+    self._values = {}
+
+  def __getitem__(self, key):
+    if key not in self._values:
+      if key not in self._key_set:
+        raise KeyError(key)
+      self._values[key] = self._load(key)
+    return self._values[key]
+
+  def __iter__(self):
+    return iter(self._keys)
+
+  def __len__(self):
+    return len(self._keys)
+
+
 class ApiDoc():
 
-  def __init__(self, doc_path: str):
+  def __init__(self, doc_path: str, use_compiled: bool = True):
+    '''
+    @param use_compiled: load the compiled doc next to doc_path if it is up to date, or compile it
+    '''
     self.doc_path = doc_path
-    self.doc: dict[str, dict[str, ApiEle]] = {} # screen_name -> api_name -> ApiEle
+    self.doc: Mapping[str, dict[str, ApiEle]] = {} # screen_name -> api_name -> ApiEle
     self.api_xpath: dict[str, str] = {}
-    self.elements: list[ApiEle] = []
     self.skeleton_str2screen_name: dict[str, str] = {}
-    self.screen_name2skeleton: dict[str, HTMLSkeleton] = {}
+    self.screen_name2raw_skeleton: dict[str, str] = {}
+    self.screen_name2skeleton: Mapping[str, HTMLSkeleton] = {}
+    # the fingerprint of every screen, see HTMLSkeleton.tag_paths
+    self.screen_name2tag_paths: dict[str, frozenset[str]] = {}
+    # screens ordered by the number of tags in their skeleton, largest first, for pruning the nearest-screen search
+    self.screen_names_by_size: list[str] = []
+    self.screen_name2order: dict[str, int] = {}
+    self._all_element_desc: dict[bool, str] = {}
 
     self.is_updated = False
     
     self.main_screen: str = None
-    self._load_api_doc()
+    compiled_path = compiled_doc.get_compiled_path(doc_path)
+    if use_compiled and compiled_doc.is_up_to_date(doc_path, compiled_path):
+      self._load_compiled_doc(compiled_path)
+    else:
+      self._load_api_doc()
+      if use_compiled:
+        try:
+          compiled_doc.write_compiled_doc(self, compiled_path)
+        except OSError as e:
+          print(f'Failed to compile {doc_path}: {e}')
 
   def _load_api_doc(self):
     raw_api_doc = json.load(open(self.doc_path, 'r'))
@@ -176,19 +241,57 @@ class ApiDoc():
       if not self.main_screen:
         self.main_screen = k # first screen is the main screen
 
+      self.screen_name2raw_skeleton[k] = v['skeleton']
       self.screen_name2skeleton[k] = HTMLSkeleton(v['skeleton'])
       self.skeleton_str2screen_name[v['skeleton']] = k
       _elements = {}
       for k_ele, v_ele in v['elements'].items():
         ele = ApiEle(k, v_ele)
         _elements[k_ele] = ele
-        self.elements.append(ele)
         self.api_xpath[k_ele] = ele.xpath
       self.doc[k] = _elements
 
+    # build the fingerprint of every screen once
+    self.screen_name2tag_paths = {
+        screen_name: skeleton.tag_paths for screen_name, skeleton in self.screen_name2skeleton.items()
+    }
+    self._sort_screens()
+
     # ! screen and skeleton should be unique (but it's not)
     # assert len(self.skeleton_str2screen_name) == len_screen
 
+  def _load_compiled_doc(self, compiled_path: str):
+    compiled = compiled_doc.CompiledDoc(compiled_path)
+    self.main_screen = compiled.main_screen
+    self.api_xpath = compiled.api_xpath
+    self.screen_name2raw_skeleton = compiled.skeletons
+    for screen_name, skeleton_str in compiled.skeletons.items():
+      self.skeleton_str2screen_name[skeleton_str] = screen_name
+    self.screen_name2tag_paths = compiled.tag_paths
+    self._all_element_desc = compiled.all_element_desc
+
+    def load_screen(screen_name):
+      return {
+          api_name: ApiEle(screen_name, raw, [[DependentAction.from_dict(action) for action in path]
+                                              for path in dependency_action])
+          for api_name, raw, dependency_action in compiled.load_screen(screen_name)
+      }
+
+    self.doc = _LazyMapping(compiled.screen_names, load_screen)
+    self.screen_name2skeleton = _LazyMapping(compiled.screen_names,
+                                             lambda screen_name: HTMLSkeleton(compiled.skeletons[screen_name]))
+    self._sort_screens()
+
+  def _sort_screens(self):
+    self.screen_name2order = {screen_name: idx for idx, screen_name in enumerate(self.screen_name2tag_paths)}
+    self.screen_names_by_size = sorted(
+        self.screen_name2tag_paths,
+        key=lambda name: (-len(self.screen_name2tag_paths[name]), self.screen_name2order[name]))
+
+  @property
+  def elements(self) -> list[ApiEle]:
+    return [ele for elements in self.doc.values() for ele in elements.values()]
+
   def get_api_xpath(self):
     return self.api_xpath
   
@@ -227,13 +330,23 @@ class ApiDoc():
     skeleton_str = skeleton if isinstance(skeleton, str) else skeleton.str
     screen_name = self.skeleton_str2screen_name.get(skeleton_str, None)
     if not screen_name:
+      if isinstance(skeleton, str):
+        skeleton = HTMLSkeleton(skeleton)
       count = 3 # todo::
-      for _screen_name, screen_skeleton in self.screen_name2skeleton.items():
-        common = screen_skeleton.extract_common_skeleton(skeleton)
-        _count = common.count()
+      current_size = len(skeleton.tag_paths)
+      for _screen_name in self.screen_names_by_size:
+        screen_tag_paths = self.screen_name2tag_paths[_screen_name]
+        # the common structure can not be larger than either skeleton
+        if min(len(screen_tag_paths), current_size) < count:
+          break
+        _count = len(screen_tag_paths & skeleton.tag_paths)
         if _count > count:
           count = _count
           screen_name = _screen_name
+        elif _count == count and screen_name is not None and \
+            self.screen_name2order[_screen_name] < self.screen_name2order[screen_name]:
+          # keep the first documented screen on ties, as the linear scan did
+          screen_name = _screen_name
     
     # count is 0, screen_name is None
     return screen_name
@@ -285,7 +398,10 @@ class ApiDoc():
     return elements_desc
   
   def get_all_element_desc(self, is_show_xpath=False):
-    return self._get_element_description(self.elements, is_show_xpath)
+    # the description of all elements is only rendered once, unless their xpaths are fixed
+    if is_show_xpath not in self._all_element_desc or self.is_updated:
+      self._all_element_desc[is_show_xpath] = self._get_element_description(self.elements, is_show_xpath)
+    return self._all_element_desc[is_show_xpath]
   
   def get_current_element_desc(self, state: environment.State, is_show_xpath=False):
     element_tree = state.element_tree
@@ -12,6 +12,7 @@ import agent.agent_utils as agent_utils
 import agent.environment as environment
 
 from agent.droidbot.device_state import ElementTree, EleAttr, DeviceState
+from agent.droidbot import trace_log
 
 from agent.script_utils.api_doc import ApiDoc
 from agent.script_utils.err import XPathError, APIError, ActionError, NotFoundError
@@ -111,17 +112,10 @@ def _save2yaml(file_name,
                screenshot=None):
   if not LOGGING_ENABLED:
     return
-  
-  if not os.path.exists(file_name):
-    tmp_data = {'step_num': 0, 'records': []}
-    with open(file_name, 'w', encoding='utf-8') as f:
-      yaml.dump(tmp_data, f)
-
-  with open(file_name, 'r', encoding='utf-8') as f:
-    old_yaml_data = yaml.safe_load(f)
-  new_records = old_yaml_data['records']
-  new_records.append({
-      'step': len(new_records),
+
+  trace_writer = trace_log.get_trace_writer(file_name)
+  trace_writer.append({
+      'step': trace_writer.num_records,
       'State': state_prompt,
       'Choice': idx,
       'Action': action_type,
@@ -136,14 +130,6 @@ def _save2yaml(file_name,
       'currently_executing_code': currently_executing_code,
       'effect_range': effect_range,
       'screenshot': screenshot})
-  data = {
-      'step_num': len(new_records),
-      'records': new_records
-  }
-  t1 = time.time()
-  with open(file_name, 'w', encoding='utf-8') as f:
-    yaml.safe_dump(data, f)
-  print(f'save to yaml time: {time.time() - t1}')
 
 def _save2log(save_path, 
                log_file: str,
@@ -214,11 +200,12 @@ class CodeStatus:
   def __init__(self):
     # internal
     self.action_count = 0
-    self.last_screen_html_str = None
+    # the digest of the element tree of the last screen, see ElementTree.digest
+    self.last_screen_digest = None
     
   def reset(self):
     self.action_count = 0
-    self.last_screen_html_str = None
+    self.last_screen_digest = None
     
   def check_action_count(self):
     if self.action_count >= MAX_ACTION_COUNT:
@@ -226,13 +213,13 @@ class CodeStatus:
       # pass
     self.action_count += 1
   
-  def check_last_screen(self, screen_html_str: str):
+  def check_last_screen(self, element_tree: ElementTree):
     is_same = False
-    if not self.last_screen_html_str:
-      self.last_screen_html_str = screen_html_str
+    if not self.last_screen_digest:
+      self.last_screen_digest = element_tree.digest
     else:
-      is_same = self.last_screen_html_str == screen_html_str
-      self.last_screen_html_str = screen_html_str
+      is_same = self.last_screen_digest == element_tree.digest
+      self.last_screen_digest = element_tree.digest
     return is_same
 
 
@@ -273,7 +260,7 @@ class Verifier:
   
   @property
   def last_screen(self):
-    return self.status.last_screen_html_str
+    return self.status.last_screen_digest
   
   def get_cached_element_tree(self):
     if self._element_tree:
@@ -288,7 +275,7 @@ class Verifier:
     self.env.wait_for_stable_state()
 
   def check_last_screen_html(self):
-    is_same = self.status.check_last_screen(self.element_tree.str)
+    is_same = self.status.check_last_screen(self.element_tree)
     return is_same
 
   def get_unique_xpath_on_screen(self, api_name, xpaths):
@@ -366,7 +353,7 @@ class Verifier:
                   "view": scrollable_element.view,
                   "direction": scrolling_direction
               })
-          time.sleep(WAIT_AFTER_ACTION_SECONDS)
+          self.env.wait_after_action(WAIT_AFTER_ACTION_SECONDS)
           self.update_state()
 
           is_same = self.check_last_screen_html()
@@ -539,7 +526,7 @@ Please output only answer that is in the format of the json above and nothing el
           # if executable_action.get('action_type') == 'wait':
           #   raise ActionError(f'Fail to {action.action_type}({action.api_name})', None, None, action.action_type, action.api_name)
           self.env.execute_action(executable_action)
-          time.sleep(WAIT_AFTER_ACTION_SECONDS)
+          self.env.wait_after_action(WAIT_AFTER_ACTION_SECONDS)
           self.update_state()
           self.check_last_screen_html()
 
@@ -663,7 +650,7 @@ Please output only answer that is in the format of the json above and nothing el
                 "direction": 'down', # it happens nothing when it is not scrollable,
                 "time_spent_locating": time_spend_locating
             })
-        time.sleep(WAIT_AFTER_ACTION_SECONDS)
+        self.env.wait_after_action(WAIT_AFTER_ACTION_SECONDS)
         self.update_state()
         element_tree = self.element_tree
         target_ele = element_tree.get_ele_by_xpath(xpath)
@@ -683,7 +670,7 @@ Please output only answer that is in the format of the json above and nothing el
     
     executable_action = agent_utils.convert_action(action_type, target_ele, text)
     self.env.execute_action(executable_action)
-    time.sleep(WAIT_AFTER_ACTION_SECONDS)
+    self.env.wait_after_action(WAIT_AFTER_ACTION_SECONDS)
     self.update_state()
     # print(f"action executed {api_name} {target_ele.full_desc}")
     self.check_action_count()
@@ -942,7 +929,7 @@ Please output only answer that is in the format of the json above and nothing el
         screenshot=self.state.screenshot)
 
     self.env.execute_action({"action_type": "enter"})
-    time.sleep(WAIT_AFTER_ACTION_SECONDS)
+    self.env.wait_after_action(WAIT_AFTER_ACTION_SECONDS)
     
     self.check_action_count()
 
@@ -982,13 +969,13 @@ Please output only answer that is in the format of the json above and nothing el
         screenshot=self.state.screenshot)
 
     self.env.execute_action({"action_type": "back"})
-    time.sleep(WAIT_AFTER_ACTION_SECONDS)
+    self.env.wait_after_action(WAIT_AFTER_ACTION_SECONDS)
     
     foreground_activity_name = self.env.foreground_activity_name
     # out of the app
     if foreground_activity_name and foreground_activity_name.startswith('com.google.android.apps.nexuslauncher'):
       self.env.execute_action({"action_type": "open_app", "app_name": self.app_name})
-      time.sleep(WAIT_AFTER_ACTION_SECONDS)
+      self.env.wait_after_action(WAIT_AFTER_ACTION_SECONDS)
     
     self.check_action_count()
 
@@ -1246,7 +1233,7 @@ class ElementList:
                 "view": scrollable_element.view,
                 "direction": direction
             })
-        time.sleep(WAIT_AFTER_ACTION_SECONDS)
+        self.env.wait_after_action(WAIT_AFTER_ACTION_SECONDS)
         self.update_state()
 
         is_same = self.check_last_screen_html()
@@ -1406,7 +1393,7 @@ class ElementList:
     
     executable_action = agent_utils.convert_action(action_type, target_ele, text)
     self.env.execute_action(executable_action)
-    time.sleep(WAIT_AFTER_ACTION_SECONDS)
+    self.env.wait_after_action(WAIT_AFTER_ACTION_SECONDS)
     self.update_state()
     self.check_action_count()
     
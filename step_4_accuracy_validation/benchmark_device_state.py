@@ -0,0 +1,125 @@
+"""
+Micro-benchmark of the DeviceState construction over recorded view dumps.
+
+The dumps are the states saved by droidbot during the exploration (states/state_*.json, or any json file holding a list
+of views or a dict with the "views"), searched recursively under the given folders:
+
+    python benchmark_device_state.py ../step_1_doc_generation/data/*/explore_data
+
+Besides the construction time, the stages that used to be quadratic are timed against their former implementation.
+"""
+import os
+import sys
+import copy
+import glob
+import json
+import time
+import argparse
+import statistics
+
+from agent.droidbot.device_state import DeviceState, EleAttr
+
+DEFAULT_DATA_DIRS = ['../step_1_doc_generation/data/*/explore_data']
+
+
+def load_view_dumps(data_dirs: list[str]) -> list[tuple[str, list[dict]]]:
+    dumps = []
+    for data_dir in data_dirs:
+        for path in sorted(glob.glob(os.path.join(data_dir, '**', '*.json'), recursive=True)):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            views = data.get('views') if isinstance(data, dict) else data
+            if isinstance(views, list) and views and isinstance(views[0], dict) and 'temp_id' in views[0]:
+                dumps.append((path, views))
+    return dumps
+
+
+def _legacy_view_tree(views):
+    # recursive deepcopy of every view
+    def assemble(root_view):
+        for i, j in enumerate(root_view['children']):
+            root_view['children'][i] = copy.deepcopy(views[j])
+            assemble(root_view['children'][i])
+    view_tree = copy.deepcopy(views[0])
+    assemble(view_tree)
+    return view_tree
+
+
+def _legacy_ancestors_properties(views):
+    # walk the ancestors of every view, once per property
+    def get_self_ancestors_property(view, key):
+        while True:
+            if view.get(key):
+                return view[key]
+            parent_id = view.get('parent', -1)
+            if parent_id is None or not 0 <= parent_id < len(views):
+                return None
+            view = views[parent_id]
+    return {key: [get_self_ancestors_property(view, key) for view in views] for key in DeviceState.ANCESTORS_PROPERTIES}
+
+
+def _valid_children(views, enabled_view_ids):
+    for view_id in enabled_view_ids:
+        view = views[view_id]
+        EleAttr(view_id, list(view.get('children', [])), view, views, enabled_view_ids=enabled_view_ids)
+
+
+def _time(func, repeat: int, setup=None) -> float:
+    '''
+    @param setup: called before every run (not timed), its result is passed to func
+    '''
+    durations = []
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        t0 = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - t0)
+    return statistics.median(durations)
+
+
+def benchmark(dumps: list[tuple[str, list[dict]]], repeat: int):
+    totals = {}
+
+    def add(name, duration):
+        totals[name] = totals.get(name, 0.0) + duration
+
+    for path, views in dumps:
+        enabled_view_ids = [view['temp_id'] for view in views if view.get('visible')]
+
+        def new_state():
+            return DeviceState(None, copy.deepcopy(views), 'benchmark', [], [])
+
+        add('construction', _time(lambda state: DeviceState(None, state, 'benchmark', [], []), repeat,
+                                  setup=lambda: copy.deepcopy(views)))
+        add('view tree (before)', _time(lambda: _legacy_view_tree(views), repeat))
+        add('view tree (after)', _time(lambda state: state.view_tree, repeat, setup=new_state))
+        add('ancestor flags (before)', _time(lambda: _legacy_ancestors_properties(views), repeat))
+        add('ancestor flags (after)', _time(lambda state: DeviceState._ancestors_properties.fget.__wrapped__(state), repeat,
+                                            setup=new_state))
+        add('valid children (before)', _time(lambda: _valid_children(views, enabled_view_ids), repeat))
+        add('valid children (after)', _time(lambda: _valid_children(views, set(enabled_view_ids)), repeat))
+
+    print(f'{len(dumps)} view dumps, {sum(len(views) for _, views in dumps)} views, median of {repeat} runs')
+    for name, duration in totals.items():
+        print(f'{name:<28}{duration * 1000:10.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DeviceState construction over recorded view dumps.")
+    parser.add_argument('data_dirs', nargs='*', default=DEFAULT_DATA_DIRS)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    data_dirs = [data_dir for pattern in args.data_dirs for data_dir in glob.glob(pattern)]
+    dumps = load_view_dumps(data_dirs)
+    if not dumps:
+        print(f'no view dumps found in {args.data_dirs}')
+        sys.exit(1)
+    benchmark(dumps, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,10 @@ EMULATOR_AGRS = {
     "port" : "5554",
     # "no-window" : "true",  # Change this to "true" to run the emulator without GUI.
 }
+# Serials of the running emulators the tasks are sharded across, each one needs the snapshot above.
+EMULATOR_POOL = [f"emulator-{EMULATOR_AGRS['port']}"]
+# Generate the solutions of autodroidv2 in batches while the emulators run the tasks.
+BATCH_GENERATION = False
 
 # NO NEED TO CHANGE
 DOC_PATH = "evaluation/droidtask/docs"
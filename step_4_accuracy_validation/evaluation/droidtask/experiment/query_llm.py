@@ -8,16 +8,25 @@ def _get_all_element_names(doc):
             element_num += 1
     return all_elements_desc, element_num
 
-def make_solution_prompt_droidtask_tune(doc, task, app_name, first_screen_elements=None):
+def make_solution_prompt_droidtask_tune(doc, task, app_name, first_screen_elements=None, task_last=False):
+    prefix, suffix = make_solution_prompt_droidtask_tune_parts(doc, task, app_name, first_screen_elements, task_last)
+    return prefix + suffix
+
+def make_solution_prompt_droidtask_tune_parts(doc, task, app_name, first_screen_elements=None, task_last=False):
+    """
+    returns the prompt as (prefix, suffix), the prefix does not depend on the task, so its KV cache can be shared by
+    all tasks of the app. By default the prompt keeps the order autodroidv2 was fine-tuned on and the prefix is only
+    the first paragraph; with task_last the whole app document is the prefix and the task is moved to the end.
+    """
     all_elements_desc, num = _get_all_element_names(doc)
     first_screen_instruction = "" if not first_screen_elements else f"3. Current screen elements: The elements in the current screen, which you can start to interact with. "
     first_screen_statement = '' if not first_screen_elements else f"\nCurrent screen elements: \n{first_screen_elements}\n"
     # tasks_desc = '\t\n'.join([f'{i+1}. {task}' for i, task in enumerate(tasks)])
-    return f'''Imagine that you are a robot operating a smartphone to use the {app_name} app. Like how humans operate the smartphone, you can tap, long tap, input text, scroll, and get attributes of the UI elements in the {app_name} app. You need to write scripts to manipulate the UI elements (buttons, text fields, scrollers, element_lists, etc) in the app. 
-
-**Your ultimate task is: {task}**
+    head = f'''Imagine that you are a robot operating a smartphone to use the {app_name} app. Like how humans operate the smartphone, you can tap, long tap, input text, scroll, and get attributes of the UI elements in the {app_name} app. You need to write scripts to manipulate the UI elements (buttons, text fields, scrollers, element_lists, etc) in the app. 
 
-In the script, you can use the following APIs:
+'''
+    task_statement = f'''**Your ultimate task is: {task}**'''
+    body = f'''In the script, you can use the following APIs:
 - <element_selector>.tap()
 - <element_selector>.tap(<child_element)
 - <element_selector>.set_text(<text>)
@@ -48,6 +57,9 @@ Your answer should follow this JSON format:
 }}
 
 **Note that you should only output the JSON content.**'''
+    if task_last:
+        return head + body, '\n\n' + task_statement
+    return head, task_statement + '\n\n' + body
 
 def make_solution_prompt_droidtask_tune_without_eles(doc, task, app_name, first_screen_elements=None):
     all_elements_desc, num = _get_all_element_names(doc)
@@ -0,0 +1,118 @@
+import os
+import queue
+import time
+import logging
+import threading
+import traceback
+from copy import deepcopy
+
+import pandas
+
+from agent.emulator_controller import EmulatorController
+from agent.readiness import DeviceReadiness
+
+
+class EmulatorDevice():
+  """an emulator of the device pool, restored from its own snapshot before every task"""
+
+  def __init__(self, serial: str, avd_name: str, snapshot: str):
+    self.serial = serial
+    self.snapshot = snapshot
+    port = serial.split('-')[-1]
+    self.emulator_controller = EmulatorController(avd_name=avd_name, device_serial=serial,
+                                                  params={'snapshot': snapshot, 'port': port})
+    self.emulator_controller.attach()
+    self.readiness = DeviceReadiness(self.emulator_controller)
+
+  def reset(self):
+    self.emulator_controller.reload_snapshot(self.snapshot)
+    # the device is usable once the snapshot is loaded and adb is back
+    self.readiness.wait_for_snapshot()
+
+
+class TaskScheduler():
+  """
+  shard tasks across a pool of devices, one worker per device.
+
+  The devices only need a `serial` and a `reset()` that restores the device to the initial state of a task, so the
+  scheduler can be driven by fake devices as well. Every worker takes the next pending task as soon as its device
+  is free, so a run scales with the number of devices.
+  """
+
+  def __init__(self, devices: list, run_task, output_dir: str, result_folder: str = 'results'):
+    '''
+    @param run_task: run_task(device, app_name, task_number, task_data) -> result dict, or None to skip the task
+    '''
+    self.devices = devices
+    self.run_task = run_task
+    self.output_dir = output_dir
+    self.result_folder = result_folder
+    self.logger = logging.getLogger(self.__class__.__name__)
+
+    self._lock = threading.Lock()
+    self._results = {}
+    self._task_order = {}
+
+  def run(self, tasks) -> dict[str, list[dict]]:
+    '''
+    run all tasks (app_name, task_number, task_data) and write the results of each app to results/{app_name}.jsonl,
+    in the same order as the tasks are given. tasks can be a generator, e.g. one generating the solutions of the
+    tasks, so that the devices already run the first tasks while the rest is being generated.
+    '''
+    pending = queue.Queue()
+    t0 = time.time()
+    workers = [threading.Thread(target=self._work, args=(device, pending), name=f'worker-{device.serial}')
+               for device in self.devices]
+    for worker in workers:
+      worker.start()
+
+    task_num = 0
+    try:
+      for app_name, task_number, task_data in tasks:
+        with self._lock:
+          self._task_order[(app_name, task_number)] = task_num
+        pending.put((app_name, task_number, task_data))
+        task_num += 1
+    finally:
+      # one stop signal per worker, after all tasks
+      for _ in workers:
+        pending.put(None)
+      for worker in workers:
+        worker.join()
+    self.logger.info(f'{task_num} tasks done on {len(self.devices)} devices in {time.time() - t0:.1f}s')
+
+    return {app_name: self._sorted_results(app_name) for app_name in self._results}
+
+  def _work(self, device, pending: queue.Queue):
+    while True:
+      task = pending.get()
+      if task is None:
+        return
+      app_name, task_number, task_data = task
+
+      t0 = time.time()
+      try:
+        device.reset()
+        result = self.run_task(device, app_name, task_number, task_data)
+      except Exception as e:
+        traceback.print_exc()
+        print(e)
+        result = {'failed': True}
+      self.logger.info(f'{app_name}/{task_number} done on {device.serial} in {time.time() - t0:.1f}s')
+
+      if result is not None:
+        self._add_result(app_name, task_number, result)
+
+  def _add_result(self, app_name: str, task_number: str, result: dict):
+    with self._lock:
+      self._results.setdefault(app_name, {})[task_number] = deepcopy(result)
+      result_df = pandas.DataFrame(self._sorted_results(app_name))
+      result_dir = os.path.join(self.output_dir, self.result_folder)
+      if not os.path.exists(result_dir):
+        os.makedirs(result_dir)
+      result_df.to_json(os.path.join(result_dir, f"{app_name}.jsonl"), lines=True, orient='records')
+
+  def _sorted_results(self, app_name: str) -> list[dict]:
+    app_results = self._results[app_name]
+    task_numbers = sorted(app_results, key=lambda task_number: self._task_order[(app_name, task_number)])
+    return [app_results[task_number] for task_number in task_numbers]
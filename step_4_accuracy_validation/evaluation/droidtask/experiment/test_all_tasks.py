@@ -12,16 +12,17 @@ import shutil
 import subprocess
 import agent.environment as environment
 import tools as tools
-from evaluation.droidtask.config import BASE_APK_PATH, DEBUG_MODE, DOC_PATH, EMULATOR_AGRS, FIRST_SCREEN_ELEMENTS_PATH, TASKS_PATH
-from evaluation.droidtask.experiment.query_llm import make_solution_prompt_droidtask_tune
+import model_server
+from evaluation.droidtask.config import AVD_NAME, BASE_APK_PATH, DEBUG_MODE, DOC_PATH, EMULATOR_AGRS, FIRST_SCREEN_ELEMENTS_PATH, TASKS_PATH
+from evaluation.droidtask.experiment.query_llm import make_solution_prompt_droidtask_tune_parts
+from evaluation.droidtask.experiment.task_scheduler import EmulatorDevice, TaskScheduler
 from agent.droidbot.device import Device
 from agent.droidbot.app import App
 from agent.droidbot.input_event import RestartAppEvent
 from agent.code_agent import CodeAgent
+from agent.droidbot import trace_log
 from agent.script_utils.ui_apis import CodeConfig, CodeStatus, Verifier, regenerate_script, _save2log
 from agent.script_utils.api_doc import ApiDoc
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
-import torch
 
 
 def process_error_info(original_script, compiled_script, traceback, error,
@@ -148,7 +149,7 @@ class CodeAgent():
     tools.dump_json_file(f'{self.save_path}/line_mappings.json', line_mappings)
     
     # in case some silly scripts include no UI actions at all, we make an empty log for batch_verifying
-    tools.dump_yaml_file(os.path.join(self.save_path, f'log.yaml'), {'records': [], 'step_num': 0})
+    trace_log.reset_trace(os.path.join(self.save_path, f'log.yaml'))
     
     env = self.env
     self.code_config.set(self.save_path, code, code_script, line_mappings)
@@ -184,6 +185,7 @@ class CodeAgent():
         currently_executing_code=None,
         comment='done',
         screenshot=None)
+    trace_log.close_trace(self.code_config.log_file)
     t2 = time.time()
     runtime.append({
         'total': t2 - t0,
@@ -204,7 +206,11 @@ class CodeAgent():
     return result
 
 
-def check_code_executable(app_name, code, task_id, output_dir):
+def check_code_executable(app_name, code, task_id, output_dir, device_serial=None):
+    """
+    run the code of a task on the device. Without a device_serial, the default emulator is restored from the snapshot
+    first; a given device_serial is expected to be restored by the caller (see task_scheduler.TaskScheduler).
+    """
     output_dir = f"{output_dir}/{app_name}/{task_id}"
     if os.path.exists(output_dir):
       shutil.rmtree(output_dir)
@@ -225,10 +231,11 @@ def check_code_executable(app_name, code, task_id, output_dir):
 
     logging.info("Starting DroidBot")
     try:
-      device_serial = f"emulator-{EMULATOR_AGRS['port']}"
-      subprocess.run(["adb",  "-s", device_serial, "emu", "avd", "snapshot", "load", EMULATOR_AGRS['snapshot']])  
-      import time
-      time.sleep(3)
+      if device_serial is None:
+        device_serial = f"emulator-{EMULATOR_AGRS['port']}"
+        subprocess.run(["adb",  "-s", device_serial, "emu", "avd", "snapshot", "load", EMULATOR_AGRS['snapshot']])  
+        import time
+        time.sleep(3)
       
       device = Device(
           device_serial=device_serial,
@@ -294,16 +301,87 @@ def postprocess_code(code, doc):
   code = remove_quotes(code)
   return code
 
-def load_autodroidv2():
-    model_path = "autodroidv2"
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float16, device_map="auto")
-    return model, tokenizer
-    
-def query_autodroidv2(model, tokenizer, prompt: str):
-    inputs = tokenizer(prompt, return_tensors="pt").to("cuda" if torch.cuda.is_available() else "cpu")
-    output = model.generate(**inputs, max_length=1000, pad_token_id=tokenizer.eos_token_id)
-    return tokenizer.decode(output[0], skip_special_tokens=True)
+AUTODROIDV2_MODEL_PATH = "autodroidv2"
+# batched generation: the answers are bounded by max_new_tokens and end with the closing brace of the JSON answer
+BATCH_MAX_NEW_TOKENS = 2048
+BATCH_STOP_STRINGS = ["\n}"]
+BATCH_SIZE = 8
+# put the task after the app document, so that all tasks of an app share its KV cache. autodroidv2 was fine-tuned on
+# prompts with the task first, only enable this after checking the accuracy of the reordered prompt
+TASK_LAST_PROMPT = False
+
+DEBUG_CODE = '''
+# $server_overview_screen__you_button.tap()
+# $personal_profile_screen__settings_button.tap()
+# $settings_screen__notifications_button.tap()
+# '''
+
+def query_autodroidv2(prompt: str, prefix: str = None):
+    return model_server.query_autodroidv2(prompt, model_path=AUTODROIDV2_MODEL_PATH, max_length=1000, prefix=prefix)
+
+def make_task_prompt(app_name, task):
+  first_screen_elements = tools.load_json_file(f'{FIRST_SCREEN_ELEMENTS_PATH}/{app_name}_first_elements.json')
+  doc = tools.load_json_file(f'{DOC_PATH}/{app_name}.json')
+  prompt_prefix, prompt_suffix = make_solution_prompt_droidtask_tune_parts(doc, task, app_name, first_screen_elements,
+                                                                             task_last=TASK_LAST_PROMPT)
+  return prompt_prefix, prompt_suffix
+
+def answer_to_code(app_name, task_number, output_dir, task_prompt, task_answer, encoder=None):
+  """
+  extract the script from the answer of the model, returns None if the answer is too long to be executed
+  """
+  print(task_answer)
+  if not os.path.exists(f'{output_dir}/{app_name}'):
+    os.makedirs(f'{output_dir}/{app_name}')
+  tools.dump_json_file(json_path=f'{output_dir}/{app_name}/{task_number}_qa.json', data=[task_prompt, task_answer])
+  if encoder is not None:
+    # calculate the token number of the answer, if too long, we skip
+    tokens = encoder.encode(task_answer)
+    if len(tokens) > 2048:
+      print(f"Task answer too long: {len(tokens)}")
+      return None
+  
+  task_answer, _ = tools.convert_gpt_answer_to_json(task_answer, 'gpt-4o')
+  doc = tools.load_json_file(f'{DOC_PATH}/{app_name}.json')
+  code = postprocess_code(task_answer['script'], doc)
+  print(f"Post processed code: {code}")
+  return code
+
+def generate_task_code(app_name, task, task_number, output_dir, model_name="autodroidv2", encoder=None):
+  """
+  query the model for the script of a task, returns None if the answer is too long to be executed
+  """
+  if DEBUG_MODE:
+    doc = tools.load_json_file(f'{DOC_PATH}/{app_name}.json')
+    code = postprocess_code(DEBUG_CODE, doc)
+    print(f"Post processed code: {code}")
+    return code
+
+  prompt_prefix, prompt_suffix = make_task_prompt(app_name, task)
+  task_prompt = prompt_prefix + prompt_suffix
+  print(task_prompt)
+  if model_name == "autodroidv2":
+    task_answer = query_autodroidv2(task_prompt, prefix=prompt_prefix)
+  else:
+    task_answer = tools.query_model(task_prompt, model_name)
+  return answer_to_code(app_name, task_number, output_dir, task_prompt, task_answer, encoder)
+
+def generate_answers_batched(tasks):
+  """
+  query autodroidv2 for the (app_name, task_number, task_data) tasks in batches. The initial solution does not depend
+  on the device, so the tasks are yielded with their prompt and answer (in task_data) as soon as their batch is
+  generated.
+  """
+  prompts = []
+  for app_name, task_number, task_data in tasks:
+    prompt_prefix, prompt_suffix = make_task_prompt(app_name, task_data['task'])
+    prompts.append(prompt_prefix + prompt_suffix)
+
+  answers = model_server.query_autodroidv2_batch(prompts, model_path=AUTODROIDV2_MODEL_PATH,
+                                                 max_new_tokens=BATCH_MAX_NEW_TOKENS,
+                                                 stop_strings=BATCH_STOP_STRINGS, batch_size=BATCH_SIZE)
+  for (app_name, task_number, task_data), task_prompt, task_answer in zip(tasks, prompts, answers):
+    yield app_name, task_number, dict(task_data, prompt=task_prompt, answer=task_answer)
 
 def run_all_tasks(app, output_dir, model_name="autodroidv2"):
   
@@ -312,7 +390,7 @@ def run_all_tasks(app, output_dir, model_name="autodroidv2"):
   result_folder = 'results'
   
   if model_name == "autodroidv2":
-    model, tokenizer = load_autodroidv2()
+    model_server.load_autodroidv2(AUTODROIDV2_MODEL_PATH)
 
   import tiktoken
   encoder = tiktoken.get_encoding("cl100k_base")
@@ -326,38 +404,9 @@ def run_all_tasks(app, output_dir, model_name="autodroidv2"):
     for task_number, task_data in app_tasks.items():
       try:
         task = task_data['task']
-        
-        first_screen_elements = tools.load_json_file(f'{FIRST_SCREEN_ELEMENTS_PATH}/{app_name}_first_elements.json')
-        doc = tools.load_json_file(f'{DOC_PATH}/{app_name}.json')
-        if DEBUG_MODE:
-              code = '''
-# $server_overview_screen__you_button.tap()
-# $personal_profile_screen__settings_button.tap()
-# $settings_screen__notifications_button.tap()
-# '''
-        else:
-          task_prompt = make_solution_prompt_droidtask_tune(doc, task, app_name, first_screen_elements)
-          print(task_prompt)
-          if model_name == "autodroidv2":
-            task_answer = query_autodroidv2(model, tokenizer, task_prompt)
-          else:
-            task_answer = tools.query_model(task_prompt, model_name)
-          print(task_answer)
-          if not os.path.exists(f'{output_dir}/{app_name}'):
-            os.makedirs(f'{output_dir}/{app_name}')
-          tools.dump_json_file(json_path=f'{output_dir}/{app_name}/{task_number}_qa.json', data=[task_prompt, task_answer])
-          # calculate the token number of the answer, if too long, we skip
-          tokens = encoder.encode(task_answer)
-          if len(tokens) > 2048:
-            print(f"Task answer too long: {len(tokens)}")
-            continue
-          
-          task_answer, _ = tools.convert_gpt_answer_to_json(task_answer, 'gpt-4o')
-          code = task_answer['script']
-        
-        
-        code = postprocess_code(code, doc)
-        print(f"Post processed code: {code}")
+        code = generate_task_code(app_name, task, task_number, output_dir, model_name, encoder)
+        if code is None:
+          continue
         result = check_code_executable(
           app_name=app_name,
           code=code,
@@ -380,4 +429,46 @@ def run_all_tasks(app, output_dir, model_name="autodroidv2"):
       output_path = os.path.join(output_dir, result_folder, f"{app_name}.jsonl")
       result_df.to_json(output_path, lines=True, orient='records')
       if DEBUG_MODE:
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
+
+def run_all_tasks_on_devices(apps, output_dir, device_serials, model_name="autodroidv2", batch_generation=False):
+  """
+  run the tasks of all apps, sharded across the emulators in device_serials. The results are merged into the same
+  results/{app}.jsonl files as run_all_tasks.
+  With batch_generation, the scripts of autodroidv2 are generated in batches, and the devices run the tasks of a
+  batch while the next one is being generated.
+  """
+  tasks_data = tools.load_json_file(TASKS_PATH)
+
+  if model_name == "autodroidv2":
+    model_server.load_autodroidv2(AUTODROIDV2_MODEL_PATH)
+
+  import tiktoken
+  encoder = tiktoken.get_encoding("cl100k_base")
+  def run_task(device, app_name, task_number, task_data):
+    task = task_data['task']
+    if 'answer' in task_data:
+      # the answer is bounded by BATCH_MAX_NEW_TOKENS, no need to count its tokens again
+      code = answer_to_code(app_name, task_number, output_dir, task_data['prompt'], task_data['answer'])
+    else:
+      # the model is shared by all workers, model_server runs one generation at a time
+      code = generate_task_code(app_name, task, task_number, output_dir, model_name, encoder)
+    if code is None:
+      return None
+    result = check_code_executable(
+      app_name=app_name,
+      code=code,
+      task_id=task_number,
+      output_dir=output_dir,
+      device_serial=device.serial
+    )
+    result.update({"task": task, 'code': code, 'doc_path': f'{DOC_PATH}/{app_name}.json', })
+    return result
+
+  tasks = [(app_name, task_number, task_data) for app_name, app_tasks in tasks_data.items() if app_name in apps
+           for task_number, task_data in app_tasks.items()]
+  devices = [EmulatorDevice(serial, AVD_NAME, EMULATOR_AGRS['snapshot']) for serial in device_serials]
+  if batch_generation and model_name == "autodroidv2" and not DEBUG_MODE:
+    tasks = generate_answers_batched(tasks)
+  scheduler = TaskScheduler(devices, run_task, output_dir)
+  return scheduler.run(tasks)
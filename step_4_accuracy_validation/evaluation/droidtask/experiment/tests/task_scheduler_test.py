@@ -0,0 +1,90 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from evaluation.droidtask.experiment.task_scheduler import TaskScheduler
+
+
+class FakeDevice:
+    def __init__(self, serial):
+        self.serial = serial
+        self.reset_count = 0
+        self.busy = False
+
+    def reset(self):
+        self.reset_count += 1
+
+
+class TestTaskScheduler(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.tasks = [
+            (app_name, f"task{idx}.yaml", {"task": f"{app_name} task {idx}"})
+            for app_name in ["calendar", "clock"]
+            for idx in range(6)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_tasks_are_sharded_across_devices(self):
+        devices = [FakeDevice(f"emulator-{5554 + 2 * idx}") for idx in range(3)]
+        ran_on = {}
+        lock = threading.Lock()
+
+        def run_task(device, app_name, task_number, task_data):
+            # a device never runs two tasks at once
+            self.assertFalse(device.busy)
+            device.busy = True
+            time.sleep(0.01)
+            device.busy = False
+            with lock:
+                ran_on[(app_name, task_number)] = device.serial
+            if task_number == "task5.yaml":
+                return None  # skipped tasks have no result
+            if task_number == "task4.yaml":
+                raise RuntimeError("task crashed")
+            return {"task": task_data["task"], "device": device.serial}
+
+        results = TaskScheduler(devices, run_task, self.output_dir).run(self.tasks)
+
+        self.assertEqual(len(ran_on), len(self.tasks))
+        self.assertEqual(sum(device.reset_count for device in devices), len(self.tasks))
+        self.assertGreater(len(set(ran_on.values())), 1)
+        for app_name in ["calendar", "clock"]:
+            expected = [f"{app_name} task {idx}" for idx in range(4)] + [None]
+            self.assertEqual([result.get("task") for result in results[app_name]], expected)
+            self.assertEqual(results[app_name][-1], {"failed": True})
+
+            with open(os.path.join(self.output_dir, "results", f"{app_name}.jsonl")) as f:
+                lines = [json.loads(line) for line in f.read().splitlines()]
+            self.assertEqual(len(lines), 5)
+            self.assertEqual([line["task"] for line in lines[:4]], expected[:4])
+
+    def test_tasks_are_streamed_to_devices(self):
+        devices = [FakeDevice("emulator-5554"), FakeDevice("emulator-5556")]
+        started = []
+
+        def generate_tasks():
+            for idx, task in enumerate(self.tasks):
+                if idx == len(self.tasks) - 1:
+                    # the devices work on the tasks generated so far
+                    time.sleep(0.2)
+                    self.assertGreater(len(started), 0)
+                yield task
+
+        def run_task(device, app_name, task_number, task_data):
+            started.append(task_number)
+            return {"task": task_data["task"]}
+
+        results = TaskScheduler(devices, run_task, self.output_dir).run(generate_tasks())
+        self.assertEqual(len(started), len(self.tasks))
+        self.assertEqual([result["task"] for result in results["clock"]], [f"clock task {idx}" for idx in range(6)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,11 @@
 import logging
+import math
 import os
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from enum import Enum
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 
@@ -19,6 +21,20 @@ class FailedReason(Enum):
     UI_POSITIONS_NOT_FOUND = "ui positions not found"
 
 
+# the evaluator of the worker processes of run_evaluation, set once per worker
+_worker_evaluator: Optional["BaseEvaluator"] = None
+
+
+def _init_worker(evaluator: "BaseEvaluator") -> None:
+    global _worker_evaluator
+    _worker_evaluator = evaluator
+    evaluator.init_worker()
+
+
+def _eval_episode_in_worker(episode: str) -> Tuple[bool, Optional[FailedReason]]:
+    return _worker_evaluator.eval_episode(episode)
+
+
 class BaseEvaluator(ABC):
     def __init__(
         self,
@@ -41,9 +57,17 @@ class BaseEvaluator(ABC):
         #   - "first_n": only evaluating the first_n episodes
         #   - "episodes": [episode_1, episode_2, ...]
         #                 only evaluate target episodes
+        #   - "num_workers": evaluate the episodes in this many processes
         self.options = options if options else None
 
-    def run_evaluation(self) -> None:
+    def run_evaluation(self, num_workers: Optional[int] = None) -> None:
+        """
+        num_workers: the processes evaluating the episodes, options["num_workers"]
+        or 1 by default. The results are recorded in the order of the episodes
+        whatever the number of workers.
+        """
+        if num_workers is None:
+            num_workers = self.options.get("num_workers", 1) if self.options else 1
         target_episodes = self.helper.get_all_episodes()
 
         if self.options:
@@ -59,8 +83,12 @@ class BaseEvaluator(ABC):
                 first_n = int(self.options["first_n"])
                 target_episodes = self.helper.get_all_episodes()[:first_n]
 
-        for epi in target_episodes:
-            completeness, failed_reason = self.eval_episode(epi)
+        if num_workers > 1 and len(target_episodes) > 1:
+            results = self._eval_episodes_in_pool(target_episodes, num_workers)
+        else:
+            results = map(self.eval_episode, target_episodes)
+
+        for epi, (completeness, failed_reason) in zip(target_episodes, results):
             app = self.helper.get_task_app_by_episode(epi)
             path = self.helper.get_task_path_by_episode(epi)
             if failed_reason is not None:
@@ -75,6 +103,29 @@ class BaseEvaluator(ABC):
             else:
                 self.episode_completion[epi] = (completeness, "", app, path)
 
+    def init_worker(self) -> None:
+        """
+        called once in each worker process of run_evaluation, on the copy of
+        the evaluator the worker received, to set up the process-wide state
+        that is not part of that copy
+        """
+
+    def _eval_episodes_in_pool(
+        self, episodes: List[str], num_workers: int
+    ) -> List[Tuple[bool, Optional[FailedReason]]]:
+        # every worker gets a copy of the evaluator once, and keeps its caches
+        # (ground-truth traces, embedding model, ...) across its episodes; the
+        # episodes are given in contiguous chunks, so that a worker mostly sees
+        # the episodes of the same categories
+        chunksize = max(1, math.ceil(len(episodes) / (num_workers * 4)))
+        with ProcessPoolExecutor(
+            max_workers=num_workers, initializer=_init_worker, initargs=(self,)
+        ) as pool:
+            # map() returns the results in the order of the episodes
+            return list(
+                pool.map(_eval_episode_in_worker, episodes, chunksize=chunksize)
+            )
+
     def eval_episode(self, episode: str) -> Tuple[bool, Optional[FailedReason]]:
         # self.logger.info(f"Evaluating episode: {episode}")
         task_description = self.helper.get_task_description_by_episode(episode)
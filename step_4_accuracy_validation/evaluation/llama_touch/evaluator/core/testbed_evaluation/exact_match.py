@@ -1,13 +1,18 @@
 import json
 import re
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
 
 import imagehash
+import numpy as np
 from lxml import etree
 from PIL import Image
 
 from ..common.action_type import ActionType
 from ..task_trace import EssentialStateKeyword, UIState
+from .image_cache import get_image_cache
+
+# the text and content-desc of the annotated UI components compared by their image
+NULL_STATE = ["", " ", "null", None]
 
 
 def _get_image_patch(image: Image, bounds: List[int]) -> Image:
@@ -15,10 +20,37 @@ def _get_image_patch(image: Image, bounds: List[int]) -> Image:
     return image.crop((left, top, right, bottom))
 
 
+def _load_image(screenshot: Union[str, np.ndarray]) -> Image:
+    if isinstance(screenshot, np.ndarray):
+        # frames captured in memory, in the RGB order
+        return Image.fromarray(screenshot)
+    with Image.open(screenshot) as img:
+        img.load()
+        return img
+
+
+def _get_image_size(screenshot: Union[str, np.ndarray]) -> tuple:
+    if isinstance(screenshot, np.ndarray):
+        height, width = screenshot.shape[:2]
+        return width, height
+    return get_image_cache().get_size(screenshot)
+
+
+def _get_patch_hash(
+    screenshot: Union[str, np.ndarray], bounds: List[float]
+) -> imagehash.ImageHash:
+    if isinstance(screenshot, np.ndarray):
+        return imagehash.average_hash(
+            _get_image_patch(_load_image(screenshot), bounds)
+        )
+    # the screenshots are decoded once, and the hashes of their patches memoized
+    return get_image_cache().get_patch_hash(screenshot, bounds)
+
+
 def _check_img_exact_match(
     annotated_ui_node: Dict,
-    gr_screenshot_path: str,
-    exec_screenshot_path: str,
+    gr_screenshot_path: Union[str, np.ndarray],
+    exec_screenshot_path: Union[str, np.ndarray],
     image_similarity_bound: Optional[int] = 1,
 ) -> bool:
     """
@@ -27,8 +59,8 @@ def _check_img_exact_match(
 
     Args:
         annotated_ui_node: annotated essential state that represents a UI node
-        gr_screenshot_path: screenshot path of the annotated UI
-        exec_screenshot_path: screenshot path of the execution UI
+        gr_screenshot_path: screenshot path of the annotated UI, or its pixels as a numpy array
+        exec_screenshot_path: screenshot path of the execution UI, or its pixels as a numpy array
         image_similarity_bound: threshold to determine whether the image patches are similar
 
     Return:
@@ -38,12 +70,10 @@ def _check_img_exact_match(
     gr_bounds = annotated_ui_node["bounds"]
     assert gr_bounds is not None
 
-    gr_screen_width, gr_screen_height = 0, 0
-    exec_screen_width, exec_screen_height = 0, 0
-    with Image.open(gr_screenshot_path) as img:
-        gr_screen_width, gr_screen_height = img.size
-    with Image.open(exec_screenshot_path) as img:
-        exec_screen_width, exec_screen_height = img.size
+    gr_label = gr_screenshot_path if isinstance(gr_screenshot_path, str) else "<in-memory frame>"
+    exec_label = exec_screenshot_path if isinstance(exec_screenshot_path, str) else "<in-memory frame>"
+    gr_screen_width, gr_screen_height = _get_image_size(gr_screenshot_path)
+    exec_screen_width, exec_screen_height = _get_image_size(exec_screenshot_path)
 
     gr_l, gr_t, gr_r, gr_b = map(
         int, re.findall(r"\[(\d+),(\d+)\]\[(\d+),(\d+)\]", gr_bounds)[0]
@@ -55,24 +85,17 @@ def _check_img_exact_match(
         gr_b * exec_screen_height / gr_screen_height,
     )
 
-    annotate_image_patch: Image = _get_image_patch(
-        Image.open(gr_screenshot_path), [gr_l, gr_t, gr_r, gr_b]
-    )
-    exec_image_patch: Image = _get_image_patch(
-        Image.open(exec_screenshot_path), [exec_l, exec_t, exec_r, exec_b]
-    )
-
-    gr_hash = imagehash.average_hash(annotate_image_patch)
-    exec_hash = imagehash.average_hash(exec_image_patch)
+    gr_hash = _get_patch_hash(gr_screenshot_path, [gr_l, gr_t, gr_r, gr_b])
+    exec_hash = _get_patch_hash(exec_screenshot_path, [exec_l, exec_t, exec_r, exec_b])
 
     if gr_hash - exec_hash > image_similarity_bound:
         print(
-            f"[image] match fail: hamming distance: {gr_hash-exec_hash}, '{gr_screenshot_path}' with '{exec_screenshot_path}'"
+            f"[image] match fail: hamming distance: {gr_hash-exec_hash}, '{gr_label}' with '{exec_label}'"
         )
         return False
 
     print(
-        f"[image] match success: hamming distance: {gr_hash-exec_hash}, '{gr_screenshot_path}' with '{exec_screenshot_path}'"
+        f"[image] match success: hamming distance: {gr_hash-exec_hash}, '{gr_label}' with '{exec_label}'"
     )
     return True
 
@@ -150,10 +173,16 @@ def _check_exact_single_node_match(
     return False
 
 
+def _is_matched_by_image(annotated_ui_repr: Dict) -> bool:
+    return (
+        annotated_ui_repr.get("text", None) in NULL_STATE
+        and annotated_ui_repr.get("content-desc", None) in NULL_STATE
+    )
+
+
 def check_uicomponent_match(gr_ui_state: UIState, exec_ui_state: UIState) -> bool:
     """Exact match on two UI components"""
     match_node_ids: List[str] = gr_ui_state.essential_state[EssentialStateKeyword.EXACT]
-    null_state = ["", " ", "null", None]
 
     parser = etree.XMLParser(recover=True, encoding="utf-8")
     exec_ui_tree = etree.parse(exec_ui_state.vh_path, parser)
@@ -165,10 +194,7 @@ def check_uicomponent_match(gr_ui_state: UIState, exec_ui_state: UIState) -> boo
             open(gr_vh_simp_ui_json_path, "r", encoding="utf-8")
         )[node_id]
 
-        if (
-            annotated_ui_repr.get("text", None) in null_state
-            and annotated_ui_repr.get("content-desc", None) in null_state
-        ):
+        if _is_matched_by_image(annotated_ui_repr):
             if not _check_img_exact_match(
                 annotated_ui_repr,
                 gr_ui_state.screenshot_path,
@@ -247,9 +273,7 @@ def check_click_match(gr_ui_state: UIState, exec_ui_state: UIState) -> bool:
         int, re.findall(r"\[(\d+),(\d+)\]\[(\d+),(\d+)\]", bounds)[0]
     )
 
-    screen_width, screen_height = 0, 0
-    with Image.open(exec_ui_state.screenshot_path) as img:
-        screen_width, screen_height = img.size
+    screen_width, screen_height = _get_image_size(exec_ui_state.screenshot_path)
 
     # screen_width, screen_height = Image.open(exec_ui_state.screenshot_path).size
     y = exec_ui_state.action.touch_point_yx[0] * screen_height
@@ -265,3 +289,42 @@ def check_click_match(gr_ui_state: UIState, exec_ui_state: UIState) -> bool:
             f"[click] match failed: click action:{x,y}, '{gr_ui_state.vh_path}' with '{exec_ui_state.vh_path}'"
         )
         return False
+
+
+def build_groundtruth_hash_index(helper, index_path: str) -> None:
+    """
+    Persist the sizes of the ground-truth screenshots and the hashes of their
+    annotated patches compared by _check_img_exact_match, so that later
+    evaluations load them instead of decoding the screenshots.
+
+    Args:
+        helper: the DatasetHelper of the ground-truth dataset
+        index_path: the json file of the index, loaded with
+            get_image_cache().load_index(index_path)
+    """
+    image_cache = get_image_cache()
+    screenshot_paths = set()
+    for episode in helper.get_all_episodes():
+        gr_trace = helper.load_groundtruth_trace_by_episode(episode)
+        for ui_state in gr_trace or []:
+            if not ui_state.essential_state:
+                continue
+            node_ids = ui_state.essential_state.get(EssentialStateKeyword.EXACT)
+            if not node_ids:
+                continue
+            with open(ui_state.vh_simp_ui_json_path, "r", encoding="utf-8") as f:
+                annotated_ui_reprs = json.load(f)
+            for node_id in node_ids:
+                annotated_ui_repr = annotated_ui_reprs[int(node_id)]
+                if not _is_matched_by_image(annotated_ui_repr):
+                    continue
+                bounds = map(
+                    int,
+                    re.findall(
+                        r"\[(\d+),(\d+)\]\[(\d+),(\d+)\]",
+                        annotated_ui_repr["bounds"],
+                    )[0],
+                )
+                image_cache.get_patch_hash(ui_state.screenshot_path, list(bounds))
+                screenshot_paths.add(ui_state.screenshot_path)
+    image_cache.dump_index(index_path, screenshot_paths)
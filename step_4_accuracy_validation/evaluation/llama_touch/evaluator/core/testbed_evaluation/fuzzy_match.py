@@ -1,26 +1,116 @@
+import hashlib
 import json
 import os
+import threading
 from typing import Dict, List
 
 from lxml import etree
 
 from ..task_trace import EssentialStateKeyword, UIState
 from ..utils.autodroid_vh2html import simplify_views
-from .sentence_similarity import check_sentence_similarity
+from .sentence_similarity import compute_embedding_similarity, encode_sentences
+
+SCREEN_SIMILARITY_THRESHOLD = 0.85
+
+# sha256 of a view hierarchy file -> embedding of its simplified views
+# identical screens (e.g. the hard links of the artifact store) are encoded once
+_vh_embeddings: Dict[str, object] = {}
+# path -> (size, mtime, sha256), so that an unchanged file is not hashed again
+_vh_hashes: Dict[str, tuple] = {}
+_cache_lock = threading.Lock()
+
+
+def _get_vh_hash(vh_json_path: str) -> str:
+    stat = os.stat(vh_json_path)
+    with _cache_lock:
+        cached = _vh_hashes.get(vh_json_path)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    with open(vh_json_path, "rb") as f:
+        vh_hash = hashlib.sha256(f.read()).hexdigest()
+    with _cache_lock:
+        _vh_hashes[vh_json_path] = (stat.st_size, stat.st_mtime_ns, vh_hash)
+    return vh_hash
+
+
+def precompute_vh_embeddings(vh_json_paths: List[str]) -> None:
+    """
+    Encode the views of the view hierarchy files not encoded yet, in batches,
+    e.g. all the states of an episode before they are compared.
+    The missing files are skipped.
+    """
+    missing: Dict[str, str] = {}
+    for vh_json_path in vh_json_paths:
+        if not vh_json_path or not os.path.exists(vh_json_path):
+            continue
+        vh_hash = _get_vh_hash(vh_json_path)
+        with _cache_lock:
+            if vh_hash in _vh_embeddings:
+                continue
+        missing.setdefault(vh_hash, vh_json_path)
+    if not missing:
+        return
+
+    sentences = []
+    for vh_json_path in missing.values():
+        with open(vh_json_path, "r", encoding="utf-8") as f:
+            sentences.append(simplify_views(json.load(f)))
+    embeddings = encode_sentences(sentences)
+    with _cache_lock:
+        for vh_hash, embedding in zip(missing, embeddings):
+            _vh_embeddings[vh_hash] = embedding
+
+
+def get_vh_embedding(vh_json_path: str):
+    vh_hash = _get_vh_hash(vh_json_path)
+    with _cache_lock:
+        embedding = _vh_embeddings.get(vh_hash)
+    if embedding is None:
+        precompute_vh_embeddings([vh_json_path])
+        with _cache_lock:
+            embedding = _vh_embeddings[vh_hash]
+    return embedding
+
+
+def _has_screen_fuzzy_match(ui_state: UIState) -> bool:
+    if not ui_state.essential_state:
+        return False
+    node_ids = ui_state.essential_state.get(EssentialStateKeyword.FUZZY) or []
+    return -1 in [int(node_id) for node_id in node_ids]
+
+
+def precompute_trace_embeddings(
+    gr_trace: List[UIState], exec_trace: List[UIState]
+) -> None:
+    """
+    Encode up front, in one batch, the screens of an episode that
+    compare_entire_ui_vh may compare: the ground-truth states with a fuzzy<-1>
+    essential state, and all the states of the execution trace.
+    """
+    gr_paths = [
+        ui_state.vh_json_path
+        for ui_state in gr_trace
+        if _has_screen_fuzzy_match(ui_state)
+    ]
+    if not gr_paths:
+        return
+    exec_paths = [ui_state.vh_json_path for ui_state in exec_trace]
+    precompute_vh_embeddings(gr_paths + exec_paths)
 
 
 def compare_entire_ui_vh(gr_ui_state: UIState, exec_ui_state: UIState) -> bool:
     gr_vh_json_path = gr_ui_state.vh_json_path
     exec_vh_json_path = exec_ui_state.vh_json_path
-    gr_views: str = simplify_views(json.load(open(gr_vh_json_path)))
     # WARNING: AgentEnv for AppAgent can't get VH
     if not os.path.exists(exec_vh_json_path):
         return True
-    exec_views: str = simplify_views(json.load(open(exec_vh_json_path)))
 
-    similarity, similar = check_sentence_similarity(
-        gr_views, exec_views, threshold=0.85
+    # the views are encoded once, the comparison is the dot product of their
+    # normalized embeddings
+    similarity = compute_embedding_similarity(
+        get_vh_embedding(gr_vh_json_path), get_vh_embedding(exec_vh_json_path)
     )
+    similar = similarity > SCREEN_SIMILARITY_THRESHOLD
     if similar:
         print(
             f"[screen fuzzy match] success: '{gr_ui_state.screenshot_path}' with '{exec_ui_state.screenshot_path}', similarity: {similarity}"
@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import imagehash
+from PIL import Image
+
+# the decoded screenshots kept in memory, the least recently used are dropped
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class ImageCache:
+    """
+    Screenshots decoded once per evaluation, and the average hashes of their
+    patches.
+
+    The decoded images are kept in an LRU bounded by their size in memory. The
+    hashes of the patches are memoized by (path, bounds), and can be loaded from
+    a persisted index, e.g. the one of the ground-truth traces built by
+    exact_match.build_groundtruth_hash_index.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self._images: "OrderedDict[str, Image.Image]" = OrderedDict()
+        self._num_bytes = 0
+        self._sizes: Dict[str, Tuple[int, int]] = {}
+        self._patch_hashes: Dict[Tuple[str, Tuple], imagehash.ImageHash] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.normpath(path)
+
+    def get_image(self, path: str) -> Image.Image:
+        key = self._key(path)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                return image
+
+        with Image.open(path) as img:
+            img.load()
+            image = img
+        num_bytes = image.width * image.height * len(image.getbands())
+
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = image
+                self._num_bytes += num_bytes
+                self._sizes[key] = image.size
+                # the image just decoded is kept even if it is larger than the bound
+                while self._num_bytes > self.max_bytes and len(self._images) > 1:
+                    _, dropped = self._images.popitem(last=False)
+                    self._num_bytes -= (
+                        dropped.width * dropped.height * len(dropped.getbands())
+                    )
+            return self._images[key]
+
+    def get_size(self, path: str) -> Tuple[int, int]:
+        """
+        (width, height) of the screenshot, only its header is read if it was
+        not decoded yet
+        """
+        key = self._key(path)
+        with self._lock:
+            size = self._sizes.get(key)
+        if size is None:
+            with Image.open(path) as img:
+                size = img.size
+            with self._lock:
+                self._sizes[key] = size
+        return size
+
+    def get_patch_hash(self, path: str, bounds: Tuple) -> imagehash.ImageHash:
+        """
+        bounds: (left, top, right, bottom) of the patch in the screenshot
+        """
+        key = (self._key(path), tuple(bounds))
+        with self._lock:
+            patch_hash = self._patch_hashes.get(key)
+        if patch_hash is None:
+            patch_hash = imagehash.average_hash(self.get_image(path).crop(bounds))
+            with self._lock:
+                self._patch_hashes[key] = patch_hash
+        return patch_hash
+
+    def dump_index(self, index_path: str, paths: Optional[set] = None) -> None:
+        """
+        persist the sizes and patch hashes of the screenshots, all of them or
+        only those in `paths`
+        """
+        keys = None if paths is None else {self._key(path) for path in paths}
+        with self._lock:
+            index = {
+                "sizes": {
+                    path: list(size)
+                    for path, size in self._sizes.items()
+                    if keys is None or path in keys
+                },
+                "patch_hashes": [
+                    [path, list(bounds), str(patch_hash)]
+                    for (path, bounds), patch_hash in self._patch_hashes.items()
+                    if keys is None or path in keys
+                ],
+            }
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+
+    def load_index(self, index_path: str) -> None:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        with self._lock:
+            for path, size in index["sizes"].items():
+                self._sizes[path] = tuple(size)
+            for path, bounds, patch_hash in index["patch_hashes"]:
+                self._patch_hashes[(path, tuple(bounds))] = imagehash.hex_to_hash(
+                    patch_hash
+                )
+
+
+# shared by the checks of the evaluation in this process
+_image_cache = ImageCache()
+
+
+def get_image_cache() -> ImageCache:
+    return _image_cache
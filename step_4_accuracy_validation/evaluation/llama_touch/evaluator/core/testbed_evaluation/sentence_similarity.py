@@ -1,18 +1,54 @@
+import threading
+from typing import List
+
 from sentence_transformers import SentenceTransformer, util
 
+MODEL_NAME = "all-MiniLM-L6-v2"
+ENCODE_BATCH_SIZE = 64
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model() -> SentenceTransformer:
+    """
+    The model is loaded once per process and shared by all comparisons.
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = SentenceTransformer(
+                model_name_or_path=MODEL_NAME,
+                device="cpu",
+            )
+        return _model
 
-def compute_sentence_similiarity(sentence1: str, sentence2: str) -> float:
-    model = SentenceTransformer(
-        model_name_or_path="all-MiniLM-L6-v2",
-        device="cpu",
-    )
 
-    sentence_embedding1 = model.encode(sentence1, convert_to_tensor=True)
-    sentence_embedding2 = model.encode(sentence2, convert_to_tensor=True)
+def encode_sentences(sentences: List[str]):
+    """
+    Encode the sentences in batches.
 
-    similarity = util.pytorch_cos_sim(sentence_embedding1, sentence_embedding2)[0][0]
+    Return: tensor of shape (len(sentences), dim), the embeddings are normalized
+    so that the cosine similarity of two embeddings is their dot product
+    """
+    model = get_model()
+    # the model is not safe to be called by several threads at once
+    with _model_lock:
+        return model.encode(
+            sentences,
+            batch_size=ENCODE_BATCH_SIZE,
+            convert_to_tensor=True,
+            normalize_embeddings=True,
+        )
 
-    return similarity
+
+def compute_embedding_similarity(embedding1, embedding2) -> float:
+    return float(util.dot_score(embedding1, embedding2)[0][0])
+
+
+def compute_sentence_similiarity(sentence1: str, sentence2: str) -> float:
+    sentence_embedding1, sentence_embedding2 = encode_sentences([sentence1, sentence2])
+    return compute_embedding_similarity(sentence_embedding1, sentence_embedding2)
 
 
 def check_sentence_similarity(sentence1: str, sentence2: str, threshold: float = 0.8):
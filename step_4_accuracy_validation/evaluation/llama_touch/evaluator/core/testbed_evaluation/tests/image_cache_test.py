@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+import imagehash
+from PIL import Image
+
+from core.testbed_evaluation.image_cache import ImageCache
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.image_paths = [
+            "evaluator/testbed_evaluation/tests/test_case/img_test_case/case1/2.png",
+            "evaluator/testbed_evaluation/tests/test_case/img_test_case/case1/3.png",
+            "evaluator/testbed_evaluation/tests/test_case/img_test_case/case2/1.png",
+        ]
+        self.bounds = [(0, 0, 200, 100), (100.5, 300.25, 540.0, 700.75)]
+
+    def test_patch_hashes_match_the_decoded_images(self):
+        cache = ImageCache()
+        for path in self.image_paths:
+            with Image.open(path) as img:
+                size = img.size
+                expected = [
+                    imagehash.average_hash(img.crop(bounds)) for bounds in self.bounds
+                ]
+            self.assertEqual(cache.get_size(path), size)
+            for bounds, patch_hash in zip(self.bounds, expected):
+                self.assertEqual(cache.get_patch_hash(path, bounds), patch_hash)
+                # memoized
+                self.assertIs(
+                    cache.get_patch_hash(path, list(bounds)),
+                    cache.get_patch_hash(path, bounds),
+                )
+
+    def test_decoded_images_are_bounded(self):
+        with Image.open(self.image_paths[0]) as img:
+            num_bytes = img.width * img.height * len(img.getbands())
+        cache = ImageCache(max_bytes=int(num_bytes * 1.5))
+        first = cache.get_image(self.image_paths[0])
+        self.assertIs(cache.get_image(self.image_paths[0]), first)
+        cache.get_image(self.image_paths[1])
+        # the first image was dropped to make room for the second one
+        self.assertIsNot(cache.get_image(self.image_paths[0]), first)
+
+    def test_index_round_trip(self):
+        cache = ImageCache()
+        for path in self.image_paths:
+            cache.get_patch_hash(path, self.bounds[1])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_path = os.path.join(temp_dir, "index.json")
+            cache.dump_index(index_path, set(self.image_paths[:2]))
+            loaded = ImageCache()
+            loaded.load_index(index_path)
+
+        for path in self.image_paths[:2]:
+            self.assertEqual(loaded.get_size(path), cache.get_size(path))
+            self.assertEqual(
+                loaded.get_patch_hash(path, self.bounds[1]),
+                cache.get_patch_hash(path, self.bounds[1]),
+            )
+        # nothing was decoded, the hashes and sizes come from the index
+        self.assertEqual(len(loaded._images), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
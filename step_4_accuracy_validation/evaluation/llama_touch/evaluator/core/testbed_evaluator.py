@@ -1,4 +1,5 @@
 import logging
+import os
 from typing import Dict, List, Optional, Tuple
 
 from core.agent import MobileAgent
@@ -6,11 +7,16 @@ from core.agent import MobileAgent
 from core.evaluator import BaseEvaluator, FailedReason
 from .task_trace import EssentialStateKeyword, TaskTrace, UIState
 from .testbed_evaluation.exact_match import (
+    build_groundtruth_hash_index,
     check_click_match,
     check_type_match,
     check_uicomponent_match,
 )
-from .testbed_evaluation.fuzzy_match import check_fuzzy_match
+from .testbed_evaluation.fuzzy_match import (
+    check_fuzzy_match,
+    precompute_trace_embeddings,
+)
+from .testbed_evaluation.image_cache import get_image_cache
 from .testbed_evaluation.system_state_match import (
     check_install_match,
     check_uninstall_match,
@@ -85,6 +91,20 @@ class TestbedEvaluator(BaseEvaluator):
         self.logger = logging.getLogger(self.evaluator_name)
         logging.getLogger().setLevel(logging.WARNING)
 
+        # the persisted hashes of the image patches of the ground-truth traces,
+        # built on the first evaluation
+        self.gr_hash_index = options.get("gr_hash_index") if options else None
+        if self.gr_hash_index:
+            if not os.path.exists(self.gr_hash_index):
+                build_groundtruth_hash_index(self.helper, self.gr_hash_index)
+            get_image_cache().load_index(self.gr_hash_index)
+
+    def init_worker(self) -> None:
+        # the image cache belongs to the process, the workers do not get it
+        # with their pickled copy of the evaluator
+        if self.gr_hash_index:
+            get_image_cache().load_index(self.gr_hash_index)
+
     def eval_impl(
         self, episode, task_description
     ) -> Tuple[bool, Optional[FailedReason]]:
@@ -94,6 +114,9 @@ class TestbedEvaluator(BaseEvaluator):
         exec_trace: TaskTrace = self.agent.load_exec_trace_by_episode(episode)
         if not exec_trace:
             return False, FailedReason.EXEC_TRACE_NOT_FOUND
+        if self.screen_level_fuzzy_match:
+            # the screens are encoded in one batch instead of once per comparison
+            precompute_trace_embeddings(gr_trace, exec_trace)
 
         # index for iterating exec_trace
         i = 0
@@ -17,6 +17,7 @@ class BaseAgent(MobileAgent):
         self.agent = name
         self.exec_trace_path = exec_trace_path
         self.epi_to_exec_trace_path = {}
+        self.helper = None
 
     def load_predicted_action_by_episode(self, episode: str) -> Optional[List[Action]]:
         exec_trace: TaskTrace = self.load_exec_trace_by_episode(episode)
@@ -25,16 +26,20 @@ class BaseAgent(MobileAgent):
         return None
    
     def load_exec_trace_by_episode(self, episode: str) -> Optional[TaskTrace]:
-        helper = DatasetHelper(CONFIG.EPI_METADATA_PATH, CONFIG.GR_DATASET_PATH)
-        path = helper.get_task_path_by_episode(episode)
+        # the metadata is loaded once, not for every episode
+        if self.helper is None:
+            self.helper = DatasetHelper(CONFIG.EPI_METADATA_PATH, CONFIG.GR_DATASET_PATH)
+        path = self.helper.get_task_path_by_episode(episode)
         exec_trace_path = os.path.join(self.exec_trace_path, path)
         if not os.path.exists(exec_trace_path):
             return None
-        return helper.load_testbed_trace_by_path(exec_trace_path)
+        return self.helper.load_testbed_trace_by_path(exec_trace_path)
     
 def parse_args():
     parser = argparse.ArgumentParser(description="This script generates solutions.")
     parser.add_argument('-a', '--agent_name', default="autodroidv2")
+    parser.add_argument('-w', '--num_workers', type=int, default=1, help='Number of processes evaluating the episodes, each with its own copy of the evaluator and its caches')
+    parser.add_argument('--gr_hash_index', default=None, help='Json file of the image hashes of the ground-truth traces, built if it does not exist')
     args = parser.parse_args()
 
     return args
@@ -72,8 +77,9 @@ if __name__ == "__main__":
             "check_fuzzy_match": True,
             "check_exact_match": True,
             "check_system_state": True,
+            "gr_hash_index": args.gr_hash_index,
         },
         
     )
-    t.run_evaluation()
+    t.run_evaluation(num_workers=args.num_workers)
     t.report_stats()
\ No newline at end of file
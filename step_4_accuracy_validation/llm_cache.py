@@ -0,0 +1,161 @@
+"""
+On-disk cache of LLM responses, shared by all pipeline stages and processes.
+
+Responses are keyed by (model, temperature, prompt hash), so re-running a stage after a crash or a small change only
+queries the prompts that changed. The least recently used responses are evicted when the cache grows over its size
+limit. Configured by environment variables:
+
+    LLM_CACHE_PATH: the SQLite file of the cache (default: .llm_cache/responses.sqlite)
+    LLM_CACHE_MAX_MB: the size limit of the cached responses (default: 1024)
+    LLM_CACHE_DISABLED: set to 1 to always query the models
+"""
+import os
+import json
+import time
+import atexit
+import sqlite3
+import hashlib
+import inspect
+import functools
+import threading
+
+DEFAULT_CACHE_PATH = '.llm_cache/responses.sqlite'
+DEFAULT_MAX_MB = 1024
+
+
+class LLMCache:
+
+    def __init__(self, path: str, max_size: int):
+        '''
+        @param max_size: the size limit of the cached responses in bytes
+        '''
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # several processes (e.g. the stages of a pipeline run at once) share the file
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, model TEXT, temperature TEXT, response TEXT, size INTEGER, last_access REAL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, prompt, temperature=None) -> str:
+        '''
+        @param prompt: str, or the list of content parts (text and images) of a multimodal prompt
+        '''
+        if not isinstance(prompt, str):
+            prompt = json.dumps(prompt, sort_keys=True)
+        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+        return f'{model}|{temperature}|{prompt_hash}'
+
+    def get(self, model: str, prompt, temperature=None):
+        '''
+        @return: the cached response, or None if the prompt was not queried before
+        '''
+        key = self.make_key(model, prompt, temperature)
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, model: str, prompt, response: str, temperature=None):
+        key = self.make_key(model, prompt, temperature)
+        size = len(response.encode())
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, model, str(temperature), response, size, time.time()))
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        evicted = []
+        for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY last_access'):
+            if total_size <= self.max_size:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'size': size,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _print_stats(cache: LLMCache):
+    if cache.hits + cache.misses:
+        stats = cache.stats()
+        print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['entries']} responses ({stats['size'] / 2**20:.1f} MB) in {cache.path}")
+
+
+def get_cache():
+    '''
+    @return: the process-wide cache, or None if caching is disabled
+    '''
+    global _cache
+    if os.environ.get('LLM_CACHE_DISABLED') == '1':
+        return None
+    with _cache_lock:
+        if _cache is None:
+            path = os.environ.get('LLM_CACHE_PATH', DEFAULT_CACHE_PATH)
+            max_mb = float(os.environ.get('LLM_CACHE_MAX_MB', DEFAULT_MAX_MB))
+            _cache = LLMCache(path, int(max_mb * 2**20))
+            atexit.register(_print_stats, _cache)
+        return _cache
+
+
+def cached_query(query_func):
+    '''
+    cache the responses of a query function, which takes the `prompt` and the `model` (or `model_name`) as arguments,
+    and optionally a `temperature`
+
+    The wrapped function takes an extra `refresh` argument: if True, the model is queried again instead of returning
+    the cached response, e.g. when the caller rejected it, and the new response replaces it in the cache.
+    '''
+    signature = inspect.signature(query_func)
+
+    @functools.wraps(query_func)
+    def wrapper(*args, refresh=False, **kwargs):
+        cache = get_cache()
+        if cache is None:
+            return query_func(*args, **kwargs)
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        prompt = arguments.arguments['prompt']
+        model = arguments.arguments.get('model', arguments.arguments.get('model_name'))
+        temperature = arguments.arguments.get('temperature')
+
+        response = None if refresh else cache.get(model, prompt, temperature)
+        if response is None:
+            response = query_func(*args, **kwargs)
+            if isinstance(response, str):
+                cache.put(model, prompt, response, temperature)
+        return response
+
+    return wrapper
@@ -0,0 +1,288 @@
+"""
+Concurrent client of the LLM APIs, used by MultiProcessingQuery instead of a process pool.
+
+The requests are coroutines of one event loop; the HTTP calls run in a thread pool sized to the concurrency limits.
+For every provider (the OpenAI-compatible proxy of the GPT models, the Anthropic API, and the OpenAI-compatible server
+of the other models, routed as tools.query_model does):
+
+    - at most `max_concurrency` requests are in flight,
+    - the requests are started at `requests_per_second` on average (token bucket of `burst` tokens),
+    - the failed requests (connection errors, timeouts, 408/409/429/5xx) are retried with an exponential backoff, or
+      after the delay of the Retry-After header, which also holds back the other requests to the provider.
+
+Identical prompts in flight are sent once and share the response, and the responses go through the on-disk cache of
+llm_cache, shared with the tools.query_* functions. Configured by environment variables:
+
+    GPT_API_URL: the base URL of the proxy of the GPT models (default: the one of tools.query_gpt)
+    LLM_MAX_CONCURRENCY: the requests in flight to each provider (default: 8)
+    LLM_REQUESTS_PER_SECOND: the rate of the requests to each provider (default: 5)
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import email.utils
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from llm_cache import LLMCache, get_cache
+
+GPT_MODELS = ["gpt-3.5-turbo", "gpt-3.5-turbo-16k", "gpt-4", "gpt-4-32k", "gpt-4o", "gpt-4-turbo"]
+CLAUDE_MODELS = ["claude-3-haiku-20240307", "claude-3-opus-20240229", "claude-3-sonnet-20240229"]
+
+# the proxy of the GPT models queried by tools.query_gpt
+DEFAULT_GPT_API_URL = 'https://chat1.plus7.plus/v1'
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+# the HTTP status of the requests worth retrying, 529 is the overload of the Anthropic API
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+MAX_RETRY_AFTER = 600
+
+logger = logging.getLogger('LLMClient')
+
+
+class LLMRequestError(Exception):
+    """
+    a request answered with an error status
+    """
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+@dataclass
+class Provider:
+    name: str
+    # 'openai' for the chat completions API, 'anthropic' for the messages API
+    api: str
+    base_url: str
+    api_key: str = ''
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND
+    burst: int = DEFAULT_MAX_CONCURRENCY
+
+
+def default_providers() -> dict:
+    max_concurrency = int(os.environ.get('LLM_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY))
+    requests_per_second = float(os.environ.get('LLM_REQUESTS_PER_SECOND', DEFAULT_REQUESTS_PER_SECOND))
+    providers = [
+        Provider('gpt', 'openai', os.environ.get('GPT_API_URL') or DEFAULT_GPT_API_URL,
+                 os.environ.get('OPENAI_API_KEY', '')),
+        Provider('claude', 'anthropic', os.environ.get('ANTHROPIC_API_URL') or 'https://api.anthropic.com',
+                 os.environ.get('ANTHROPIC_API_KEY', '')),
+        Provider('llm', 'openai', os.environ.get('OPENAI_API_URL', ''), os.environ.get('LLM_API_KEY', '')),
+    ]
+    for provider in providers:
+        provider.max_concurrency = provider.burst = max_concurrency
+        provider.requests_per_second = requests_per_second
+    return {provider.name: provider for provider in providers}
+
+
+def get_provider_name(model: str) -> str:
+    if model in GPT_MODELS:
+        return 'gpt'
+    if model in CLAUDE_MODELS:
+        return 'claude'
+    return 'llm'
+
+
+def parse_retry_after(value):
+    '''
+    @param value: the Retry-After header, in seconds or as an HTTP date
+    @return: the seconds to wait, or None if there is no valid header
+    '''
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class TokenBucket:
+    """
+    rate limit of the requests to a provider, for the coroutines of one event loop
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        # the waiting requests are served in order
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        '''
+        hold back the requests, e.g. for the Retry-After of a rate limited request
+        '''
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # no burst when the requests are resumed
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+
+class _ProviderState:
+
+    def __init__(self, provider: Provider):
+        self.semaphore = asyncio.Semaphore(provider.max_concurrency)
+        self.bucket = TokenBucket(provider.requests_per_second, provider.burst)
+
+
+class LLMClient:
+
+    def __init__(self, providers: dict = None, max_concurrency: int = None, timeout: float = 120,
+                 max_retries: int = 6, base_backoff: float = 1.0, max_backoff: float = 60.0, use_cache: bool = True):
+        '''
+        @param providers: name of the provider -> Provider, see default_providers()
+        @param max_concurrency: if given, the requests in flight to each provider, instead of the configured ones
+        @param use_cache: whether to look up and store the responses in the cache of llm_cache
+        '''
+        self.providers = providers if providers is not None else default_providers()
+        if max_concurrency is not None:
+            for provider in self.providers.values():
+                provider.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.use_cache = use_cache
+
+        workers = sum(provider.max_concurrency for provider in self.providers.values())
+        self._executor = ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix='llm-client')
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.providers), pool_maxsize=workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        # created in the event loop of the first request
+        self._states = {}
+        self._inflight = {}
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'coalesced': 0, 'cached': 0}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _state(self, provider: Provider) -> _ProviderState:
+        if provider.name not in self._states:
+            self._states[provider.name] = _ProviderState(provider)
+        return self._states[provider.name]
+
+    async def complete(self, model: str, prompt: str, refresh: bool = False) -> str:
+        '''
+        @param refresh: if True, query the model even if the prompt is cached or in flight, e.g. to retry an invalid
+            response, and replace the cached response
+        @return: the response of the model
+        '''
+        if refresh:
+            return await self._complete(model, prompt, refresh=True)
+        key = LLMCache.make_key(model, prompt)
+        task = self._inflight.get(key)
+        if task is not None:
+            self._count('coalesced')
+        else:
+            task = asyncio.ensure_future(self._complete(model, prompt))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # a cancelled caller does not cancel the request shared with the others
+        return await asyncio.shield(task)
+
+    async def _complete(self, model: str, prompt: str, refresh: bool = False) -> str:
+        loop = asyncio.get_running_loop()
+        cache = get_cache() if self.use_cache else None
+        if cache is not None and not refresh:
+            response = await loop.run_in_executor(self._executor, cache.get, model, prompt)
+            if response is not None:
+                self._count('cached')
+                return response
+        response = await self._request(self.providers[get_provider_name(model)], model, prompt)
+        if cache is not None:
+            await loop.run_in_executor(self._executor, cache.put, model, prompt, response)
+        return response
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.max_backoff, self.base_backoff * 2**attempt) * random.uniform(0.5, 1.0)
+
+    async def _request(self, provider: Provider, model: str, prompt: str) -> str:
+        loop = asyncio.get_running_loop()
+        state = self._state(provider)
+        attempt = 0
+        while True:
+            async with state.semaphore:
+                await state.bucket.acquire()
+                self._count('requests')
+                try:
+                    return await loop.run_in_executor(self._executor, self._post, provider, model, prompt)
+                except LLMRequestError as e:
+                    if e.status not in RETRY_STATUS or attempt >= self.max_retries:
+                        raise
+                    err = e
+                    delay = e.retry_after if e.retry_after is not None else self._backoff(attempt)
+                    if e.status == 429 or e.retry_after is not None:
+                        state.bucket.pause(delay)
+                except (requests.RequestException, ValueError, KeyError, IndexError) as e:
+                    # connection errors, timeouts and malformed responses
+                    if attempt >= self.max_retries:
+                        raise
+                    err = e
+                    delay = self._backoff(attempt)
+            attempt += 1
+            self._count('retries')
+            logger.warning(f'{provider.name} request failed ({err}), retrying in {delay:.1f}s ({attempt}/{self.max_retries})')
+            await asyncio.sleep(delay)
+
+    def _post(self, provider: Provider, model: str, prompt: str) -> str:
+        messages = [{'role': 'user', 'content': prompt}]
+        if provider.api == 'anthropic':
+            url = provider.base_url.rstrip('/') + '/v1/messages'
+            headers = {'x-api-key': provider.api_key, 'anthropic-version': '2023-06-01'}
+            body = {'model': model, 'max_tokens': 4096, 'messages': messages}
+        else:
+            url = provider.base_url.rstrip('/') + '/chat/completions'
+            headers = {'Authorization': f'Bearer {provider.api_key}'}
+            body = {'model': model, 'messages': messages}
+
+        response = self._session.post(url, headers=headers, json=body, timeout=self.timeout)
+        if response.status_code != 200:
+            raise LLMRequestError(f'{response.status_code} {response.text[:200]}', response.status_code,
+                                  parse_retry_after(response.headers.get('Retry-After')))
+        data = response.json()
+        if provider.api == 'anthropic':
+            return data['content'][0]['text']
+        return data['choices'][0]['message']['content']
@@ -3,8 +3,8 @@ import argparse
 import os
 import time
 import yaml
-from evaluation.droidtask.config import BASE_EXPERIMENT_PATH, BASELINE_PATH, GROUNDTRUTH_PATH, TASKS_GROUNDTRUTH_PATH, EMULATOR_AGRS
-from evaluation.droidtask.experiment.test_all_tasks import run_all_tasks
+from evaluation.droidtask.config import BASE_EXPERIMENT_PATH, BASELINE_PATH, GROUNDTRUTH_PATH, TASKS_GROUNDTRUTH_PATH, EMULATOR_AGRS, EMULATOR_POOL, BATCH_GENERATION
+from evaluation.droidtask.experiment.test_all_tasks import run_all_tasks, run_all_tasks_on_devices
 import tools as tools
 from dotenv import load_dotenv
 
@@ -270,9 +270,12 @@ if __name__ == '__main__':
         "notes", 
         "voicerecorder"
     ]
+    if not evaluation:
+        # run the tasks of all apps at once, so that every emulator of the pool is kept busy
+        run_all_tasks_on_devices(app_list, f"{BASE_EXPERIMENT_PATH}/{agent}", EMULATOR_POOL, model, batch_generation=BATCH_GENERATION)
     all_stats = []
     for app in app_list:
-        app_acc, all_tasks, stats = test_app_tasks(agent, app, baseline_dir, model, run_tasks_online=not evaluation)
+        app_acc, all_tasks, stats = test_app_tasks(agent, app, baseline_dir, model, run_tasks_online=False)
         all_stats.append(stats)
         # show_app_failures(app, baseline_dir)
     stats_txt = ""